@@ -0,0 +1,389 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script sending the Mist API requests and the PSK emails with asyncio
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from mist_psk import Mist
+from mist_smtp import MistSmtp
+from mist_metrics import METRICS
+from mist_output import line_printer
+from mist_records import Psk
+
+try:
+    import aiohttp
+    import aiosmtplib
+except ImportError:
+    aiohttp = None
+    aiosmtplib = None
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def is_available() -> bool:
+    """
+    Return True if the optional packages used by the asyncio engine
+    (aiohttp and aiosmtplib) are installed
+    """
+    return aiohttp is not None and aiosmtplib is not None
+
+
+class AsyncEngine:
+    """
+    Class running an asyncio event loop in a dedicated thread. The
+    synchronization code stays synchronous and runs the coroutines with
+    `run`, so the targets synchronized in parallel share the same loop, the
+    same HTTP connections and the same limit of `concurrency` requests sent
+    at the same time.
+    """
+
+    def __init__(self, concurrency: int = 100):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        self._http = None
+        self.semaphore = self.run(self._create_semaphore())
+
+    async def _create_semaphore(self):
+        return asyncio.Semaphore(self.concurrency)
+
+    def submit(self, coroutine):
+        """
+        Start the `coroutine` in the event loop and return a
+        concurrent.futures.Future, so the calling thread can wait for it
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        """
+        Run the `coroutine` in the event loop and return its result
+        """
+        return self.submit(coroutine).result()
+
+    async def get_http(self):
+        """
+        Return the aiohttp session, created in the event loop when it is
+        first used
+        """
+        if self._http is None:
+            # the proxy settings are read from the environment, like with requests
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=300),
+                trust_env=True,
+            )
+        return self._http
+
+    def close(self):
+        """
+        Close the HTTP connections and stop the event loop
+        """
+        if self._http is not None:
+            self.run(self._http.close())
+            self._http = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncResponse:
+    """
+    Response of a request sent with aiohttp, with the attributes of the
+    mistapi responses used by the script
+    """
+
+    def __init__(self, status_code=None, headers=None, data=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.data = data
+
+
+class AsyncMist(Mist):
+    """
+    Mist class listing, importing and deleting the PSKs with aiohttp. The
+    API session is still opened with mistapi (login, token validation,
+    cloud host), and the other requests are still sent with mistapi.
+    The requests go through the same ApiThrottle as the mistapi requests,
+    so they share the rate limits and the pause on HTTP 429.
+    """
+
+    def __init__(self, config, engine: AsyncEngine):
+        super().__init__(config)
+        self.engine = engine
+
+    def _psks_uri(self):
+        return f"/api/v1/{self.scope}/{self.scope_id}/psks"
+
+    async def _request(self, method: str, uri: str, idempotent: bool = True, **kwargs):
+        return await self.throttle.call_async(
+            self._send_request, method, uri,
+            idempotent=idempotent, slot=self.engine.semaphore, **kwargs
+        )
+
+    async def _map(self, function, items: list) -> list:
+        """
+        Call the coroutine `function` for each item, with at most
+        `concurrency` workers, and return the results (or the exceptions)
+        in the same order. Only the workers are created, not one coroutine
+        per item
+        """
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+
+        async def worker():
+            for index, item in pending:
+                try:
+                    results[index] = await function(item)
+                except Exception as e:
+                    results[index] = e
+
+        await asyncio.gather(
+            *[worker() for _ in range(min(self.engine.concurrency, len(items)))]
+        )
+        return results
+
+    async def _send_request(self, method: str, uri: str, params: dict = None, body=None):
+        session = self.apisession._session
+        url = f"https://{self.apisession._cloud_uri}{uri}"
+        # read for each request, as the API session can be opened again
+        headers = dict(session.headers)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        http = await self.engine.get_http()
+        try:
+            async with http.request(
+                method,
+                url,
+                params=params,
+                data=payload,
+                headers=headers,
+                cookies=session.cookies.get_dict(),
+            ) as response:
+                content = await response.read()
+                try:
+                    data = json.loads(content) if content else None
+                except ValueError:
+                    data = content.decode(errors="replace")
+                METRICS.api_call(method, uri, response.status, len(payload or b""), len(content))
+                return AsyncResponse(response.status, response.headers, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            LOGGER.error("Exception occurred", exc_info=True)
+            METRICS.api_call(method, uri, None)
+            return AsyncResponse()
+
+    ###########################################################################
+    # LIST
+    def get_ppks(self):
+        return [Psk.from_dict(psk) for psk in self.engine.run(self._list_ppks())]
+
+    async def _list_ppks(self):
+        """
+        Request the first page to get the total number of PSKs, then
+        request the other pages with `concurrency` workers
+        """
+        limit = 1000
+        response = await self._list_ppks_page_async(1, limit)
+        total = response.headers.get("X-Page-Total")
+        data = response.data
+        if total is None:
+            # no pagination information, request the pages until the last one
+            page = 1
+            while len(response.data) >= limit:
+                page += 1
+                response = await self._list_ppks_page_async(page, limit)
+                data += response.data
+            return data
+        pages = range(2, -(-int(total) // limit) + 1)
+        LOGGER.debug(f"_list_ppks:{total} psks, requesting {len(pages)} more pages")
+        responses = await self._map(lambda page: self._list_ppks_page_async(page, limit), list(pages))
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+            data += response.data
+        return data
+
+    async def _list_ppks_page_async(self, page: int, limit: int):
+        response = await self._request(
+            "GET", self._psks_uri(),
+            params={"limit": limit, "page": page, **({"ssid": self.ssid} if self.ssid else {})}
+        )
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.data}")
+        return response
+
+    ###########################################################################
+    # DELETE
+    def delete_ppsks(self, psk_ids: list, dry_run: bool = False, on_deleted=None):
+        if dry_run:
+            return super().delete_ppsks(psk_ids, dry_run, on_deleted)
+        return self.engine.run(self._delete_ppsks(psk_ids, on_deleted))
+
+    async def _delete_ppsks(self, psk_ids: list, on_deleted=None):
+        """
+        Same as Mist.delete_ppsks, but the bulk deletes, then the single
+        deletes, are sent by `concurrency` workers
+        """
+        results = {}
+        remaining = psk_ids
+        if self.scope == "orgs":
+            remaining = []
+            batch_size = 100
+            batches = [
+                psk_ids[start : start + batch_size]
+                for start in range(0, len(psk_ids), batch_size)
+            ]
+            responses = await self._map(
+                lambda batch: self._request("POST", f"{self._psks_uri()}/delete", body={"psk_ids": batch}),
+                batches,
+            )
+            for batch, response in zip(batches, responses):
+                if isinstance(response, Exception):
+                    LOGGER.error("Exception occurred", exc_info=response)
+                elif response.status_code == 200:
+                    for psk_id in batch:
+                        results[psk_id] = True
+                    if on_deleted:
+                        on_deleted(batch)
+                    continue
+                LOGGER.warning("delete_ppsks:bulk delete failed. Will delete the psks one by one")
+                remaining += batch
+
+        responses = await self._map(
+            lambda psk_id: self._request("DELETE", f"{self._psks_uri()}/{psk_id}"), remaining
+        )
+        for psk_id, response in zip(remaining, responses):
+            if isinstance(response, Exception):
+                LOGGER.error("Exception occurred", exc_info=response)
+                results[psk_id] = False
+            else:
+                results[psk_id] = response.status_code == 200
+            if not results[psk_id]:
+                LOGGER.error(f"delete_ppsks:unable to delete psk id {psk_id}")
+            elif on_deleted:
+                on_deleted([psk_id])
+        return results
+
+    ###########################################################################
+    # CREATE
+    def _submit_import(self, executor, psks_data, dry_run: bool = False):
+        # only the request is sent by the event loop: the results are still
+        # processed by the target thread, which owns the inventory and the
+        # cache (the SQLite connection can not be used by another thread)
+        if dry_run:
+            return super()._submit_import(executor, psks_data, dry_run)
+        return self.engine.submit(self._import_ppsks_async(psks_data))
+
+    async def _import_ppsks_async(self, psks_data):
+        start = time.monotonic()
+        # safe to replay: the PSKs are created or updated by name (see
+        # Mist._import_ppsks)
+        response = await self._request(
+            "POST", f"{self._psks_uri()}/import", idempotent=True, body=psks_data
+        )
+        elapsed = time.monotonic() - start
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.data}")
+        return response.data, elapsed
+
+
+class AsyncMistSmtp(MistSmtp):
+    """
+    MistSmtp class sending the PSK emails with aiosmtplib. Up to
+    `pool_size` SMTP sessions are opened, and each session sends the
+    emails one after the other. The report is still sent with smtplib.
+    """
+
+    def __init__(self, config, engine: AsyncEngine):
+        super().__init__(config)
+        self.engine = engine
+
+    def send_psks(self, emails: list, dry_run: bool = False, on_sent=None):
+        if dry_run or not self.email_psk_to_users or not emails:
+            return super().send_psks(emails, dry_run, on_sent)
+        # the lines printed by the event loop keep the prefix of the target
+        return self.engine.run(self._send_psks(emails, on_sent, line_printer()))
+
+    async def _send_psks(self, emails: list, on_sent=None, print_line=None):
+        print_line = print_line or line_printer()
+        pending = asyncio.Queue()
+        for index, email in enumerate(emails):
+            pending.put_nowait((index, email))
+        results = [False] * len(emails)
+        await asyncio.gather(
+            *[
+                self._smtp_worker(pending, results, on_sent, print_line)
+                for _ in range(min(max(1, self.pool_size), len(emails)))
+            ]
+        )
+        return results
+
+    async def _smtp_worker(self, pending: asyncio.Queue, results: list, on_sent, print_line):
+        session = None
+        try:
+            while not pending.empty():
+                index, (psk, ssid, user_name, user_email) = pending.get_nowait()
+                # rendered by a thread, so the other sessions keep sending
+                start = time.perf_counter()
+                msg = await asyncio.get_running_loop().run_in_executor(
+                    None, self._build_psk_email, psk, ssid, user_name, user_email
+                )
+                METRICS.add_time("email_render", time.perf_counter() - start)
+                METRICS.add_items("email_render")
+                log_message = f"Sending psk email to {user_name} {user_email}"
+                LOGGER.info(f"_send_email:{log_message}")
+                start = time.perf_counter()
+                try:
+                    try:
+                        if session is None:
+                            session = await self._connect()
+                        await session.sendmail(self.from_email, [user_email], msg)
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # the server closed the idle session, open a new one
+                        LOGGER.debug("_smtp_worker:session closed by the server, reconnecting")
+                        session = await self._connect()
+                        await session.sendmail(self.from_email, [user_email], msg)
+                    METRICS.add_time("email_send", time.perf_counter() - start)
+                    METRICS.add_items("email_send")
+                    METRICS.count("email_bytes_sent", len(msg))
+                    results[index] = True
+                    print_line(f"{log_message} ".ljust(79, ".") + "\033[92m\u2714\033[0m")
+                    LOGGER.info("_send_email:email sent")
+                    if on_sent:
+                        on_sent(user_name)
+                except:
+                    print_line(f"{log_message} ".ljust(79, ".") + '\033[31m\u2716\033[0m')
+                    LOGGER.critical("Exception occurred", exc_info=True)
+                    if session is not None:
+                        session.close()
+                    session = None
+        finally:
+            if session is not None:
+                try:
+                    await session.quit()
+                except:
+                    LOGGER.debug("_smtp_worker:unable to close the session", exc_info=True)
+
+    async def _connect(self):
+        LOGGER.debug(f"_connect:opening a new session to {self.host}:{self.port}")
+        # like smtplib.SMTP, no STARTTLS when SSL is not used
+        session = aiosmtplib.SMTP(
+            hostname=self.host, port=self.port, use_tls=self.use_ssl, start_tls=False
+        )
+        await session.connect()
+        if self.username and self.password:
+            await session.login(self.username, self.password)
+        return session
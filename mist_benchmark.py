@@ -0,0 +1,470 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Python Script to benchmark the synchronization without any external service.
+
+The LDAP directory is seeded with the ldap3 mock strategy, the Mist PSK API
+is replaced by a local fake API (with configurable latency and HTTP 429
+responses) plugged into the HTTP session of mistapi, and the emails are
+sent to a local SMTP sink. Each phase of the synchronization is timed for
+each number of users.
+
+---
+Usage:
+-u, --users=        comma separated list of the number of users to test.
+                    default is "1000,10000,100000,500000"
+
+-x, --existing=     ratio of the users already having a PSK. default is 0.9
+
+-s, --stale=        number of PSKs to delete, as a ratio of the number of
+                    users. default is 0.01
+
+-L, --latency=      latency of the fake Mist API, in milliseconds.
+                    default is 50
+
+-R, --rate=         number of requests per second accepted by the fake Mist
+                    API before sending HTTP 429 responses. default is 0
+                    (unlimited)
+
+-o, --output=       save the results in a JSON file
+
+-m, --tracemalloc   measure the peak of memory allocated by Python for each
+                    run (slower)
+
+-v, --verbose       display the output of the synchronization
+
+-h, --help          display this help
+
+The settings of the synchronization (e.g. MIST_CREATE_WORKERS) can be set
+as environment variables.
+"""
+import os
+import sys
+import io
+import re
+import gc
+import json
+import time
+import getopt
+import random
+import socketserver
+import threading
+import tracemalloc
+import resource
+import contextlib
+import urllib.parse
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+import mist_ldap_sync
+from mist_ldap import MistLdap
+from mist_metrics import METRICS
+
+BASE_DN = "DC=benchmark,DC=local"
+SEARCH_GROUP = f"CN=wifi,OU=Groups,{BASE_DN}"
+BIND_USER = f"CN=admin,{BASE_DN}"
+BIND_PASSWORD = "benchmark"
+ORG_ID = "00000000-0000-0000-0000-000000000000"
+SSID = "benchmark"
+
+
+###############################################################################
+#### LDAP
+class BenchmarkLdap(MistLdap):
+    """
+    MistLdap connected to a ldap3 mock directory
+    """
+
+    # the mock strategy does not support the extensible match filters, and
+    # the seeded accounts are all enabled
+    ENABLED_USERS = ""
+
+    def __init__(self, config, server: Server):
+        super().__init__(config)
+        self.mock_server = server
+
+    def _bind(self, exclude=None, **options):
+        conn = Connection(
+            self.mock_server,
+            user=BIND_USER,
+            password=BIND_PASSWORD,
+            client_strategy=MOCK_SYNC,
+        )
+        conn.bind()
+        return conn
+
+
+def seed_directory(users: int):
+    """
+    Return a mock server with `users` members of the search group
+    """
+    server = Server("benchmark", get_info=OFFLINE_AD_2012_R2)
+    conn = Connection(server, user=BIND_USER, password=BIND_PASSWORD, client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry(BIND_USER, {"userPassword": BIND_PASSWORD, "sn": "admin"})
+    conn.strategy.add_entry(SEARCH_GROUP, {"objectClass": ["top", "group"]})
+    for i in range(users):
+        conn.strategy.add_entry(
+            f"CN=user{i},OU=Users,{BASE_DN}",
+            {
+                "objectClass": ["top", "person", "organizationalPerson", "user"],
+                "userPrincipalName": f"user{i}@benchmark.local",
+                "mail": f"user{i}@benchmark.local",
+                "memberOf": [SEARCH_GROUP],
+            },
+        )
+    return server
+
+
+###############################################################################
+#### MIST
+class FakeMistApi(BaseAdapter):
+    """
+    requests adapter answering the Mist PSK API requests from memory.
+    Each request is delayed by `latency` seconds, and HTTP 429 responses
+    are sent when more than `rate` requests per second are received.
+    """
+
+    def __init__(self, latency: float = 0, rate: float = 0):
+        super().__init__()
+        self.latency = latency
+        self.rate = rate
+        self.psks = {}
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def seed(self, names: list):
+        for name in names:
+            self._add({"name": name, "passphrase": "benchmark", "ssid": SSID})
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        url = urllib.parse.urlparse(request.url)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        body = json.loads(request.body) if request.body else None
+        route = re.sub(r"/(orgs|sites)/[^/]+", "/\\1/{id}", url.path)
+        route = re.sub(r"/psks/(?!import|delete)[^/]+$", "/psks/{psk_id}", route)
+        with self._lock:
+            if self._throttle():
+                return self._response(request, 429, {"detail": "Too Many Requests"}, {"Retry-After": "1"})
+            return self._route(request, request.method, route, url.path, query, body)
+
+    def close(self):
+        pass
+
+    def _throttle(self):
+        if not self.rate:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def _route(self, request, method, route, path, query, body):
+        if route == "/api/v1/self":
+            return self._response(request, 200, {
+                "email": "benchmark@benchmark.local",
+                "privileges": [{"scope": "org", "org_id": ORG_ID, "role": "admin", "name": "benchmark"}],
+            })
+        if method == "GET" and route.endswith("/psks"):
+            psks = list(self.psks.values())
+            if query.get("ssid"):
+                psks = [psk for psk in psks if psk["ssid"] == query["ssid"]]
+            if query.get("name"):
+                names = query["name"].split(",")
+                psks = [psk for psk in psks if psk["name"] in names]
+            limit = int(query.get("limit", 100))
+            page = int(query.get("page", 1))
+            headers = {"X-Page-Total": str(len(psks)), "X-Page-Limit": str(limit), "X-Page-Page": str(page)}
+            return self._response(request, 200, psks[(page - 1) * limit : page * limit], headers)
+        if method == "POST" and route.endswith("/psks/import"):
+            for psk in body:
+                self._add(psk)
+            return self._response(request, 200, {"updated": [psk["name"] for psk in body], "errors": []})
+        if method == "POST" and route.endswith("/psks/delete"):
+            for psk_id in body["psk_ids"]:
+                self.psks.pop(psk_id, None)
+            return self._response(request, 200, {})
+        if method == "POST" and route.endswith("/psks"):
+            return self._response(request, 200, self._add(body))
+        if method == "DELETE" and route.endswith("/psks/{psk_id}"):
+            if self.psks.pop(path.rsplit("/", 1)[1], None):
+                return self._response(request, 200, {})
+            return self._response(request, 404, {"detail": "not found"})
+        return self._response(request, 404, {"detail": f"{method} {route} not implemented"})
+
+    def _add(self, psk: dict):
+        psk = dict(psk, id=f"{random.getrandbits(128):032x}")
+        self.psks[psk["id"]] = psk
+        return psk
+
+    def _response(self, request, status_code: int, data, headers: dict = None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.reason = "OK" if status_code < 400 else "ERROR"
+        response._content = json.dumps(data).encode()
+        response.headers = CaseInsensitiveDict({"Content-Type": "application/json", **(headers or {})})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+
+@contextlib.contextmanager
+def fake_mist_api(api: FakeMistApi):
+    """
+    Send all the requests to the Mist Cloud to the fake API
+    """
+    get_adapter = requests.Session.get_adapter
+
+    def _get_adapter(session, url):
+        if urllib.parse.urlparse(url).hostname == "api.mist.com":
+            return api
+        return get_adapter(session, url)
+
+    requests.Session.get_adapter = _get_adapter
+    try:
+        yield api
+    finally:
+        requests.Session.get_adapter = get_adapter
+
+
+###############################################################################
+#### SMTP
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 benchmark ESMTP\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.wfile.write(b"250-benchmark\r\n250 8BITMIME\r\n")
+            elif command == b"DATA":
+                self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                size = 0
+                for data in self.rfile:
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                self.server.received(size)
+                self.wfile.write(b"250 OK\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 Bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server accepting and discarding all the emails
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpSinkHandler)
+        self.messages = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def received(self, size: int):
+        with self._lock:
+            self.messages += 1
+            self.bytes_received += size
+
+
+###############################################################################
+#### BENCHMARK
+def _configure(smtp_port: int):
+    defaults = {
+        "LDAP_HOST": "benchmark",
+        "LDAP_BIND_USER": BIND_USER,
+        "LDAP_BIND_PASSWORD": BIND_PASSWORD,
+        "LDAP_BASE_DN": BASE_DN,
+        "LDAP_SEARCH_GROUP": SEARCH_GROUP,
+        "LDAP_RECURSIVE_SEARCH": "False",
+        "MIST_HOST": "api.mist.com",
+        "MIST_API_TOKEN": "benchmark",
+        "MIST_SCOPE": "orgs",
+        "MIST_SCOPE_ID": ORG_ID,
+        "MIST_SSID": SSID,
+        "SMTP_ENABLED": "True",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_USE_SSL": "False",
+        "SMTP_FROM_EMAIL": "wifi@benchmark.local",
+        "SMTP_REPORT_ENABLED": "True",
+        "SMTP_REPORT_RECEIVERS": "admin@benchmark.local",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ["SMTP_PORT"] = str(smtp_port)
+    with contextlib.redirect_stdout(io.StringIO()):
+        ldap_config = mist_ldap_sync._load_ldap(False)
+        mist_config = mist_ldap_sync._load_mist(False)
+        smtp_config = mist_ldap_sync._load_smtp(False, "psk_template.html")
+    return ldap_config, mist_config, smtp_config
+
+
+def run(users: int, existing: float, stale: float, latency: float, rate: float, use_tracemalloc: bool, verbose: bool):
+    """
+    Run one synchronization with `users` LDAP users and return the results
+    """
+    gc.collect()
+    print(f"Seeding the directory with {users} users ".ljust(79, "."), end="", flush=True)
+    start = time.perf_counter()
+    server = seed_directory(users)
+    api = FakeMistApi(latency / 1000, rate)
+    names = [f"user{i}@benchmark.local" for i in range(int(users * existing))]
+    names += [f"stale{i}@benchmark.local" for i in range(int(users * stale))]
+    api.seed(names)
+    seed_time = time.perf_counter() - start
+    print("\033[92m✔\033[0m")
+
+    sink = SmtpSink()
+    print(f"Synchronizing {users} users ".ljust(79, "."), end="", flush=True)
+    if use_tracemalloc:
+        tracemalloc.start()
+    try:
+        ldap_config, mist_config, smtp_config = _configure(sink.port)
+        output = sys.stdout if verbose else open(os.devnull, "w")
+        with fake_mist_api(api), contextlib.redirect_stdout(output):
+            start = time.perf_counter()
+            main = mist_ldap_sync.Main(ldap_config, mist_config, smtp_config, False, False, [])
+            main.ldap = BenchmarkLdap(ldap_config, server)
+            main.sync()
+            total = time.perf_counter() - start
+        if not verbose:
+            output.close()
+        print("\033[92m✔\033[0m")
+    except:
+        print("\033[31m✖\033[0m")
+        raise
+    finally:
+        sink.shutdown()
+        sink.server_close()
+        peak = None
+        if use_tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    metrics = METRICS.to_dict()
+    return {
+        "users": users,
+        "seed_time": seed_time,
+        "total_time": total,
+        "phases": {name: phase["seconds"] for name, phase in metrics["phases"].items()},
+        "psks_created": len(main.report_add),
+        "psks_deleted": len(main.report_delete),
+        "api_calls": {
+            f"{call['method']} {call['endpoint']} {call['status']}": call["count"]
+            for call in metrics["api_calls"]
+        },
+        "api_throttled": metrics["counters"].get("api_throttled", 0),
+        "api_bytes_sent": metrics["counters"].get("api_bytes_sent", 0),
+        "api_bytes_received": metrics["counters"].get("api_bytes_received", 0),
+        "emails": sink.messages,
+        "email_bytes": sink.bytes_received,
+        "tracemalloc_peak": peak,
+        # high-water mark of the process, in KB on Linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def print_results(results: list):
+    phases = []
+    for result in results:
+        for phase in result["phases"]:
+            if phase not in phases:
+                phases.append(phase)
+    print()
+    print(" RESULTS (seconds) ".center(80, "_"))
+    print("phase".ljust(16) + "".join(f"{result['users']:>12}" for result in results))
+    for phase in phases:
+        print(phase.ljust(16) + "".join(f"{result['phases'].get(phase, 0):>12.2f}" for result in results))
+    print("total".ljust(16) + "".join(f"{result['total_time']:>12.2f}" for result in results))
+    print("users/s".ljust(16) + "".join(f"{result['users'] / result['total_time']:>12.0f}" for result in results))
+    print("api calls".ljust(16) + "".join(f"{sum(result['api_calls'].values()):>12}" for result in results))
+    print("api 429".ljust(16) + "".join(f"{result['api_throttled']:>12}" for result in results))
+    print("emails".ljust(16) + "".join(f"{result['emails']:>12}" for result in results))
+    print("max rss (MB)".ljust(16) + "".join(f"{result['max_rss'] / 1024:>12.0f}" for result in results))
+    if any(result["tracemalloc_peak"] is not None for result in results):
+        print("py peak (MB)".ljust(16) + "".join(
+            f"{(result['tracemalloc_peak'] or 0) / 1024 / 1024:>12.0f}" for result in results
+        ))
+
+
+def usage():
+    print(__doc__.split("---", 1)[1])
+
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(
+            sys.argv[1:],
+            "u:x:s:L:R:o:mvh",
+            ["users=", "existing=", "stale=", "latency=", "rate=", "output=", "tracemalloc", "verbose", "help"],
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    USERS = [1000, 10000, 100000, 500000]
+    EXISTING = 0.9
+    STALE = 0.01
+    LATENCY = 50
+    RATE = 0
+    OUTPUT = None
+    TRACEMALLOC = False
+    VERBOSE = False
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            usage()
+            sys.exit()
+        elif o in ["-u", "--users"]:
+            USERS = [int(users) for users in a.split(",")]
+        elif o in ["-x", "--existing"]:
+            EXISTING = float(a)
+        elif o in ["-s", "--stale"]:
+            STALE = float(a)
+        elif o in ["-L", "--latency"]:
+            LATENCY = float(a)
+        elif o in ["-R", "--rate"]:
+            RATE = float(a)
+        elif o in ["-o", "--output"]:
+            OUTPUT = a
+        elif o in ["-m", "--tracemalloc"]:
+            TRACEMALLOC = True
+        elif o in ["-v", "--verbose"]:
+            VERBOSE = True
+        else:
+            assert False, "unhandled option"
+
+    RESULTS = []
+    for users in USERS:
+        RESULTS.append(run(users, EXISTING, STALE, LATENCY, RATE, TRACEMALLOC, VERBOSE))
+    print_results(RESULTS)
+    if OUTPUT:
+        with open(OUTPUT, "w") as f:
+            json.dump(RESULTS, f, indent=2)
+        print(f"Results saved in {OUTPUT}")
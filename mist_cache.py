@@ -0,0 +1,123 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the local cache of the Mist PSKs
+"""
+import logging
+import os
+import sqlite3
+import time
+from mist_records import Psk
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class PskCache:
+    """
+    Class storing the PSK inventory in a SQLite file, keyed by scope,
+    scope_id and SSID, so it can be reused by the next runs instead of
+    listing all the PSKs from the Mist Cloud.
+    """
+
+    def __init__(self, path: str, scope: str, scope_id: str, ssid: str):
+        self.path = path
+        self.key = (scope, scope_id, ssid)
+        # the file contains the passphrases, so it is only readable by the
+        # owner (SQLite creates its journal files with the same mode)
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS psks (
+                scope TEXT, scope_id TEXT, ssid TEXT,
+                id TEXT, name TEXT, passphrase TEXT, email TEXT, vlan_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS psks_key ON psks (scope, scope_id, ssid);
+            CREATE TABLE IF NOT EXISTS meta (
+                scope TEXT, scope_id TEXT, ssid TEXT, full_sync_time REAL,
+                PRIMARY KEY (scope, scope_id, ssid)
+            );
+            """
+        )
+
+    def age(self):
+        """
+        Return the number of seconds since the last full reload, or None if
+        there is no cached data for this scope/SSID
+        """
+        row = self.conn.execute(
+            "SELECT full_sync_time FROM meta WHERE scope=? AND scope_id=? AND ssid=?",
+            self.key,
+        ).fetchone()
+        if not row:
+            return None
+        return time.time() - row[0]
+
+    def load(self) -> list:
+        """
+        Return the cached PSKs
+        """
+        cursor = self.conn.execute(
+            "SELECT id, name, passphrase, ssid, email, vlan_id FROM psks "
+            "WHERE scope=? AND scope_id=? AND ssid=?",
+            self.key,
+        )
+        return [Psk(*row) for row in cursor]
+
+    def save_all(self, psks: list):
+        """
+        Replace the cached PSKs after a full reload
+        """
+        self.conn.execute(
+            "DELETE FROM psks WHERE scope=? AND scope_id=? AND ssid=?", self.key
+        )
+        self.conn.executemany(
+            "INSERT INTO psks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [self._row(psk) for psk in psks],
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?)", (*self.key, time.time())
+        )
+        self.commit()
+        LOGGER.info(f"psk cache:{len(psks)} psks saved in {self.path}")
+
+    def add(self, psk: Psk):
+        self.conn.execute("INSERT INTO psks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._row(psk))
+
+    def remove(self, psk_id):
+        self.conn.execute(
+            "DELETE FROM psks WHERE scope=? AND scope_id=? AND ssid=? AND id=?",
+            (*self.key, psk_id),
+        )
+
+    def set_id(self, name: str, psk_id):
+        self.conn.execute(
+            "UPDATE psks SET id=? WHERE scope=? AND scope_id=? AND ssid=? AND name=? AND id IS NULL",
+            (psk_id, *self.key, name),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def _row(self, psk: Psk):
+        vlan_id = psk.vlan_id
+        return (
+            *self.key,
+            psk.id,
+            psk.name,
+            psk.passphrase,
+            psk.email,
+            str(vlan_id) if vlan_id is not None else None,
+        )
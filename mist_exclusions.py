@@ -0,0 +1,103 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script matching the names of the PSKs excluded from the synchronization
+"""
+import logging
+import re
+import fnmatch
+from mist_reconcile import normalize
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+GLOB_CHARS = ("*", "?", "[")
+# syntax which can not be used in the combined regular expression: the inline
+# global flags (only allowed at the start of the expression), the group
+# references (the group numbers change) and the named groups (the names of
+# two entries could be the same). Not preceded by an escaping backslash
+SEPARATE_SYNTAX = re.compile(
+    r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?[aiLmsux]+\)|\(\?P[<=]|\(\?\()"
+)
+
+
+class PskExclusions:
+    """
+    Class checking if a PSK name is excluded, built once when the
+    configuration is loaded. Each entry is either:
+    - an exact name, stored in a set,
+    - a glob pattern (e.g. `svc-*`),
+    - a regular expression prefixed with `re:` (e.g. `re:^printer-\\d+$`).
+    All the patterns are compiled into a single regular expression, so a
+    name is checked with one set lookup and at most one regex match. The
+    regular expressions with inline global flags, group references or
+    named groups are matched separately.
+    The names are compared case insensitively, like the LDAP users and
+    the PSKs are matched.
+    """
+
+    def __init__(self, entries: list = None):
+        self.names = set()
+        self.patterns = []
+        self.separate = []
+        for entry in entries or []:
+            entry = entry.strip()
+            if not entry or entry.startswith("#"):
+                continue
+            if entry.startswith("re:"):
+                pattern = entry[3:]
+                # checked alone first, to report the wrong entry
+                try:
+                    regex = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    raise ValueError(f"invalid exclusion {entry!r}: {e}")
+                if SEPARATE_SYNTAX.search(pattern):
+                    LOGGER.debug(f"__init__:{entry!r} matched separately")
+                    self.separate.append(regex)
+                else:
+                    self.patterns.append(pattern)
+            elif any(char in entry for char in GLOB_CHARS):
+                self.patterns.append(fnmatch.translate(normalize(entry)))
+            else:
+                self.names.add(normalize(entry))
+        self.regex = None
+        if self.patterns:
+            self.regex = re.compile(
+                "|".join(f"(?:{pattern})" for pattern in self.patterns), re.IGNORECASE
+            )
+
+    @classmethod
+    def load(cls, value: str = "", file: str = None):
+        """
+        Build the exclusions from the comma separated `value` and from the
+        `file` (one entry per line, lines starting with `#` are ignored)
+        """
+        entries = value.split(",") if value else []
+        if file:
+            with open(file, "r") as f:
+                entries += f.read().splitlines()
+        exclusions = cls(entries)
+        LOGGER.debug(f"load:{exclusions}")
+        return exclusions
+
+    def __contains__(self, name) -> bool:
+        key = normalize(name)
+        if not key:
+            return False
+        if key in self.names:
+            return True
+        if self.regex is not None and self.regex.fullmatch(key) is not None:
+            return True
+        return any(regex.fullmatch(key) for regex in self.separate)
+
+    def __len__(self):
+        return len(self.names) + len(self.patterns) + len(self.separate)
+
+    def __str__(self):
+        return f"{len(self.names)} names, {len(self.patterns) + len(self.separate)} patterns"
@@ -0,0 +1,243 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script expanding the nested LDAP groups without the AD matching rule
+"""
+import logging
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ldap3 import BASE
+from ldap3.utils.conv import escape_filter_chars
+from mist_ldap_connections import LdapConnectionPool
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class GroupExpander:
+    """
+    Class walking the group tree breadth first, as an alternative to the
+    LDAP_MATCHING_RULE_IN_CHAIN filter which is slow on large nested groups.
+    For each level, the groups are processed by `workers` threads, each one
+    with its own LDAP connection. The direct members of a group are found
+    with indexed `memberOf=<group>` paged searches, and the groups already
+    visited are skipped, so cycles are not followed.
+    The nested groups and the members of each group are cached in
+    `cache_file`, keyed by the group uSNChanged, so they are only searched
+    again when the membership of the group changed. The attributes of the
+    cached members are updated with the members changed since the previous
+    expansion (uSNChanged above the highestCommittedUSN of the DC at that
+    time). USNs are local to each DC, so the cache is only used with the DC
+    which built it.
+    """
+
+    def __init__(
+        self,
+        connect,
+        base_dn: str,
+        attributes: list,
+        workers: int = 4,
+        cache_file: str = None,
+        paged_size: int = 1000,
+        paged_search=None,
+        user_filter: str = "",
+    ):
+        self.base_dn = base_dn
+        # added to the search of the users (e.g. to exclude the disabled accounts)
+        self.user_filter = user_filter
+        self.attributes = attributes
+        self.workers = workers
+        self.cache_file = cache_file
+        self.paged_size = paged_size
+        # function used to do the paged searches, to handle the server failover
+        self.paged_search = paged_search or (
+            lambda conn, **kwargs: conn.extend.standard.paged_search(**kwargs)
+        )
+        self.cache = {}
+        # DNs (lower case) of the group and of its nested groups, filled by `expand`
+        self.groups = set()
+        self.pool = LdapConnectionPool(connect)
+        self._lock = threading.Lock()
+
+    def expand(self, group_dn: str):
+        """
+        Generator returning the users member of the group or of one of its
+        nested groups, as {"dn", "attributes"} entries. Each user is only
+        returned once.
+        """
+        self.cache = self._load_cache()
+        root_dse = self._get_root_dse(self.pool.get())
+        server = str(root_dse.get("dsServiceName", ""))
+        if self.cache.get("server") != server:
+            LOGGER.info("expand:no group cache for this domain controller")
+            self.cache = {"groups": {}}
+        # the members changed after this USN are read again at the next expansion
+        self.cache["server"] = server
+        self.cache["next_usn"] = root_dse.get("highestCommittedUSN")
+        visited = self.groups
+        visited.clear()
+        visited.add(group_dn.lower())
+        users = set()
+        level = [group_dn]
+        depth = 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while level:
+                    LOGGER.debug(f"expand:level {depth}: {len(level)} groups")
+                    next_level = []
+                    for children, entries in executor.map(self._expand_group, level):
+                        for child in children:
+                            if child.lower() in visited:
+                                LOGGER.debug(f"expand:group {child} already visited")
+                                continue
+                            visited.add(child.lower())
+                            next_level.append(child)
+                        for entry in entries:
+                            if entry["dn"].lower() not in users:
+                                users.add(entry["dn"].lower())
+                                yield entry
+                    level = next_level
+                    depth += 1
+            LOGGER.info(f"expand:{len(visited)} groups, {len(users)} users, depth {depth}")
+            # groups removed from the tree are removed from the cache
+            self.cache["groups"] = {
+                dn: data for dn, data in self.cache["groups"].items() if dn in visited
+            }
+            self.cache["usn"] = self.cache.pop("next_usn")
+            self._save_cache()
+        finally:
+            self.pool.close()
+
+    def _expand_group(self, group_dn: str):
+        conn = self.pool.get()
+        conn.search(
+            search_base=group_dn,
+            search_filter="(objectClass=*)",
+            search_scope=BASE,
+            attributes=["uSNChanged"],
+        )
+        if not conn.response or "attributes" not in conn.response[0]:
+            LOGGER.warning(f"_expand_group:group {group_dn} not found")
+            return [], []
+        usn = int(conn.response[0]["attributes"]["uSNChanged"])
+        group_filter = escape_filter_chars(group_dn)
+
+        cached = self.cache["groups"].get(group_dn.lower())
+        if cached and cached["usn"] == usn and cached.get("users") is not None and self.cache.get("usn"):
+            children = cached["groups"]
+            users = self._update_users(conn, group_filter, dict(cached["users"]))
+        else:
+            children = [
+                entry["dn"]
+                for entry in self._search(conn, f"(&(objectClass=group)(memberOf={group_filter}))", ["objectClass"])
+                if "dn" in entry
+            ]
+            users = {
+                entry["dn"]: self._serialize(entry["attributes"])
+                for entry in self._search(
+                    conn,
+                    f"(&(objectclass=person)(memberOf={group_filter}){self.user_filter})",
+                    self.attributes,
+                )
+            }
+        with self._lock:
+            self.cache["groups"][group_dn.lower()] = {
+                "usn": usn,
+                "groups": children,
+                # the members are only kept if they can be saved in the cache file
+                "users": users if self.cache_file else None,
+            }
+        entries = [{"dn": dn, "attributes": attributes} for dn, attributes in users.items()]
+        return children, entries
+
+    def _update_users(self, conn, group_filter: str, users: dict):
+        """
+        Update the cached members of the group with the members changed since
+        the previous expansion: the changed members are removed, and added
+        back if they still match the user filter (e.g. not disabled)
+        """
+        changed = f"(uSNChanged>={int(self.cache['usn']) + 1})"
+        for entry in self._search(conn, f"(&(objectclass=person)(memberOf={group_filter}){changed})", ["objectClass"]):
+            users.pop(entry["dn"], None)
+        for entry in self._search(
+            conn,
+            f"(&(objectclass=person)(memberOf={group_filter}){changed}{self.user_filter})",
+            self.attributes,
+        ):
+            users[entry["dn"]] = self._serialize(entry["attributes"])
+        return users
+
+    def _search(self, conn, search_filter: str, attributes: list):
+        return [
+            entry
+            for entry in self.paged_search(
+                conn,
+                search_base=self.base_dn,
+                search_filter=search_filter,
+                attributes=attributes,
+                paged_size=self.paged_size,
+            )
+            if "attributes" in entry and entry.get("type", "searchResEntry") == "searchResEntry"
+        ]
+
+    def _serialize(self, attributes):
+        # JSON compatible copy of the attributes, for the cache file
+        data = {}
+        for key in self.attributes:
+            if key in attributes:
+                value = attributes[key]
+                if isinstance(value, list):
+                    data[key] = [str(item) for item in value]
+                else:
+                    data[key] = str(value)
+        return data
+
+    def _get_root_dse(self, conn):
+        # without the highestCommittedUSN, the cached members are not used
+        try:
+            conn.search(
+                search_base="",
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["highestCommittedUSN", "dsServiceName"],
+            )
+            return conn.response[0]["attributes"]
+        except Exception:
+            LOGGER.warning("_get_root_dse:unable to read the rootDSE", exc_info=True)
+            return {}
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+            if "groups" not in cache:
+                LOGGER.info("_load_cache:group cache file from a previous version ignored")
+                return {}
+            return cache
+        except:
+            LOGGER.error("Unable to load the group cache file", exc_info=True)
+            return {}
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            tmp_file = f"{self.cache_file}.tmp"
+            # the file contains the names and the emails of the members
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.cache, f)
+            os.replace(tmp_file, self.cache_file)
+        except:
+            LOGGER.error("Unable to save the group cache file", exc_info=True)
@@ -0,0 +1,108 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the inventory of the Mist PSKs during a run
+"""
+import logging
+from mist_reconcile import normalize
+from mist_records import Psk
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class PskInventory:
+    """
+    Class keeping the PSKs retrieved from the Mist Cloud for the whole run.
+    The PSKs are indexed by id and by normalized name, and the inventory is
+    updated when PSKs are created or deleted, so the PSK list only has to be
+    requested once.
+    If a PskCache is provided, the changes are also saved in the cache.
+    """
+
+    def __init__(self, psks: list = None, cache=None):
+        self.by_id = {}
+        self.by_name = {}
+        self.cache = None
+        for psk in psks or []:
+            self.add(psk)
+        self.cache = cache
+
+    def __len__(self):
+        return sum(len(psks) for psks in self.by_name.values())
+
+    def add(self, psk):
+        """
+        Add a PSK to the inventory. The PSKs received from the Mist Cloud are
+        converted to Psk records, so only the fields used by the script are kept
+        """
+        if not isinstance(psk, Psk):
+            psk = Psk.from_dict(psk)
+        if psk.id:
+            self.by_id[psk.id] = psk
+        self.by_name.setdefault(psk.key, []).append(psk)
+        if self.cache:
+            self.cache.add(psk)
+        return psk
+
+    def remove(self, psk_id):
+        """
+        Remove a PSK from the inventory
+        """
+        psk = self.by_id.pop(psk_id, None)
+        if not psk:
+            return None
+        key = psk.key
+        psks = [item for item in self.by_name.get(key, []) if item is not psk]
+        if psks:
+            self.by_name[key] = psks
+        else:
+            self.by_name.pop(key, None)
+        if self.cache:
+            self.cache.remove(psk_id)
+        return psk
+
+    def replace(self, name, psks: list):
+        """
+        Replace the PSKs matching the user name with `psks`
+        """
+        for psk in self.by_name.pop(normalize(name), []):
+            if psk.id:
+                self.by_id.pop(psk.id, None)
+                if self.cache:
+                    self.cache.remove(psk.id)
+        for psk in psks:
+            self.add(psk)
+
+    def commit(self):
+        """
+        Save the changes in the cache
+        """
+        if self.cache:
+            self.cache.commit()
+
+    def close(self):
+        """
+        Save the changes and close the cache
+        """
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+
+    def get(self, name) -> list:
+        """
+        Return the PSKs matching the user name
+        """
+        return self.by_name.get(normalize(name), [])
+
+    def psks(self) -> list:
+        """
+        Return all the PSKs
+        """
+        return [psk for psks in self.by_name.values() for psk in psks]
@@ -0,0 +1,163 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script recording the progress of a synchronization, so it can be resumed
+"""
+import logging
+import os
+import json
+import time
+import threading
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class RunJournal:
+    """
+    Class recording the progress of a synchronization in a JSON Lines file.
+    Each step is appended to the file as soon as it is done:
+    - "plan": the PSKs to create and to delete for a target,
+    - "created": the PSKs created by an import batch, with their passphrase
+      so the emails can be sent without listing the PSKs again,
+    - "deleted": the ids of the PSKs deleted,
+    - "email": the users to whom the PSK email was sent.
+    The file is removed when the run is completed. With `resume`, the
+    entries of the interrupted run are loaded, and the targets with a plan
+    continue from it instead of searching LDAP and listing the PSKs again.
+    Without `path`, nothing is recorded.
+    """
+
+    def __init__(self, path: str = None, resume: bool = False):
+        self.path = path
+        self.targets = {}
+        self._file = None
+        self._lock = threading.Lock()
+        if not path:
+            return
+        if resume:
+            self._load()
+        if self.targets:
+            LOGGER.info(f"journal:resuming the run of {len(self.targets)} targets from {path}")
+            mode = os.O_APPEND
+        else:
+            mode = os.O_TRUNC
+        # the file contains the passphrases of the new PSKs
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | mode, 0o600)
+        # the mode of os.open only applies to a new file
+        os.fchmod(fd, 0o600)
+        self._file = os.fdopen(fd, "a")
+        if self.targets:
+            # the last entry may be incomplete if the process was killed
+            self._file.write("\n")
+        else:
+            self._write({"type": "start", "time": time.time()})
+
+    def get(self, target: str):
+        """
+        Return the recorded state of the target, or None if the target has
+        no plan to resume
+        """
+        return self.targets.get(target)
+
+    def all_planned(self, targets: list) -> bool:
+        return bool(self.targets) and all(target in self.targets for target in targets)
+
+    def plan(self, target: str, to_create: list, to_delete: list):
+        self._write(
+            {
+                "type": "plan",
+                "target": target,
+                "create": [[user.name, user.email] for user in to_create],
+                "delete": [[psk.id, psk.name] for psk in to_delete],
+            },
+            sync=True,
+        )
+
+    def created(self, target: str, psks: list):
+        if not psks:
+            return
+        self._write(
+            {
+                "type": "created",
+                "target": target,
+                "psks": [
+                    [psk["name"], psk["passphrase"], psk["ssid"], psk.get("vlan_id")]
+                    for psk in psks
+                ],
+            },
+            sync=True,
+        )
+
+    def deleted(self, target: str, psk_ids: list):
+        if psk_ids:
+            self._write({"type": "deleted", "target": target, "ids": list(psk_ids)}, sync=True)
+
+    def email_sent(self, target: str, name: str):
+        self._write({"type": "email", "target": target, "name": name})
+
+    def close(self, completed: bool):
+        """
+        Close the journal. When the run is completed, the file is removed
+        """
+        if not self._file:
+            return
+        with self._lock:
+            self._file.close()
+            self._file = None
+        if completed:
+            os.remove(self.path)
+            LOGGER.info("journal:run completed, journal removed")
+        else:
+            LOGGER.warning(f"journal:run not completed. Use --resume to continue it from {self.path}")
+
+    def _write(self, entry: dict, sync: bool = False):
+        if not self._file:
+            return
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            # flushed for each entry, so it is kept if the process is killed. The
+            # batch entries are also synced, so they are kept if the host crashes
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            LOGGER.info("journal:no interrupted run to resume")
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line partially written when the process was killed
+                    LOGGER.warning("journal:ignoring an incomplete entry")
+                    continue
+                if entry["type"] == "plan":
+                    self.targets[entry["target"]] = {
+                        "create": entry["create"],
+                        "delete": entry["delete"],
+                        "created": {},
+                        "deleted": set(),
+                        "emails": set(),
+                    }
+                    continue
+                state = self.targets.get(entry.get("target"))
+                if state is None:
+                    continue
+                if entry["type"] == "created":
+                    for name, passphrase, ssid, vlan_id in entry["psks"]:
+                        state["created"][name] = (passphrase, ssid, vlan_id)
+                elif entry["type"] == "deleted":
+                    state["deleted"].update(entry["ids"])
+                elif entry["type"] == "email":
+                    state["emails"].add(entry["name"])
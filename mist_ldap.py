@@ -12,7 +12,19 @@ Script managing the communication with the LDAP/LDAPS server
 
 import logging
 import sys
-from ldap3 import Server, Connection
+import os
+import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ldap3 import Server, Connection, BASE, LEVEL, SUBTREE, ASYNC_STREAM
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
+from mist_groups import GroupExpander
+from mist_ldap_connections import LdapConnectionPool
+from mist_metrics import METRICS
+from mist_records import LdapUser
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -23,6 +35,10 @@ class MistLdap:
     Class managing the requests to the LDAP/LDAPS server
     """
 
+    # AD filter excluding the disabled accounts (ACCOUNTDISABLE flag of
+    # userAccountControl), so the synchronization and the watch agree
+    ENABLED_USERS = "(!(userAccountControl:1.2.840.113556.1.4.803:=2))"
+
     def __init__(self, config):
         self.host = config.get("host")
         self.port = config.get("port")
@@ -35,24 +51,83 @@ class MistLdap:
         self.base_dn = config.get("base_dn")
         self.search_group = config.get("search_group")
         self.recursive_search = config.get("recursive_search")
+        self.recursive_engine = config.get("recursive_engine", "matching_rule")
+        self.expand_workers = config.get("expand_workers", 4)
+        self.group_cache_file = config.get("group_cache_file")
         self.user_name = config.get("user_name")
         self.user_email = config.get("user_email")
-        self.server = Server(
-            self.host, port=self.port, use_ssl=self.use_ssl, tls=self.tls
-        )
+        self.incremental = config.get("incremental", False)
+        self.state_file = config.get("state_file")
+        self.full_sync_interval = config.get("full_sync_interval", 86400)
+        self.watch_retry = config.get("watch_retry", 30)
+        self.partitions = config.get("partitions", [])
+        self.search_workers = config.get("search_workers", 4)
+        self.page_size = config.get("page_size", 1000)
+        self.connect_timeout = config.get("connect_timeout", 5)
+        self.health_check_interval = config.get("health_check_interval", 300)
+        self.conn = None
+        # DNs (lower case) of the search group and of its nested groups, when
+        # known. Used by `watch` to only check the members when one of them changed
+        self.nested_groups = None
+        # connections of the GroupExpander threads, evicted when a server fails
+        self._pool = None
+        # LDAP_HOST may contain several servers, separated by ","
+        self.servers = [
+            Server(
+                host.strip(),
+                port=self.port,
+                use_ssl=self.use_ssl,
+                tls=self.tls,
+                connect_timeout=self.connect_timeout,
+            )
+            for host in str(self.host).split(",")
+            if host.strip()
+        ]
+        self.server = self.servers[0]
+        self._latencies = {}
+        self._health_check_time = 0
+        self._servers_lock = threading.Lock()
 
     def get_users(self, ad_user_list: list = None):
         """
         Function to retrieve the list of users.
         It will connect to the server, then do the search
         """
-        conn = self._connect()
-        entries = self._search(conn)
-        ad_user_list = self._process(entries, ad_user_list)
-        LOGGER.info(f"processing ldap data finished. got {len(ad_user_list)} users")
+        if not ad_user_list:
+            ad_user_list = []
+        ad_user_list.extend(self.iter_users())
         return ad_user_list
 
+    def iter_users(self):
+        """
+        Generator returning the users while the LDAP pages are received.
+        Only the current page is kept in memory, so this should be used
+        instead of `get_users` when the users are directly indexed.
+        """
+        with METRICS.phase("ldap_connect"):
+            conn = self._connect()
+        if self.incremental:
+            entries = self._incremental_search(conn)
+        else:
+            entries = self._search(conn)
+        entries = METRICS.iterate("ldap_search", entries)
+        count = 0
+        for user in METRICS.iterate("ldap_process", self._process(entries)):
+            count += 1
+            yield user
+        LOGGER.info(f"processing ldap data finished. got {count} users")
+
     def _connect(self):
+        if self.conn is not None:
+            # connection kept from a previous run (daemon mode)
+            if self._check_connection():
+                LOGGER.info("Reusing the LDAP connection")
+                return self.conn
+            try:
+                self.conn.unbind()
+            except:
+                pass
+            self.conn = None
         print(
             f"Contacting LDAP server on {self.host}:{self.port} "
             "(SSL: {self.use_ssl}) ".ljust(79, "."),
@@ -63,77 +138,680 @@ class MistLdap:
             f"Contacting LDAP server on {self.host}:{self.port} (SSL: {self.use_ssl})"
         )
         try:
-            conn = Connection(
-                self.server,
-                self.bind_user,
-                self.bind_password,
-                auto_bind=True,
-                read_only=True,
-                auto_range=True,
-            )
+            conn = self._bind()
             print("\033[92m\u2714\033[0m")
-            LOGGER.info("Connected")
+            LOGGER.info(f"Connected to {conn.server.host}")
+            self.conn = conn
             return conn
         except:
             print("\033[31m\u2716\033[0m")
             LOGGER.critical("Exception occurred", exc_info=True)
             sys.exit(1)
 
+    def _bind(self, exclude: Server = None, **options):
+        """
+        Return a connection bound to the fastest healthy server. If the
+        server can not be reached, the next one is used
+        """
+        options.setdefault("auto_range", True)
+        servers = [server for server in self._get_servers() if server is not exclude]
+        if not servers:
+            raise LDAPCommunicationError(f"no other LDAP server than {exclude.host} to connect to")
+        for server in servers:
+            try:
+                return Connection(
+                    server,
+                    self.bind_user,
+                    self.bind_password,
+                    auto_bind=True,
+                    read_only=True,
+                    **options,
+                )
+            except:
+                LOGGER.warning(f"_bind:unable to connect to {server.host}", exc_info=True)
+                self._mark_failed(server)
+                if server is servers[-1]:
+                    raise
+
+    def _get_servers(self):
+        """
+        Return the servers, the fastest healthy one first. The servers are
+        checked again every `health_check_interval` seconds
+        """
+        if len(self.servers) == 1:
+            return self.servers
+        with self._servers_lock:
+            if time.time() - self._health_check_time > self.health_check_interval:
+                with ThreadPoolExecutor(max_workers=len(self.servers)) as executor:
+                    latencies = list(executor.map(self._check_server, self.servers))
+                self._latencies = dict(zip(self.servers, latencies))
+                self._health_check_time = time.time()
+                LOGGER.info(
+                    "_get_servers:"
+                    + ", ".join(
+                        f"{server.host}: {'down' if latency is None else f'{latency * 1000:.0f}ms'}"
+                        for server, latency in self._latencies.items()
+                    )
+                )
+            return sorted(
+                self.servers,
+                key=lambda server: (self._latencies.get(server) is None, self._latencies.get(server) or 0),
+            )
+
+    def _check_server(self, server: Server):
+        # anonymous read of the rootDSE
+        start = time.monotonic()
+        try:
+            conn = Connection(server, auto_bind=True, receive_timeout=self.connect_timeout)
+            conn.search(
+                search_base="",
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["currentTime"],
+            )
+            conn.unbind()
+            return time.monotonic() - start
+        except:
+            LOGGER.warning(f"_check_server:{server.host} is not reachable")
+            return None
+
+    def _mark_failed(self, server: Server):
+        with self._servers_lock:
+            self._latencies[server] = None
+        if self._pool:
+            self._pool.evict(server)
+
+    def _paged_search(self, conn: Connection, failover: bool = True, **kwargs):
+        """
+        Paged search restarted on the next server if the server fails during
+        the search. The paging cookie is only valid on the server which
+        created it, so the search starts over and the entries returned
+        before the failover are returned again. They are not tracked here,
+        to keep the search streamed: the callers index the entries by DN or
+        by user name, so the duplicates are ignored.
+        With `failover` disabled, the LDAPCommunicationError is raised to the
+        caller instead (for the searches which only make sense on one server)
+        """
+        kwargs.setdefault("paged_size", self.page_size)
+        if not failover:
+            yield from conn.extend.standard.paged_search(**kwargs)
+            # busy / unavailable
+            if conn.result and conn.result.get("result") in [51, 52]:
+                raise LDAPCommunicationError(conn.result.get("description"))
+            return
+        if len(self.servers) == 1:
+            yield from conn.extend.standard.paged_search(**kwargs)
+            return
+        count = 0
+        failover_conn = None
+        attempts = 0
+        try:
+            while True:
+                try:
+                    for entry in conn.extend.standard.paged_search(**kwargs):
+                        count += 1
+                        yield entry
+                    # busy / unavailable
+                    if conn.result and conn.result.get("result") in [51, 52]:
+                        raise LDAPCommunicationError(conn.result.get("description"))
+                    return
+                except LDAPCommunicationError:
+                    attempts += 1
+                    if attempts >= len(self.servers):
+                        raise
+                    LOGGER.warning(
+                        f"_paged_search:{conn.server.host} failed after {count} entries. "
+                        "Restarting the search on the next server",
+                        exc_info=True,
+                    )
+                    failed = conn.server
+                    self._mark_failed(failed)
+                    if failover_conn:
+                        failover_conn.unbind()
+                    conn = failover_conn = self._bind(exclude=failed)
+        finally:
+            if failover_conn:
+                try:
+                    failover_conn.unbind()
+                except:
+                    pass
+
+    def _check_connection(self):
+        try:
+            if self.conn.closed or not self.conn.bound:
+                return False
+            return self.conn.search(
+                search_base="",
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["currentTime"],
+            )
+        except:
+            LOGGER.warning("LDAP connection check failed", exc_info=True)
+            return False
+
     def _search(self, conn: Connection):
         print("Executing LDAP search ".ljust(79, "."), end="", flush=True)
         LOGGER.info("Executing LDAP search")
-        entries = []
+        count = 0
 
         try:
-            if self.recursive_search:
-                entry_generator = conn.extend.standard.paged_search(
-                    search_base=self.base_dn,
-                    search_filter=f"(&(objectclass=person)(memberOf:1.2.840.113556.1.4.1941:={self.search_group}))",
-                    attributes=[self.user_name, self.user_email, "objectClass"],
-                    paged_size=1000,
+            if self.recursive_search and self.recursive_engine == "expand":
+                expander = GroupExpander(
+                    self._bind,
+                    self.base_dn,
+                    self._user_attributes(),
+                    workers=self.expand_workers,
+                    cache_file=self.group_cache_file,
+                    paged_size=self.page_size,
+                    paged_search=self._paged_search,
+                    user_filter=self.ENABLED_USERS,
                 )
+                self.nested_groups = expander.groups
+                self._pool = expander.pool
+                entry_generator = expander.expand(self.search_group)
             else:
-                entry_generator = conn.extend.standard.paged_search(
-                    search_base=self.base_dn,
-                    search_filter=f"(&(objectclass=person)(memberOf={self.search_group}))",
-                    attributes=[self.user_name, self.user_email, "objectClass"],
-                    paged_size=1000,
-                )
+                if self.recursive_search:
+                    search_filter = f"(&(objectclass=person)(memberOf:1.2.840.113556.1.4.1941:={self.search_group}){self.ENABLED_USERS})"
+                else:
+                    search_filter = f"(&(objectclass=person)(memberOf={self.search_group}){self.ENABLED_USERS})"
+                attributes = self._user_attributes()
+                if self.partitions:
+                    entry_generator = self._partitioned_search(conn, search_filter, attributes)
+                else:
+                    entry_generator = self._paged_search(
+                        conn,
+                        search_base=self.base_dn,
+                        search_filter=search_filter,
+                        attributes=attributes,
+                    )
 
             for entry in entry_generator:
                 if "attributes" in entry:
-                    entries.append(
-                        {"dn": entry["dn"], "attributes": entry["attributes"]}
-                    )
+                    count += 1
+                    yield {"dn": entry["dn"], "attributes": entry["attributes"]}
             print("\033[92m\u2714\033[0m")
-            LOGGER.info(f"Done: {len(entries)} entries")
-            return entries
+            LOGGER.info(f"Done: {count} entries")
+        # not a bare except: the GeneratorExit raised at the yield when the
+        # consumer stops iterating must not be caught
+        except Exception:
+            print("\033[31m\u2716\033[0m")
+            LOGGER.critical("Exception occurred", exc_info=True)
+            sys.exit(1)
+
+    def _get_partitions(self, conn: Connection):
+        """
+        Return the (search_base, search_scope) of each partition. With
+        "auto", the base DN is split into its first level OUs/containers,
+        plus a one level search for the objects directly under the base DN
+        """
+        if self.partitions != ["auto"]:
+            return [(partition, SUBTREE) for partition in self.partitions]
+        conn.search(
+            search_base=self.base_dn,
+            search_filter="(|(objectClass=organizationalUnit)(objectClass=container))",
+            search_scope=LEVEL,
+            attributes=["objectClass"],
+        )
+        partitions = [(self.base_dn, LEVEL)]
+        for entry in conn.response:
+            if entry.get("type") == "searchResEntry":
+                partitions.append((entry["dn"], SUBTREE))
+        return partitions
+
+    def _partitioned_search(self, conn: Connection, search_filter: str, attributes: list):
+        """
+        Search the partitions at the same time, with `search_workers`
+        threads having their own LDAP connection. The entries are returned
+        while they are received, and only once if the partitions overlap.
+        """
+        partitions = self._get_partitions(conn)
+        LOGGER.debug(f"_partitioned_search:{len(partitions)} partitions")
+        pool = LdapConnectionPool(self._bind)
+        entries = queue.Queue(maxsize=self.page_size * self.search_workers)
+        stop = threading.Event()
+
+        def search(partition):
+            search_base, search_scope = partition
+            try:
+                entry_generator = self._paged_search(
+                    pool.get(),
+                    search_base=search_base,
+                    search_filter=search_filter,
+                    search_scope=search_scope,
+                    attributes=attributes,
+                )
+                for entry in entry_generator:
+                    if stop.is_set():
+                        return
+                    if "attributes" in entry:
+                        entries.put({"dn": entry["dn"], "attributes": entry["attributes"]})
+            except Exception as e:
+                entries.put(e)
+            finally:
+                entries.put(None)
+
+        executor = ThreadPoolExecutor(max_workers=self.search_workers)
+        futures = [executor.submit(search, partition) for partition in partitions]
+        try:
+            seen = set()
+            done = 0
+            while done < len(futures):
+                entry = entries.get()
+                if entry is None:
+                    done += 1
+                elif isinstance(entry, Exception):
+                    raise entry
+                elif entry["dn"].lower() not in seen:
+                    seen.add(entry["dn"].lower())
+                    yield entry
+        finally:
+            # unblock the workers if the search is interrupted
+            stop.set()
+            while not all(future.done() for future in futures):
+                try:
+                    entries.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            executor.shutdown()
+            pool.close()
+
+    def _incremental_search(self, conn: Connection):
+        """
+        Only request the LDAP objects changed since the previous run (based on
+        the AD uSNChanged attribute) and merge them into the membership
+        snapshot saved in the state file.
+        USNs are local to each domain controller, so a full search is done
+        if the DC changed, if the configuration changed, or if the last full
+        search is older than `full_sync_interval` seconds.
+        """
+        state = self._load_state()
+        try:
+            root_dse = self._get_root_dse(conn)
+        except:
+            LOGGER.error("Unable to read the rootDSE", exc_info=True)
+            yield from self._search(conn)
+            return
+        highest_usn = int(root_dse["highestCommittedUSN"])
+        server_name = str(root_dse.get("dsServiceName", self.host))
+
+        reason = None
+        if self.recursive_search:
+            reason = "recursive search enabled"
+        elif not state:
+            reason = "no previous state"
+        elif state.get("server") != server_name:
+            reason = f"domain controller changed ({state.get('server')})"
+        elif state.get("config") != self._state_config():
+            reason = "configuration changed"
+        elif time.time() - state.get("full_sync_time", 0) > self.full_sync_interval:
+            reason = "full sync interval reached"
+
+        if reason:
+            LOGGER.info(f"_incremental_search:full search required: {reason}")
+            snapshot = {}
+            for entry in self._search(conn):
+                snapshot[entry["dn"]] = self._serialize(entry["attributes"])
+                yield entry
+            self._save_state({
+                "server": server_name,
+                "config": self._state_config(),
+                "usn": highest_usn,
+                "full_sync_time": time.time(),
+                "entries": snapshot,
+            })
+            return
+
+        print(
+            f"Executing LDAP incremental search (USN > {state['usn']}) "
+            .ljust(79, "."), end="", flush=True
+        )
+        LOGGER.info(f"Executing LDAP incremental search from USN {state['usn']}")
+        try:
+            snapshot = state["entries"]
+            changes = self._merge_group_changes(conn, snapshot, state["usn"])
+            changes += self._merge_user_changes(conn, snapshot, state["usn"])
+            state["usn"] = highest_usn
+            self._save_state(state)
+            print("\033[92m\u2714\033[0m")
+            LOGGER.info(f"Done: {changes} changes, {len(snapshot)} entries")
+        except LDAPCommunicationError:
+            if len(self.servers) == 1:
+                print("\033[31m\u2716\033[0m")
+                LOGGER.critical("Exception occurred", exc_info=True)
+                sys.exit(1)
+            # the USNs of this DC are meaningless on the other ones, so the
+            # changes can not be requested from the next server: the search
+            # is restarted on it and a full search is done (DC changed)
+            print("\033[31m\u2716\033[0m")
+            LOGGER.warning(
+                f"_incremental_search:{conn.server.host} failed. "
+                "Restarting the search on the next server",
+                exc_info=True,
+            )
+            failed = conn.server
+            self._mark_failed(failed)
+            try:
+                conn.unbind()
+            except:
+                pass
+            self.conn = conn = self._bind(exclude=failed)
+            yield from self._incremental_search(conn)
+            return
         except:
             print("\033[31m\u2716\033[0m")
             LOGGER.critical("Exception occurred", exc_info=True)
             sys.exit(1)
+        for dn, attributes in snapshot.items():
+            yield {"dn": dn, "attributes": attributes}
 
-    def _process(self, entries: list, ad_user_list: list):
-        if not ad_user_list:
-            ad_user_list = []
-        print("Processing LDAP accounts ".ljust(79, "."), end="", flush=True)
+    def _get_root_dse(self, conn: Connection):
+        conn.search(
+            search_base="",
+            search_filter="(objectClass=*)",
+            search_scope=BASE,
+            attributes=["highestCommittedUSN", "dsServiceName"],
+        )
+        return conn.response[0]["attributes"]
+
+    def _merge_group_changes(self, conn: Connection, snapshot: dict, usn: int):
+        # adding/removing a member only changes the uSNChanged of the group,
+        # not the one of the user
+        conn.search(
+            search_base=self.search_group,
+            search_filter="(objectClass=*)",
+            search_scope=BASE,
+            attributes=["uSNChanged", "member"],
+        )
+        attributes = conn.response[0]["attributes"]
+        if int(attributes["uSNChanged"]) <= usn:
+            return 0
+        members = set(attributes.get("member", []))
+        changes = 0
+        for dn in list(snapshot):
+            if dn not in members:
+                LOGGER.debug(f"_merge_group_changes:{dn} removed from the group")
+                del snapshot[dn]
+                changes += 1
+        for dn in members:
+            if dn not in snapshot and dn.lower().endswith(self.base_dn.lower()):
+                conn.search(
+                    search_base=dn,
+                    search_filter="(objectclass=person)",
+                    search_scope=BASE,
+                    attributes=self._user_attributes(),
+                )
+                for entry in conn.response:
+                    if "attributes" in entry and not self._is_disabled(entry["attributes"]):
+                        LOGGER.debug(f"_merge_group_changes:{dn} added to the group")
+                        snapshot[entry["dn"]] = self._serialize(entry["attributes"])
+                        changes += 1
+        return changes
+
+    def _merge_user_changes(self, conn: Connection, snapshot: dict, usn: int):
+        entry_generator = self._paged_search(
+            conn,
+            # USNs are local to the DC: no restart on another one
+            failover=False,
+            search_base=self.base_dn,
+            search_filter=(
+                f"(&(objectclass=person)"
+                f"(memberOf={escape_filter_chars(self.search_group)})"
+                f"(uSNChanged>={usn + 1}))"
+            ),
+            # the disabled accounts are not filtered, so they are removed
+            attributes=self._user_attributes(),
+        )
+        changes = 0
+        for entry in entry_generator:
+            if "attributes" not in entry:
+                continue
+            if self._is_disabled(entry["attributes"]):
+                if snapshot.pop(entry["dn"], None) is not None:
+                    LOGGER.debug(f"_merge_user_changes:{entry['dn']} disabled")
+                    changes += 1
+                continue
+            LOGGER.debug(f"_merge_user_changes:{entry['dn']} updated")
+            snapshot[entry["dn"]] = self._serialize(entry["attributes"])
+            changes += 1
+        return changes
+
+    def _state_config(self):
+        return {
+            "base_dn": self.base_dn,
+            "search_group": self.search_group,
+            "user_name": self.user_name,
+            "user_email": self.user_email,
+        }
+
+    def _serialize(self, attributes):
+        data = {}
+        for key in [self.user_name, self.user_email, "objectClass"]:
+            if key in attributes:
+                value = attributes[key]
+                if isinstance(value, list):
+                    data[key] = [str(item) for item in value]
+                else:
+                    data[key] = str(value)
+        return data
+
+    def _load_state(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return None
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except:
+            LOGGER.error("Unable to load the LDAP state file", exc_info=True)
+            return None
+
+    def _save_state(self, state: dict):
+        if not self.state_file:
+            return
+        try:
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except:
+            LOGGER.error("Unable to save the LDAP state file", exc_info=True)
+
+    def watch(self, on_remove):
+        """
+        Subscribe to the directory changes with the AD change notification
+        control and call `on_remove(user)` as soon as a user is removed from
+        the search group or is disabled.
+        Only the changed objects are read: the group membership is checked
+        when the group changes (or when the subscription is restarted after
+        a connection loss) and the account is checked when the user changes.
+        """
+        conn = self._connect()
+        members = {}
+        # members of the search group with a disabled account, added back
+        # to `members` when the account is enabled again
+        disabled = set()
+        for entry in self._search(conn):
+            name = self._get_name(entry["attributes"])
+            if name:
+                members[entry["dn"].lower()] = name
+        LOGGER.info(f"watch:{len(members)} members in the search group")
+        while True:
+            watch_conn = None
+            try:
+                watch_conn = self._bind(client_strategy=ASYNC_STREAM)
+                search = watch_conn.extend.microsoft.persistent_search(
+                    search_base=self.base_dn,
+                    search_scope=SUBTREE,
+                    attributes=["member", "userAccountControl", "objectClass"],
+                    streaming=False,
+                )
+                print(f"Watching the LDAP changes on {watch_conn.server.host} ".ljust(79, "."), end="", flush=True)
+                print("\033[92m\u2714\033[0m")
+                LOGGER.info(f"watch:subscribed to the changes of {self.base_dn}")
+                # changes done while the subscription was down
+                self._check_members(members, on_remove, disabled)
+                while True:
+                    event = search.next(block=True, timeout=self.watch_retry)
+                    if event is None:
+                        if watch_conn.closed:
+                            break
+                        continue
+                    if event.get("type") != "searchResEntry":
+                        break
+                    self._process_event(event, members, on_remove, disabled)
+                LOGGER.warning("watch:subscription ended")
+            except:
+                LOGGER.error("Exception occurred", exc_info=True)
+            finally:
+                if watch_conn:
+                    try:
+                        watch_conn.unbind()
+                    except:
+                        pass
+            print(
+                f"LDAP subscription lost. Retrying in {self.watch_retry}s "
+                .ljust(79, "."), end="", flush=True
+            )
+            print("\033[31m\u2716\033[0m")
+            time.sleep(self.watch_retry)
+
+    def _process_event(self, event: dict, members: dict, on_remove, disabled: set):
+        dn = event["dn"].lower()
+        attributes = event.get("attributes", {})
+        LOGGER.debug(f"_process_event:{event['dn']} changed")
+        if dn == self.search_group.lower() or (
+            self.recursive_search
+            and "group" in attributes.get("objectClass", [])
+            # the changes of the groups outside of the search group tree are ignored
+            and (self.nested_groups is None or dn in self.nested_groups)
+        ):
+            self._check_members(members, on_remove, disabled)
+        elif attributes.get("userAccountControl") is None:
+            return
+        elif dn in members and self._is_disabled(attributes):
+            LOGGER.info(f"_process_event:{event['dn']} disabled")
+            disabled.add(dn)
+            on_remove(LdapUser(members.pop(dn)))
+        elif dn in disabled and not self._is_disabled(attributes):
+            name = self._get_name(self._get_member(self._connect(), dn) or {})
+            if name:
+                LOGGER.info(f"_process_event:{event['dn']} enabled again")
+                disabled.discard(dn)
+                members[dn] = name
+
+    def _check_members(self, members: dict, on_remove, disabled: set):
+        """
+        Compare the current members of the search group with the known ones,
+        call `on_remove` for the removed users and add the new ones (or keep
+        them in `disabled` if their account is disabled)
+        """
+        conn = self._connect()
+        current = {}
+        if self.recursive_search:
+            # the nested memberships are only known by the recursive search
+            for entry in self._search(conn):
+                current[entry["dn"].lower()] = self._get_name(entry["attributes"])
+            if self.recursive_engine != "expand":
+                self.nested_groups = self._get_nested_groups(conn)
+        else:
+            conn.search(
+                search_base=self.search_group,
+                search_filter="(objectClass=*)",
+                search_scope=BASE,
+                attributes=["member"],
+            )
+            for dn in conn.response[0]["attributes"].get("member", []):
+                current[dn.lower()] = members.get(dn.lower())
+        for dn in list(members):
+            if dn not in current:
+                LOGGER.info(f"_check_members:{dn} removed from the group")
+                on_remove(LdapUser(members.pop(dn)))
+        if not self.recursive_search:
+            # the recursive search does not return the disabled members
+            disabled.intersection_update(current)
+        for dn, name in current.items():
+            if dn in members:
+                continue
+            if name is None and not self.recursive_search:
+                attributes = self._get_member(conn, dn) or {}
+                name = self._get_name(attributes)
+                if self._is_disabled(attributes):
+                    disabled.add(dn)
+            if name:
+                LOGGER.info(f"_check_members:{dn} added to the group")
+                disabled.discard(dn)
+                members[dn] = name
+
+    def _get_nested_groups(self, conn: Connection):
+        """
+        Return the DNs (lower case) of the search group and of its nested
+        groups, or None if they can not be found
+        """
+        try:
+            groups = {self.search_group.lower()}
+            for entry in self._paged_search(
+                conn,
+                search_base=self.base_dn,
+                search_filter=(
+                    "(&(objectClass=group)"
+                    f"(memberOf:1.2.840.113556.1.4.1941:={escape_filter_chars(self.search_group)}))"
+                ),
+                attributes=["objectClass"],
+            ):
+                if "dn" in entry and entry.get("type") == "searchResEntry":
+                    groups.add(entry["dn"].lower())
+            return groups
+        except Exception:
+            LOGGER.warning("_get_nested_groups:unable to get the nested groups", exc_info=True)
+            return None
+
+    def _get_member(self, conn: Connection, dn: str):
+        """
+        Return the attributes of the user `dn`, or None if it is not a user
+        """
+        conn.search(
+            search_base=dn,
+            search_filter="(objectclass=person)",
+            search_scope=BASE,
+            attributes=[self.user_name, "objectClass", "userAccountControl"],
+        )
+        for entry in conn.response:
+            if "attributes" in entry:
+                return entry["attributes"]
+        return None
+
+    def _user_attributes(self):
+        return [self.user_name, self.user_email, "objectClass", "userAccountControl"]
+
+    def _is_disabled(self, attributes):
+        # ACCOUNTDISABLE flag
+        return bool(int(attributes.get("userAccountControl") or 0) & 0x2)
+
+    def _get_name(self, attributes):
+        if "computer" in attributes.get("objectClass", []) or not attributes.get(self.user_name):
+            return None
+        if self._is_disabled(attributes):
+            return None
+        return str(attributes[self.user_name])
+
+    def _process(self, entries):
         try:
             for entry in entries:
                 LOGGER.debug(f"_process:{entry}")
                 if (
                     not "computer" in entry["attributes"].get("objectClass")
                     and self.user_name in entry["attributes"]
+                    and not self._is_disabled(entry["attributes"])
                 ):
-                    user = {"name": str(entry["attributes"][self.user_name])}
                     if self.user_email in entry["attributes"]:
-                        user["email"] = str(entry["attributes"][self.user_email])
+                        email = str(entry["attributes"][self.user_email])
                     else:
-                        user["email"] = ""
+                        email = ""
+                    user = LdapUser(str(entry["attributes"][self.user_name]), email)
                     LOGGER.debug(f"_process:user from LDAP: {user}")
-                    ad_user_list.append(user)
-            print("\033[92m\u2714\033[0m")
-            return ad_user_list
-        except:
+                    yield user
+        # see _search: the GeneratorExit must not be caught
+        except Exception:
             print("\033[31m\u2716\033[0m")
             LOGGER.critical("Exception occurred", exc_info=True)
             sys.exit(1)
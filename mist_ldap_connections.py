@@ -0,0 +1,77 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the LDAP connections used by the worker threads
+"""
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class LdapConnectionPool:
+    """
+    Class giving a bound LDAP connection to each worker thread. ldap3
+    synchronous connections can not be shared between threads, so each
+    thread gets its own connection, created with `connect` on first use.
+    The connections to a failed server are evicted, so the threads connect
+    again (to the next server) instead of reusing a dead connection.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self._lock = threading.Lock()
+        # connection of each thread, by thread id
+        self._connections = {}
+
+    def get(self):
+        """
+        Return the connection of the current thread
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            conn = self._connections.get(thread_id)
+        if conn is None:
+            conn = self.connect()
+            with self._lock:
+                self._connections[thread_id] = conn
+                count = len(self._connections)
+            LOGGER.debug(f"get:{count} LDAP connections opened")
+        return conn
+
+    def evict(self, server):
+        """
+        Remove and unbind the connections to `server`
+        """
+        with self._lock:
+            evicted = [
+                thread_id for thread_id, conn in self._connections.items()
+                if conn.server is server
+            ]
+            connections = [self._connections.pop(thread_id) for thread_id in evicted]
+        if connections:
+            LOGGER.debug(f"evict:{len(connections)} LDAP connections to {server.host} evicted")
+        self._unbind(connections)
+
+    def close(self):
+        """
+        Unbind all the connections
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections = {}
+        self._unbind(connections)
+
+    def _unbind(self, connections):
+        for conn in connections:
+            try:
+                conn.unbind()
+            except:
+                pass
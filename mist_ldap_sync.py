@@ -21,7 +21,8 @@ Usage:
 -r, --resend-emails Resend PSK emails to users. This option disable to PSK
                     creation and deletion (will just generate and send the 
                     emails)
-                    This option DOES NOT work with Mist Emails
+                    This option DOES NOT work with Mist Emails, and can not be
+                    used with -D/--daemon
 -f, --file=         if -r/--resend-emails, location of a CSV file with the list
                     of emails to whom the psk should be resend
 
@@ -35,6 +36,21 @@ Usage:
 
 -l, --log-file      Location of the log files
 
+-D, --daemon        Run as a service: keep the LDAP connection and the Mist
+                    session open and run the synchronization every
+                    DAEMON_INTERVAL seconds (or on the DAEMON_SCHEDULE cron
+                    schedule). Runs never overlap
+
+-w, --watch         Subscribe to the LDAP changes (AD change notification) and
+                    delete the PSKs of a user as soon as the user is removed
+                    from LDAP_SEARCH_GROUP or is disabled. Can be used with
+                    -D/--daemon to also run the scheduled synchronizations
+
+-R, --resume        Continue the run interrupted before its end from the
+                    JOURNAL_FILE, without searching LDAP and listing the PSKs
+                    again. The PSKs already created/deleted and the emails
+                    already sent are skipped
+
 ---
 Configuration file example:
 LDAP_HOST="dc.myserver.com"
@@ -79,10 +95,21 @@ import sys
 import logging
 import getopt
 import csv
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from mist_smtp import MistSmtp
 from mist_ldap import MistLdap
 from mist_psk import Mist
+from mist_async import AsyncEngine, AsyncMist, AsyncMistSmtp, is_available as async_available
+from mist_reconcile import MistReconcile, normalize
+from mist_records import LdapUser, Psk, UserReport, DeleteReport
+from mist_journal import RunJournal
+from mist_exclusions import PskExclusions
+from mist_scheduler import Scheduler
+from mist_metrics import METRICS
+from mist_output import TargetOutput
 
 LOGGER = logging.getLogger(__name__)
 LOG_FILE = "./mist_ldap_sync.log"
@@ -105,11 +132,19 @@ def _load_smtp(verbose, template:str):
         "logo_url": os.environ.get("SMTP_LOGO_URL", default="https://cdn.mist.com/wp-content/uploads/logo.png"),
         "email_psk_to_users": eval(os.environ.get("SMTP_EMAIL_PSK_TO_USERS", default="True")),
         "enable_qrcode": eval(os.environ.get("SMTP_ENABLE_QRCODE", default="True")),
+        "qrcode_format": os.environ.get("SMTP_QRCODE_FORMAT", default="html").lower(),
         "report_enabled": eval(os.environ.get("SMTP_REPORT_ENABLED", default="False")),
         "report_receivers": os.environ.get("SMTP_REPORT_RECEIVERS", default=None).split(","),
+        "pool_size": int(os.environ.get("SMTP_POOL_SIZE", default=3)),
         "template": template
     }
 
+    if smtp_config["qrcode_format"] not in ["html", "png"]:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: SMTP_QRCODE_FORMAT parameters invalid. Only `html` and `png` are allowed")
+        LOGGER.critical("SMTP_QRCODE_FORMAT parameters invalid. Only `html` and `png` are allowed")
+        sys.exit(1)
+
     if smtp_config["enabled"] and not os.path.isfile(smtp_config["template"]):
         print('\033[31m\u2716\033[0m')
         print(f"ERROR: SMTP Template {smtp_config['template']} does not exist... Exiting...")
@@ -132,8 +167,10 @@ def _load_smtp(verbose, template:str):
         print(f"logo_url           : {smtp_config['logo_url']}")
         print(f"email_psk_to_users : {smtp_config['email_psk_to_users']}")
         print(f"enable_qrcode      : {smtp_config['enable_qrcode']}")
+        print(f"qrcode_format      : {smtp_config['qrcode_format']}")
         print(f"report_enabled     : {smtp_config['report_enabled']}")
         print(f"report_receivers   : {smtp_config['report_receivers']}")
+        print(f"pool_size          : {smtp_config['pool_size']}")
         print(f"template           : {smtp_config['template']}")
         print("")
     LOGGER.info(f"enabled            : {smtp_config['enabled']}")
@@ -146,8 +183,10 @@ def _load_smtp(verbose, template:str):
     LOGGER.info(f"logo_url           : {smtp_config['logo_url']}")
     LOGGER.info(f"email_psk_to_users : {smtp_config['email_psk_to_users']}")
     LOGGER.info(f"enable_qrcode      : {smtp_config['enable_qrcode']}")
+    LOGGER.info(f"qrcode_format      : {smtp_config['qrcode_format']}")
     LOGGER.info(f"report_enabled     : {smtp_config['report_enabled']}")
     LOGGER.info(f"report_receivers   : {smtp_config['report_receivers']}")
+    LOGGER.info(f"pool_size          : {smtp_config['pool_size']}")
     LOGGER.info(f"template           : {smtp_config['template']}")
 
     return smtp_config
@@ -155,6 +194,25 @@ def _load_smtp(verbose, template:str):
 #############################################
 #### Mist CONFIG
 
+def _parse_mist_targets(targets:str):
+    """
+    MIST_TARGETS format: "<scope>:<scope_id>:<ssid>,<scope>:<scope_id>:<ssid>"
+    """
+    mist_targets = []
+    for target in targets.split(","):
+        if not target.strip():
+            continue
+        try:
+            scope, scope_id, ssid = target.strip().split(":", 2)
+        except ValueError:
+            scope = scope_id = ssid = None
+        if scope not in ["orgs", "sites"] or not scope_id or not ssid:
+            print(f"ERROR: Wrong MIST_TARGETS value \"{target}\". Must be <orgs|sites>:<scope_id>:<ssid>")
+            LOGGER.critical(f"Wrong MIST_TARGETS value \"{target}\". Must be <orgs|sites>:<scope_id>:<ssid>")
+            sys.exit(1)
+        mist_targets.append({"scope": scope, "scope_id": scope_id, "ssid": ssid})
+    return mist_targets
+
 def _load_mist(verbose):
     print("Loading MIST settings ".ljust(79, "."), end="", flush=True)
     mist_config = {
@@ -169,7 +227,36 @@ def _load_mist(verbose):
         "psk_max_usage": os.environ.get("MIST_PSK_MAX_USAGE", 0),
         "allowed_chars": os.environ.get("MIST_PSK_ALLOWED_CHARS", default="abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789"),
         "excluded_psks": os.environ.get("MIST_PSK_EXCLUDED", default=""),
+        "excluded_psks_file": os.environ.get("MIST_PSK_EXCLUDED_FILE", default=""),
+        "delete_workers": int(os.environ.get("MIST_DELETE_WORKERS", default=5)),
+        "api_rate": float(os.environ.get("MIST_API_RATE", default=0)),
+        "api_hourly_quota": int(os.environ.get("MIST_API_HOURLY_QUOTA", default=0)),
+        "api_max_concurrency": int(os.environ.get("MIST_API_MAX_CONCURRENCY", default=10)),
+        "api_retries": int(os.environ.get("MIST_API_RETRIES", default=3)),
+        "create_workers": int(os.environ.get("MIST_CREATE_WORKERS", default=3)),
+        "create_batch_size": int(os.environ.get("MIST_CREATE_BATCH_SIZE", default=100)),
+        "create_batch_max": int(os.environ.get("MIST_CREATE_BATCH_MAX", default=500)),
+        "create_target_latency": float(os.environ.get("MIST_CREATE_TARGET_LATENCY", default=10)),
+        "list_workers": int(os.environ.get("MIST_LIST_WORKERS", default=4)),
+        "cache_file": os.environ.get("MIST_CACHE_FILE", default=""),
+        "cache_max_age": int(os.environ.get("MIST_CACHE_MAX_AGE", default=3600)),
+        "targets": _parse_mist_targets(os.environ.get("MIST_TARGETS", default="")),
+        "target_workers": int(os.environ.get("MIST_TARGET_WORKERS", default=1)),
     }
+    if mist_config["targets"]:
+        # the first target is used as default scope/ssid
+        mist_config["scope"] = mist_config["targets"][0]["scope"]
+        mist_config["scope_id"] = mist_config["targets"][0]["scope_id"]
+        mist_config["ssid"] = mist_config["targets"][0]["ssid"]
+    try:
+        # the exclusions are compiled once and shared by all the targets
+        mist_config["excluded_psks"] = PskExclusions.load(
+            mist_config["excluded_psks"], mist_config["excluded_psks_file"]
+        )
+    except Exception as e:
+        print(f"ERROR: Wrong MIST_PSK_EXCLUDED or MIST_PSK_EXCLUDED_FILE value: {e}")
+        LOGGER.critical(f"Wrong MIST_PSK_EXCLUDED or MIST_PSK_EXCLUDED_FILE value: {e}")
+        sys.exit(1)
 
     if not mist_config["host"]:
         print("ERROR: Missing MIST_HOST parameters")
@@ -229,6 +316,22 @@ def _load_mist(verbose):
         print(f"psk_max_usage : {mist_config['psk_max_usage']}")
         print(f"allowed_chars : {mist_config['allowed_chars']}")
         print(f"excluded_psks : {mist_config['excluded_psks']}")
+        print(f"excluded_file : {mist_config['excluded_psks_file']}")
+        print(f"delete_workers: {mist_config['delete_workers']}")
+        print(f"api_rate      : {mist_config['api_rate']}")
+        print(f"api_quota     : {mist_config['api_hourly_quota']}")
+        print(f"api_concurrent: {mist_config['api_max_concurrency']}")
+        print(f"api_retries   : {mist_config['api_retries']}")
+        print(f"create_workers: {mist_config['create_workers']}")
+        print(f"create_batch  : {mist_config['create_batch_size']} (max {mist_config['create_batch_max']})")
+        print(f"create_latency: {mist_config['create_target_latency']}")
+        print(f"list_workers  : {mist_config['list_workers']}")
+        print(f"cache_file    : {mist_config['cache_file']}")
+        print(f"cache_max_age : {mist_config['cache_max_age']}")
+        print(f"targets       : {len(mist_config['targets'])}")
+        for target in mist_config["targets"]:
+            print(f"                {target['scope']}/{target['scope_id']} - {target['ssid']}")
+        print(f"target_workers: {mist_config['target_workers']}")
         print("")
     LOGGER.info(f"host               : {mist_config['host']}")
     LOGGER.info(f"scope              : {mist_config['scope']}")
@@ -240,6 +343,21 @@ def _load_mist(verbose):
     LOGGER.info(f"psk_max_usage      : {mist_config['psk_max_usage']}")
     LOGGER.info(f"allowed_chars      : {mist_config['allowed_chars']}")
     LOGGER.info(f"excluded_psks      : {mist_config['excluded_psks']}")
+    LOGGER.info(f"excluded_psks_file : {mist_config['excluded_psks_file']}")
+    LOGGER.info(f"delete_workers     : {mist_config['delete_workers']}")
+    LOGGER.info(f"api_rate           : {mist_config['api_rate']}")
+    LOGGER.info(f"api_hourly_quota   : {mist_config['api_hourly_quota']}")
+    LOGGER.info(f"api_max_concurrency: {mist_config['api_max_concurrency']}")
+    LOGGER.info(f"api_retries        : {mist_config['api_retries']}")
+    LOGGER.info(f"create_workers     : {mist_config['create_workers']}")
+    LOGGER.info(f"create_batch_size  : {mist_config['create_batch_size']}")
+    LOGGER.info(f"create_batch_max   : {mist_config['create_batch_max']}")
+    LOGGER.info(f"create_latency     : {mist_config['create_target_latency']}")
+    LOGGER.info(f"list_workers       : {mist_config['list_workers']}")
+    LOGGER.info(f"cache_file         : {mist_config['cache_file']}")
+    LOGGER.info(f"cache_max_age      : {mist_config['cache_max_age']}")
+    LOGGER.info(f"targets            : {mist_config['targets']}")
+    LOGGER.info(f"target_workers     : {mist_config['target_workers']}")
 
     return mist_config
 
@@ -258,8 +376,24 @@ def _load_ldap(verbose):
         "base_dn": os.environ.get("LDAP_BASE_DN", default=None),
         "search_group": os.environ.get("LDAP_SEARCH_GROUP", default=None),
         "recursive_search": eval(os.environ.get("LDAP_RECURSIVE_SEARCH", default=False)),
+        "recursive_engine": os.environ.get("LDAP_RECURSIVE_ENGINE", default="matching_rule").lower(),
+        "expand_workers": int(os.environ.get("LDAP_EXPAND_WORKERS", default=4)),
+        "group_cache_file": os.environ.get("LDAP_GROUP_CACHE_FILE", default="./mist_ldap_sync.groups"),
         "user_name": os.environ.get("LDAP_USER_NAME", default="userPrincipalName"),
-        "user_email": os.environ.get("LDAP_USER_EMAIL", default="mail")
+        "user_email": os.environ.get("LDAP_USER_EMAIL", default="mail"),
+        "incremental": eval(os.environ.get("LDAP_INCREMENTAL", default="False")),
+        "state_file": os.environ.get("LDAP_STATE_FILE", default="./mist_ldap_sync.state"),
+        "full_sync_interval": int(os.environ.get("LDAP_FULL_SYNC_INTERVAL", default=86400)),
+        "watch_retry": int(os.environ.get("LDAP_WATCH_RETRY", default=30)),
+        "partitions": [
+            partition.strip()
+            for partition in os.environ.get("LDAP_PARTITIONS", default="").split(";")
+            if partition.strip()
+        ],
+        "search_workers": int(os.environ.get("LDAP_SEARCH_WORKERS", default=4)),
+        "page_size": int(os.environ.get("LDAP_PAGE_SIZE", default=1000)),
+        "connect_timeout": int(os.environ.get("LDAP_CONNECT_TIMEOUT", default=5)),
+        "health_check_interval": int(os.environ.get("LDAP_HEALTH_CHECK_INTERVAL", default=300))
     }
 
     if not ldap_config["host"]:
@@ -277,6 +411,11 @@ def _load_ldap(verbose):
         print("ERROR: Missing the LDAP base_dn")
         LOGGER.critical("Missing the LDAP base_dn")
         sys.exit(1)
+    elif ldap_config["recursive_engine"] not in ["matching_rule", "expand"]:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: LDAP_RECURSIVE_ENGINE parameters invalid. Only `matching_rule` and `expand` are allowed")
+        LOGGER.critical("LDAP_RECURSIVE_ENGINE parameters invalid. Only `matching_rule` and `expand` are allowed")
+        sys.exit(1)
     else:
         print("\033[92m\u2714\033[0m")
 
@@ -292,8 +431,20 @@ def _load_ldap(verbose):
         print(f"base_dn          : {ldap_config['base_dn']}")
         print(f"search_group     : {ldap_config['search_group']}")
         print(f"recursive_search : {ldap_config['recursive_search']}")
+        print(f"recursive_engine : {ldap_config['recursive_engine']}")
+        print(f"expand_workers   : {ldap_config['expand_workers']}")
+        print(f"group_cache_file : {ldap_config['group_cache_file']}")
         print(f"user_name        : {ldap_config['user_name']}")
         print(f"user_email       : {ldap_config['user_email']}")
+        print(f"incremental      : {ldap_config['incremental']}")
+        print(f"state_file       : {ldap_config['state_file']}")
+        print(f"full_sync_interval: {ldap_config['full_sync_interval']}")
+        print(f"watch_retry      : {ldap_config['watch_retry']}")
+        print(f"partitions       : {ldap_config['partitions']}")
+        print(f"search_workers   : {ldap_config['search_workers']}")
+        print(f"page_size        : {ldap_config['page_size']}")
+        print(f"connect_timeout  : {ldap_config['connect_timeout']}")
+        print(f"health_check_interval: {ldap_config['health_check_interval']}")
         print("")
     LOGGER.info(f"host               : {ldap_config['host']}")
     LOGGER.info(f"port               : {ldap_config['port']}")
@@ -303,112 +454,485 @@ def _load_ldap(verbose):
     LOGGER.info(f"base_dn            : {ldap_config['base_dn']}")
     LOGGER.info(f"search_group       : {ldap_config['search_group']}")
     LOGGER.info(f"recursive_search   : {ldap_config['recursive_search']}")
+    LOGGER.info(f"recursive_engine   : {ldap_config['recursive_engine']}")
+    LOGGER.info(f"expand_workers     : {ldap_config['expand_workers']}")
+    LOGGER.info(f"group_cache_file   : {ldap_config['group_cache_file']}")
     LOGGER.info(f"user_name          : {ldap_config['user_name']}")
     LOGGER.info(f"user_email         : {ldap_config['user_email']}")
+    LOGGER.info(f"incremental        : {ldap_config['incremental']}")
+    LOGGER.info(f"state_file         : {ldap_config['state_file']}")
+    LOGGER.info(f"full_sync_interval : {ldap_config['full_sync_interval']}")
+    LOGGER.info(f"watch_retry        : {ldap_config['watch_retry']}")
+    LOGGER.info(f"partitions         : {ldap_config['partitions']}")
+    LOGGER.info(f"search_workers     : {ldap_config['search_workers']}")
+    LOGGER.info(f"page_size          : {ldap_config['page_size']}")
+    LOGGER.info(f"connect_timeout    : {ldap_config['connect_timeout']}")
+    LOGGER.info(f"health_check_interval: {ldap_config['health_check_interval']}")
 
     return ldap_config
 
+#############################################
+#### DAEMON CONFIG
+
+def _load_daemon(verbose):
+    print("Loading DAEMON settings ".ljust(79, "."), end="", flush=True)
+    daemon_config = {
+        "interval": int(os.environ.get("DAEMON_INTERVAL", default=300)),
+        "schedule": os.environ.get("DAEMON_SCHEDULE", default=None),
+    }
+    try:
+        Scheduler(daemon_config["interval"], daemon_config["schedule"])
+        print("\033[92m\u2714\033[0m")
+    except ValueError as e:
+        print('\033[31m\u2716\033[0m')
+        print(f"ERROR: Wrong DAEMON_INTERVAL/DAEMON_SCHEDULE value: {e}")
+        LOGGER.critical(f"Wrong DAEMON_INTERVAL/DAEMON_SCHEDULE value: {e}")
+        sys.exit(1)
+
+    if verbose:
+        print("".ljust(80, "-"))
+        print(" DAEMON CONFIG ".center(80))
+        print("")
+        print(f"interval         : {daemon_config['interval']}")
+        print(f"schedule         : {daemon_config['schedule']}")
+        print("")
+    LOGGER.info(f"interval           : {daemon_config['interval']}")
+    LOGGER.info(f"schedule           : {daemon_config['schedule']}")
+
+    return daemon_config
+
+#############################################
+#### METRICS CONFIG
+
+def _load_metrics(verbose):
+    print("Loading METRICS settings ".ljust(79, "."), end="", flush=True)
+    metrics_config = {
+        "file": os.environ.get("METRICS_FILE", default=""),
+        "format": os.environ.get("METRICS_FORMAT", default="prometheus").lower(),
+    }
+    if metrics_config["format"] not in ["prometheus", "json"]:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: METRICS_FORMAT parameters invalid. Only `prometheus` and `json` are allowed")
+        LOGGER.critical("METRICS_FORMAT parameters invalid. Only `prometheus` and `json` are allowed")
+        sys.exit(1)
+    print("\033[92m\u2714\033[0m")
+
+    if verbose:
+        print("".ljust(80, "-"))
+        print(" METRICS CONFIG ".center(80))
+        print("")
+        print(f"file             : {metrics_config['file']}")
+        print(f"format           : {metrics_config['format']}")
+        print("")
+    LOGGER.info(f"file               : {metrics_config['file']}")
+    LOGGER.info(f"format             : {metrics_config['format']}")
+
+    return metrics_config
+
+#############################################
+#### JOURNAL CONFIG
+
+def _load_journal(verbose, resume=False):
+    print("Loading JOURNAL settings ".ljust(79, "."), end="", flush=True)
+    journal_config = {
+        "file": os.environ.get("JOURNAL_FILE", default=""),
+    }
+    if resume and not journal_config["file"]:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: Missing JOURNAL_FILE parameters. Required with -R/--resume")
+        LOGGER.critical("Missing JOURNAL_FILE parameters. Required with -R/--resume")
+        sys.exit(1)
+    print("\033[92m\u2714\033[0m")
+
+    if verbose:
+        print("".ljust(80, "-"))
+        print(" JOURNAL CONFIG ".center(80))
+        print("")
+        print(f"file             : {journal_config['file']}")
+        print("")
+    LOGGER.info(f"file               : {journal_config['file']}")
+
+    return journal_config
+
+#############################################
+#### ENGINE CONFIG
+
+def _load_engine(verbose):
+    print("Loading ENGINE settings ".ljust(79, "."), end="", flush=True)
+    engine_config = {
+        "engine": os.environ.get("SYNC_ENGINE", default="threads").lower(),
+        "concurrency": int(os.environ.get("SYNC_ASYNC_CONCURRENCY", default=100)),
+    }
+    if engine_config["engine"] not in ["threads", "asyncio"]:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: SYNC_ENGINE parameters invalid. Only `threads` and `asyncio` are allowed")
+        LOGGER.critical("SYNC_ENGINE parameters invalid. Only `threads` and `asyncio` are allowed")
+        sys.exit(1)
+    elif engine_config["engine"] == "asyncio" and not async_available():
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: SYNC_ENGINE=asyncio requires the aiohttp and aiosmtplib packages")
+        LOGGER.critical("SYNC_ENGINE=asyncio requires the aiohttp and aiosmtplib packages")
+        sys.exit(1)
+    elif engine_config["concurrency"] < 1:
+        print('\033[31m\u2716\033[0m')
+        print("ERROR: SYNC_ASYNC_CONCURRENCY must be at least 1")
+        LOGGER.critical("SYNC_ASYNC_CONCURRENCY must be at least 1")
+        sys.exit(1)
+    print("\033[92m\u2714\033[0m")
+
+    if verbose:
+        print("".ljust(80, "-"))
+        print(" ENGINE CONFIG ".center(80))
+        print("")
+        print(f"engine           : {engine_config['engine']}")
+        print(f"concurrency      : {engine_config['concurrency']}")
+        print("")
+    LOGGER.info(f"engine             : {engine_config['engine']}")
+    LOGGER.info(f"concurrency        : {engine_config['concurrency']}")
+
+    return engine_config
+
 ###############################################################################
 ###############################################################################
 ##################################################################### FUNCTIONS
 ###############################################################################
+def _print_part(part, space=True):
+    if space:
+        print()
+    print(part.center(80, "_"))
+
+
 class Main():
-    def __init__(self, ldap_config, mist_config, smtp_config, dry_run, resend_emails, resend_emails_filter):
-        self._print_part("INIT", False)
+    def __init__(self, ldap_config, mist_config, smtp_config, dry_run, resend_emails, resend_emails_filter, metrics_config=None, journal_config=None, resume=False, engine_config=None):
+        _print_part("INIT", False)
+        self.metrics_config = metrics_config or {}
+        self.journal_file = (journal_config or {}).get("file")
+        self.resume = resume
+        self.ldap_config = ldap_config
         self.ldap = MistLdap(ldap_config)
-        self.mist = Mist(mist_config)
-        self.smtp = MistSmtp(smtp_config)
+        self.engine = None
+        if (engine_config or {}).get("engine") == "asyncio":
+            # the Mist API requests and the PSK emails are sent from one event loop
+            self.engine = AsyncEngine(engine_config["concurrency"])
+            self.mist = AsyncMist(mist_config, self.engine)
+            self.smtp = AsyncMistSmtp(smtp_config, self.engine)
+        else:
+            self.mist = Mist(mist_config)
+            self.smtp = MistSmtp(smtp_config)
+        self.target_workers = mist_config.get("target_workers", 1)
+        # all the targets share the Mist session and the rate limiter
+        self.targets = [
+            SyncTarget(
+                self.mist.for_target(target["scope"], target["scope_id"], target["ssid"]),
+                self.smtp, dry_run, resend_emails, resend_emails_filter
+            )
+            for target in mist_config.get("targets") or [mist_config]
+        ]
         self.report_delete = []
         self.report_add = []
-        self.ldap_user_list = []
-        self.mist_user_list = []
         self.dry_run = dry_run
         self.resend_emails = resend_emails
-        self.resend_emails_filter = resend_emails_filter
 
     def sync(self):
+        METRICS.reset()
+        success = False
+        # nothing is changed by the dry runs and the resend of the emails
+        if self.dry_run or self.resend_emails:
+            journal = RunJournal()
+        else:
+            journal = RunJournal(self.journal_file, self.resume)
+        # in daemon mode, only the first run is resumed
+        self.resume = False
+        try:
+            success = self._sync(journal)
+        finally:
+            journal.close(success)
+            METRICS.finish(success)
+            METRICS.export(self.metrics_config.get("file"), self.metrics_config.get("format"))
+
+    def _sync(self, journal):
+        self.report_delete = []
+        self.report_add = []
+        completed = True
         if self.dry_run:
-            dry_run_string = "DRY RUN - "
             LOGGER.info("Starting in DRY RUN mode")
+        if len(self.targets) == 1:
+            # the LDAP search is only done if the users are read
+            self.targets[0].sync(self.ldap.iter_users(), journal)
+        else:
+            if journal.all_planned([target.name for target in self.targets]):
+                LOGGER.info("sync:all the targets are resumed, skipping the LDAP search")
+                ldap_users = []
+            else:
+                _print_part("LDAP SEARCH")
+                LOGGER.info("sync:getting ldap users for all the targets")
+                ldap_users = list(self.ldap.iter_users())
+            output = None
+            if self.target_workers > 1:
+                # the lines of the targets synchronized at the same time are
+                # prefixed with the target name
+                output = TargetOutput(sys.stdout)
+                sys.stdout = output
+            try:
+                with ThreadPoolExecutor(max_workers=self.target_workers) as executor:
+                    futures = [
+                        executor.submit(self._sync_target, target, ldap_users, journal, output)
+                        for target in self.targets
+                    ]
+                    for future in futures:
+                        try:
+                            future.result()
+                        except:
+                            completed = False
+                            LOGGER.error("Exception occurred", exc_info=True)
+            finally:
+                if output:
+                    sys.stdout = output.stream
+
+        for target in self.targets:
+            if len(self.targets) > 1:
+                for report in target.report_add + target.report_delete:
+                    report.target = target.name
+            self.report_add += target.report_add
+            self.report_delete += target.report_delete
+        _print_part("REPORT")
+        LOGGER.info("sync:send report")
+        with METRICS.phase("report"):
+            self.smtp.send_report(self.report_add, self.report_delete, self.dry_run)
+        self.smtp.close()
+        return completed
+
+    def _sync_target(self, target, ldap_users, journal, output=None):
+        if not output:
+            return target.sync(ldap_users, journal)
+        with output.target(target.name):
+            return target.sync(ldap_users, journal)
+
+    def close(self):
+        """
+        Close the SMTP sessions and stop the asyncio engine, if used
+        """
+        self.smtp.close()
+        if self.engine:
+            self.engine.close()
+            self.engine = None
+
+    def run_daemon(self, daemon_config):
+        """
+        Keep the LDAP connection and the Mist session open and run the
+        synchronization on the configured schedule
+        """
+        scheduler = Scheduler(daemon_config["interval"], daemon_config["schedule"])
+        scheduler.run_forever(self._daemon_sync)
+
+    def run_watch(self, daemon_config=None):
+        """
+        Delete the PSKs of the users removed from the search group or
+        disabled as soon as the LDAP change is received. With
+        `daemon_config`, the scheduled synchronizations are also run
+        """
+        _print_part("LDAP WATCH")
+        # the watch uses its own LDAP connections
+        watcher = MistLdap(self.ldap_config)
+        if daemon_config:
+            thread = threading.Thread(target=watcher.watch, args=(self._deprovision,), daemon=True)
+            thread.start()
+            self.run_daemon(daemon_config)
+        else:
+            watcher.watch(self._deprovision)
+
+    def _deprovision(self, user):
+        LOGGER.info(f"watch:deprovisioning user {user.name}")
+        self.mist.check_session()
+        for target in self.targets:
+            try:
+                target.deprovision(user)
+            except:
+                LOGGER.error("Exception occurred", exc_info=True)
+
+    def _daemon_sync(self):
+        _print_part(f" SYNC {datetime.now():%Y-%m-%d %H:%M:%S} ")
+        LOGGER.info("daemon:starting synchronization")
+        self.mist.check_session()
+        self.sync()
+        LOGGER.info("daemon:synchronization done")
+
+
+class SyncTarget():
+    """
+    Synchronization of the LDAP users with the PSKs of one scope/SSID
+    """
+    def __init__(self, mist, smtp, dry_run, resend_emails, resend_emails_filter):
+        self.mist = mist
+        self.smtp = smtp
+        self.name = f"{mist.scope}/{mist.scope_id} - {mist.ssid}"
+        self.report_delete = []
+        self.report_add = []
+        self.inventory = None
+        self.reconcile = None
+        self.journal = None
+        self.resumed_add = []
+        self.resumed_delete = []
+        self.dry_run = dry_run
+        self.resend_emails = resend_emails
+        self.resend_emails_filter = resend_emails_filter
+
+    def sync(self, ldap_users, journal: RunJournal = None):
+        self.report_delete = []
+        self.report_add = []
+        self.resumed_add = []
+        self.resumed_delete = []
+        self.journal = journal or RunJournal()
+        if self.dry_run:
+            dry_run_string = "DRY RUN - "
         else:
             dry_run_string = ""
-        self._print_part("LDAP SEARCH")
-        LOGGER.info("sync:getting ldap users")
-        self.ldap_user_list = self.ldap.get_users()
-        LOGGER.info("sync:getting mist users")
-        self._print_part("MIST REQUEST")
-        self.mist_user_list = self.mist.get_users()
+        state = self.journal.get(self.name)
+        if state:
+            LOGGER.info(f"sync:{self.name}:resuming the interrupted run")
+            _print_part(f" RESUME - {self.name} ")
+            with METRICS.phase("diff"):
+                self._resume(state)
+        else:
+            LOGGER.info(f"sync:{self.name}:getting mist users")
+            _print_part(f" MIST REQUEST - {self.name} ")
+            with METRICS.phase("mist_list"):
+                self.inventory = self.mist.get_inventory(offline=self.dry_run)
+            METRICS.add_items("mist_list", len(self.inventory))
+            if not isinstance(ldap_users, list):
+                # the LDAP users are streamed page by page into the reconciliation index
+                _print_part("LDAP SEARCH")
+            LOGGER.info(f"sync:{self.name}:reconcile ldap users with mist psks")
+            with METRICS.phase("diff"):
+                self.reconcile = MistReconcile(ldap_users, self.inventory.psks())
+            METRICS.add_items("diff", len(self.reconcile.ldap_index) + len(self.inventory))
+            self.journal.plan(self.name, self.reconcile.to_create, self.reconcile.to_delete)
         if not self.resend_emails:
-            self._print_part(f" {dry_run_string}DELETE " )
-            LOGGER.info("sync:delete users")
-            self._delete_psk()
-            LOGGER.info("sync:create users")
-            self._create_psk()
+            _print_part(f" {dry_run_string}DELETE - {self.name} " )
+            LOGGER.info(f"sync:{self.name}:delete users")
+            with METRICS.phase("delete"):
+                self._delete_psk()
+            METRICS.add_items("delete", len(self.report_delete))
+            LOGGER.info(f"sync:{self.name}:create users")
+            with METRICS.phase("create"):
+                self._create_psk()
+            METRICS.add_items("create", len([user for user in self.report_add if user.psk_added]))
+            self.inventory.commit()
+            self.report_delete = self.resumed_delete + self.report_delete
+            self.report_add = self.resumed_add + self.report_add
         if not self.mist.psk_email:
-            LOGGER.info("sync:send users email")
-            self._send_user_email()
+            LOGGER.info(f"sync:{self.name}:send users email")
+            with METRICS.phase("email"):
+                self._send_user_email()
         else:
-            LOGGER.info("sync:emil configured to be sent by Mist")
-        self._print_part("REPORT")
-        LOGGER.info("sync:send report")
-        self.smtp.send_report(self.report_add, self.report_delete, self.dry_run)
+            LOGGER.info(f"sync:{self.name}:emil configured to be sent by Mist")
+        self.inventory.close()
 
-    def _print_part(self, part, space=True):
-        if space:
-            print()
-        print(part.center(80, "_"))
+    def _resume(self, state):
+        """
+        Continue the interrupted run recorded in the journal: only the PSKs
+        not created or deleted yet are processed, and the PSKs created by
+        the interrupted run are emailed if it was not done yet
+        """
+        emails = {normalize(name): email.lower() for name, email in state["create"]}
+        created = [
+            Psk(name=name, passphrase=passphrase, ssid=ssid, email=emails.get(name), vlan_id=vlan_id)
+            for name, (passphrase, ssid, vlan_id) in state["created"].items()
+        ]
+        self.inventory = self.mist.get_inventory(psks=created)
+        to_create = [
+            LdapUser(name, email)
+            for name, email in state["create"]
+            if normalize(name) not in state["created"]
+        ]
+        to_delete = [
+            Psk(id=psk_id, name=name)
+            for psk_id, name in state["delete"]
+            if psk_id not in state["deleted"]
+        ]
+        self.reconcile = MistReconcile(to_create, to_delete)
+        self.resumed_add = [
+            UserReport(psk.name, psk.email, psk_added=True, email_sent=psk.name in state["emails"])
+            for psk in created
+        ]
+        self.resumed_delete = [
+            DeleteReport(name, True)
+            for psk_id, name in state["delete"]
+            if psk_id in state["deleted"]
+        ]
+        LOGGER.info(
+            f"_resume:{self.name}:{len(created)} psks already created, "
+            f"{len(self.resumed_delete)} already deleted, "
+            f"{len(to_create)} to create, {len(to_delete)} to delete"
+        )
 
     def _generate_user_list(self, include_users_with_psk:bool=False):
         users = []
-        for user in self.ldap_user_list:
-            user_has_psk = True
-            try:
-                next(item for item in self.mist_user_list if item["name"].lower()==user["name"].lower())
-            except:
-                user_has_psk = False
-
-            if not user_has_psk or include_users_with_psk:
-                reported_user = {
-                        "name": user["name"].lower(),
-                        "email": user["email"].lower(),
-                        "psk_added": False,
-                        "email_sent": False
-                    }
-                data = []
-                if user["name"]:
-                    data.append(f"name : {user['name'].lower()}")
-                if user["email"]:
-                    data.append(f"email: {user['email'].lower()}")
-                users.append(reported_user)
+        if include_users_with_psk:
+            ldap_users = self.reconcile.ldap_users()
+        else:
+            ldap_users = self.reconcile.to_create
+        for user in ldap_users:
+            users.append(UserReport(user.key, user.email.lower()))
         return users
 
     def _delete_psk(self):
         self.report_delete = []
-        for psk in self.mist_user_list:
-            try:
-                user_in_ldap=list(item for item in self.ldap_user_list if item["name"].lower()==psk["name"].lower())
-                if user_in_ldap:
-                    LOGGER.debug(f"_delete_psk:user {psk['name']} found in ldap: {user_in_ldap}")
-                else:
-                    if not psk["name"] in self.mist.excluded_psks:
-                        LOGGER.info(f"_delete_psk:user {psk['name']} not found in LDAP. trying to delete psk id {psk['id']}")
-                        print(
-                                f"User {psk['name'].lower()} not found... Removing the psk "
-                                .ljust(79, "."), end="", flush=True
-                            )
-                        report = {"psk": psk["name"], "psk_deleted": False}
-                        try:
-                            self.mist.delete_ppsk(psk["id"], self.dry_run)
-                            print("\033[92m\u2714\033[0m")
-                            report["psk_deleted"] = True
-                        except:
-                            print('\033[31m\u2716\033[0m')
-                        finally:
-                            self.report_delete.append(report)
-            except:
-                LOGGER.error("Exception occurred", exc_info=True)
-        if not self.report_delete:
+        psks_to_delete = []
+        for psk in self.reconcile.to_delete:
+            if not psk.name in self.mist.excluded_psks:
+                LOGGER.info(f"_delete_psk:user {psk.name} not found in LDAP. trying to delete psk id {psk.id}")
+                psks_to_delete.append(psk)
+
+        if not psks_to_delete:
             print("No PSK to delete!")
+            return
+
+        print(f"{len(psks_to_delete)} psks will be deleted")
+        try:
+            results = self.mist.delete_ppsks(
+                [psk.id for psk in psks_to_delete], self.dry_run,
+                on_deleted=lambda psk_ids: self.journal.deleted(self.name, psk_ids)
+            )
+        except:
+            LOGGER.error("Exception occurred", exc_info=True)
+            results = {}
+        for psk in psks_to_delete:
+            print(
+                    f"User {psk.key} not found... Removing the psk "
+                    .ljust(79, "."), end="", flush=True
+                )
+            report = DeleteReport(psk.name, results.get(psk.id, False))
+            if report.psk_deleted:
+                if not self.dry_run:
+                    self.inventory.remove(psk.id)
+                print("\033[92m\u2714\033[0m")
+            else:
+                print('\033[31m\u2716\033[0m')
+            self.report_delete.append(report)
+
+    def deprovision(self, user):
+        """
+        Delete the PSKs of a single user removed from LDAP
+        """
+        if user.name in self.mist.excluded_psks:
+            LOGGER.info(f"deprovision:{self.name}:psk {user.name} excluded")
+            return
+        print(
+                f"User {user.key} removed... Removing the psk "
+                .ljust(79, "."), end="", flush=True
+            )
+        try:
+            results = self.mist.delete_user_ppsks(user.name, self.dry_run)
+        except:
+            print('\033[31m\u2716\033[0m')
+            LOGGER.error("Exception occurred", exc_info=True)
+            return
+        if all(results.values()):
+            print("\033[92m\u2714\033[0m")
+        else:
+            print('\033[31m\u2716\033[0m')
+        LOGGER.info(f"deprovision:{self.name}:{len(results)} psks deleted for {user.name}")
 
     def _create_psk(self):
         if self.dry_run:
@@ -426,13 +950,15 @@ class Main():
 
         else:
             print(f"{len(self.report_add)} psks will be created")
-            self.report_add = self.mist.create_ppsk_bulk(self.report_add, self.dry_run)
+            self.report_add = self.mist.create_ppsk_bulk(
+                self.report_add, self.dry_run, self.inventory,
+                on_created=lambda psks: self.journal.created(self.name, psks)
+            )
 
         if not self.report_add:
             print("No PSK created!")
 
     def _send_user_email(self):
-        psk_list = self.mist.get_ppks()
         if not self.report_add:
             LOGGER.debug(f"_send_user_email:generating user list")
             print()
@@ -442,39 +968,73 @@ class Main():
         else:
             LOGGER.debug(f"_send_user_email:got user list from self.report")
 
+        candidates = []
         for user in self.report_add:
-            if not user.get("email"):
-                LOGGER.warning(f"_create_psk:no email for {user['name']}. Will not send psk by email")
+            if user.email_sent:
+                LOGGER.debug(f"_send_user_email:email already sent to {user.name}")
+            elif not user.email:
+                LOGGER.warning(f"_create_psk:no email for {user.name}. Will not send psk by email")
+            elif (
+                (self.resend_emails and user.email in self.resend_emails_filter) or
+                (self.resend_emails and not self.resend_emails_filter) or
+                user.psk_added
+            ):
+                candidates.append(user)
+
+        if self.mist.cache_file and not self.dry_run:
+            # the passphrases of the existing PSKs may have been changed in the
+            # Mist Cloud since they were cached, so they are requested again
+            existing = [user.name for user in candidates if not user.psk_added]
+            if existing:
+                LOGGER.info(f"_send_user_email:{self.name}:refreshing {len(existing)} cached psks")
+                self.mist.refresh_ppsks(self.inventory, existing)
+
+        users_to_email = []
+        emails = []
+        for user in candidates:
+            psks = self.inventory.get(user.name)
+            if not psks:
+                LOGGER.warning(f"_create_psk:PSK for {user.name} not found")
             else:
-                if (
-                    (self.resend_emails and user.get("email") in self.resend_emails_filter) or
-                    (self.resend_emails and not self.resend_emails_filter) or
-                    user.get("psk_added")
-                ):
-                    try:
-                        psk = next(item for item in psk_list if item["name"].lower()==user["name"].lower())
-                        res = self.smtp.send_psk(
-                                psk["passphrase"],
-                                psk["ssid"],
-                                user["name"],
-                                user["email"],
-                                self.dry_run
-                            )
-                        user["email_sent"] = res
-                    except:
-                        LOGGER.warning(f"_create_psk:PSK for {user['name']} not found")
-
-def _check_only(template:str):
+                users_to_email.append(user)
+                emails.append((psks[0].passphrase, psks[0].ssid, user.name, user.email))
+
+        results = self.smtp.send_psks(
+            emails, self.dry_run,
+            on_sent=lambda name: self.journal.email_sent(self.name, name)
+        )
+        for user, res in zip(users_to_email, results):
+            user.email_sent = res
+
+def _check_only(template:str, daemon=False):
         _load_ldap(True)
         _load_mist(True)
         _load_smtp(True, template)
+        _load_metrics(True)
+        _load_journal(True)
+        _load_engine(True)
+        if daemon:
+            _load_daemon(True)
 
-def _run(check, dry_run, resend_emails, resend_emails_filter, template):
+def _run(check, dry_run, resend_emails, resend_emails_filter, template, daemon=False, watch=False, resume=False):
         ldap_config = _load_ldap(check)
         mist_config= _load_mist(check)
         smtp_config =_load_smtp(check, template)
-        main = Main(ldap_config, mist_config, smtp_config, dry_run, resend_emails, resend_emails_filter)
-        main.sync()
+        metrics_config = _load_metrics(check)
+        journal_config = _load_journal(check, resume)
+        engine_config = _load_engine(check)
+        if daemon:
+            daemon_config = _load_daemon(check)
+        main = Main(ldap_config, mist_config, smtp_config, dry_run, resend_emails, resend_emails_filter, metrics_config, journal_config, resume, engine_config)
+        try:
+            if watch:
+                main.run_watch(daemon_config if daemon else None)
+            elif daemon:
+                main.run_daemon(daemon_config)
+            else:
+                main.sync()
+        finally:
+            main.close()
 
 def _read_csv_file(file_path: str):
     LOGGER.info(f"_read_csv_file:CSV file provided. Loading {file_path}")
@@ -506,7 +1066,8 @@ Usage:
 -r, --resend-emails Resend PSK emails to users. This option disable to PSK
                     creation and deletion (will just generate and send the 
                     emails)
-                    This option DOES NOT work with Mist Emails
+                    This option DOES NOT work with Mist Emails, and can not be
+                    used with -D/--daemon
 -f, --file=         if -r/--resend-emails, location of a CSV file with the list
                     of emails to whom the psk should be resend
 
@@ -520,6 +1081,21 @@ Usage:
 
 -l, --log-file      Location of the log files
 
+-D, --daemon        Run as a service: keep the LDAP connection and the Mist
+                    session open and run the synchronization every
+                    DAEMON_INTERVAL seconds (or on the DAEMON_SCHEDULE cron
+                    schedule). Runs never overlap
+
+-w, --watch         Subscribe to the LDAP changes (AD change notification) and
+                    delete the PSKs of a user as soon as the user is removed
+                    from LDAP_SEARCH_GROUP or is disabled. Can be used with
+                    -D/--daemon to also run the scheduled synchronizations
+
+-R, --resume        Continue the run interrupted before its end from the
+                    JOURNAL_FILE, without searching LDAP and listing the PSKs
+                    again. The PSKs already created/deleted and the emails
+                    already sent are skipped
+
 ---
 Configuration file example:
 
@@ -573,8 +1149,8 @@ Github: https://github.com/tmunzer/mist_ldap_sync
     try:
         opts, args = getopt.getopt(
                 sys.argv[1:],
-                "ce:ahdl:rf:t:", 
-                ["check", "env=", "all", "help", "dry-run", "log-file=", "resend-emails", "file=", "template="]
+                "ce:ahdl:rf:t:DwR", 
+                ["check", "env=", "all", "help", "dry-run", "log-file=", "resend-emails", "file=", "template=", "daemon", "watch", "resume"]
             )
     except getopt.GetoptError as err:
         print(err)
@@ -589,6 +1165,9 @@ Github: https://github.com/tmunzer/mist_ldap_sync
     RESEND_EMAILS_FILTER_FILE=None
     RESEND_EMAILS_FILTER = []
     TEMPLATE = "psk_template.html"
+    DAEMON = False
+    WATCH = False
+    RESUME = False
     for o, a in opts:
         if o in ["-h", "--help"]:
             usage()
@@ -609,9 +1188,21 @@ Github: https://github.com/tmunzer/mist_ldap_sync
             LOG_FILE = a
         elif o in ["-t", "--template"]:
             TEMPLATE = a
+        elif o in ["-D", "--daemon"]:
+            DAEMON = True
+        elif o in ["-w", "--watch"]:
+            WATCH = True
+        elif o in ["-R", "--resume"]:
+            RESUME = True
         else:
             assert False, "unhandled option"
 
+    if DAEMON and RESEND_EMAILS:
+        # the emails would be sent again at each scheduled run
+        print("ERROR: -r/--resend-emails can not be used with -D/--daemon")
+        usage()
+        sys.exit(2)
+
     if ENV_FILE:
         load_dotenv(dotenv_path=ENV_FILE)
     else:
@@ -622,6 +1213,6 @@ Github: https://github.com/tmunzer/mist_ldap_sync
     if RESEND_EMAILS_FILTER_FILE:
         RESEND_EMAILS_FILTER = _read_csv_file(RESEND_EMAILS_FILTER_FILE)
     if CHECK_ONLY:
-        _check_only(TEMPLATE)
+        _check_only(TEMPLATE, DAEMON)
     else:
-        _run(CHECK, DRY_RUN, RESEND_EMAILS, RESEND_EMAILS_FILTER, TEMPLATE)
+        _run(CHECK, DRY_RUN, RESEND_EMAILS, RESEND_EMAILS_FILTER, TEMPLATE, DAEMON, WATCH, RESUME)
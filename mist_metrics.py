@@ -0,0 +1,208 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script collecting the metrics of the synchronization
+"""
+import logging
+import os
+import re
+import json
+import time
+import threading
+import contextlib
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+PREFIX = "mist_ldap_sync"
+
+
+class Metrics:
+    """
+    Class collecting the duration and the number of items of each phase of
+    the synchronization, and the API/SMTP counters. The time of a phase does
+    not include the time spent in the phases it calls (e.g. the LDAP search
+    streamed into the diff). The phases run by several threads (e.g. the
+    email rendering) are summed over the threads.
+    The metrics can be exported as a Prometheus textfile or as JSON.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.duration = None
+            self.success = None
+            self.phases = {}
+            self.items = {}
+            self.api_calls = {}
+            self.counters = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Context manager measuring the time spent in the phase `name`
+        """
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - children
+
+    def iterate(self, name: str, iterable):
+        """
+        Generator returning the items of `iterable`, counting the items and
+        the time spent to get them in the phase `name`
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.add_items(name)
+            yield item
+
+    def add_items(self, name: str, count: int = 1):
+        with self._lock:
+            self.items[name] = self.items.get(name, 0) + count
+
+    def count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name: str, seconds: float):
+        """
+        Add `seconds` to the phase `name`, for the operations that can not
+        be measured with `phase` (e.g. the coroutines, interleaved in the
+        same thread)
+        """
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def api_response(self, response, *args, **kwargs):
+        """
+        requests response hook counting the API calls (including the ones
+        retried by mistapi) and the bytes transferred
+        """
+        request = response.request
+        self.api_call(
+            request.method, request.path_url, response.status_code,
+            len(request.body or b""), len(response.content or b"")
+        )
+
+    def api_call(self, method: str, path: str, status, sent: int = 0, received: int = 0):
+        """
+        Count an API call and the bytes transferred
+        """
+        # replace the ids with a placeholder to limit the number of endpoints
+        endpoint = re.sub(r"/[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", "/{id}", path.split("?")[0])
+        key = (method, endpoint, str(status))
+        with self._lock:
+            self.api_calls[key] = self.api_calls.get(key, 0) + 1
+        if status == 429:
+            self.count("api_throttled")
+        self.count("api_bytes_sent", sent)
+        self.count("api_bytes_received", received)
+
+    def finish(self, success: bool):
+        with self._lock:
+            self.duration = time.time() - self.start_time
+            self.success = success
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "start_time": self.start_time,
+                "duration": self.duration,
+                "success": self.success,
+                "phases": {
+                    name: {
+                        "seconds": seconds,
+                        "items": self.items.get(name, 0),
+                        "items_per_second": self.items.get(name, 0) / seconds if seconds else 0,
+                    }
+                    for name, seconds in self.phases.items()
+                },
+                "api_calls": [
+                    {"method": method, "endpoint": endpoint, "status": status, "count": count}
+                    for (method, endpoint, status), count in self.api_calls.items()
+                ],
+                "counters": dict(self.counters),
+            }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = [
+            f"# HELP {PREFIX}_run_success 1 if the last synchronization succeeded",
+            f"# TYPE {PREFIX}_run_success gauge",
+            f"{PREFIX}_run_success {int(bool(data['success']))}",
+            f"# HELP {PREFIX}_run_timestamp_seconds Start time of the last synchronization",
+            f"# TYPE {PREFIX}_run_timestamp_seconds gauge",
+            f"{PREFIX}_run_timestamp_seconds {data['start_time']:.3f}",
+            f"# HELP {PREFIX}_run_duration_seconds Duration of the last synchronization",
+            f"# TYPE {PREFIX}_run_duration_seconds gauge",
+            f"{PREFIX}_run_duration_seconds {data['duration'] or 0:.6f}",
+        ]
+        for metric, key, help_text in [
+            ("phase_duration_seconds", "seconds", "Time spent in each phase"),
+            ("phase_items", "items", "Number of items processed in each phase"),
+            ("phase_items_per_second", "items_per_second", "Items processed per second in each phase"),
+        ]:
+            lines.append(f"# HELP {PREFIX}_{metric} {help_text}")
+            lines.append(f"# TYPE {PREFIX}_{metric} gauge")
+            for name, phase in data["phases"].items():
+                lines.append(f'{PREFIX}_{metric}{{phase="{name}"}} {phase[key]:g}')
+        lines.append(f"# HELP {PREFIX}_api_calls Number of Mist API calls")
+        lines.append(f"# TYPE {PREFIX}_api_calls gauge")
+        for call in data["api_calls"]:
+            lines.append(
+                f'{PREFIX}_api_calls{{method="{call["method"]}",endpoint="{call["endpoint"]}",'
+                f'status="{call["status"]}"}} {call["count"]}'
+            )
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str, export_format: str = "prometheus"):
+        """
+        Save the metrics in `path`. The file is replaced atomically, so it
+        can be read by the Prometheus node exporter textfile collector at
+        any time
+        """
+        if not path:
+            return
+        try:
+            if export_format == "json":
+                content = json.dumps(self.to_dict(), indent=2)
+            else:
+                content = self.to_prometheus()
+            tmp_file = f"{path}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(content)
+            os.replace(tmp_file, path)
+            LOGGER.info(f"export:metrics saved in {path}")
+        except:
+            LOGGER.error("Unable to save the metrics", exc_info=True)
+
+
+METRICS = Metrics()
@@ -0,0 +1,99 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script writing the console output of the targets synchronized in parallel
+"""
+import contextlib
+import sys
+import threading
+
+
+class TargetOutput:
+    """
+    sys.stdout wrapper used when several targets are synchronized at the
+    same time. The text printed by a target thread is buffered until the end
+    of the line (e.g. a progress line and its result mark), and each line is
+    written at once, prefixed with the target name, so the lines of the
+    targets do not interleave. The text printed by the other threads is
+    written unchanged.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def target(self, name: str):
+        """
+        Prefix the lines printed by the current thread with the target `name`
+        """
+        self._local.prefix = f"[{name}] "
+        self._local.buffer = ""
+        try:
+            yield
+        finally:
+            if self._local.buffer:
+                self._write(self._local.prefix + self._local.buffer + "\n")
+            self._local.prefix = None
+            self._local.buffer = ""
+
+    @property
+    def prefix(self) -> str:
+        """
+        Prefix of the lines printed by the current thread
+        """
+        return getattr(self._local, "prefix", None) or ""
+
+    def write_line(self, line: str):
+        """
+        Write a complete line at once, whatever the thread
+        """
+        self._write(line + "\n")
+
+    def write(self, text: str):
+        prefix = getattr(self._local, "prefix", None)
+        if not prefix:
+            self._write(text)
+            return len(text)
+        *lines, self._local.buffer = (self._local.buffer + text).split("\n")
+        if lines:
+            self._write("".join(f"{prefix}{line}\n" if line else "\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        # the lines of the targets are only written when they are complete
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def _write(self, text: str):
+        with self._lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+
+def line_printer():
+    """
+    Return a function printing a complete line at once, prefixed with the
+    target of the calling thread. To be called by the target thread, and
+    used by the threads or the event loop working for the target (e.g. to
+    send the PSK emails), which are not prefixed by TargetOutput
+    """
+    stream = sys.stdout
+    prefix = stream.prefix if isinstance(stream, TargetOutput) else ""
+
+    def print_line(line: str):
+        if prefix:
+            stream.write_line(prefix + line)
+        else:
+            print(f"{line}\n", end="", flush=True)
+
+    return print_line
@@ -0,0 +1,78 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script generating the PSK passphrases
+"""
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class PassphraseGenerator:
+    """
+    Class generating unique random passphrases by batches.
+    The random bytes are read from the OS CSPRNG (os.urandom) in one buffer
+    per batch. To keep the same probability for each allowed character, the
+    bytes above the largest multiple of the number of characters are
+    rejected, and the other ones are mapped to the characters with
+    bytes.translate, so there is no Python loop per character.
+    The passphrases already used (e.g. the ones of the current inventory)
+    are kept in a set, and a new passphrase is never one of them.
+    """
+
+    def __init__(self, allowed_chars: str, length: int, used=None):
+        # the duplicated characters would be more likely than the other ones
+        self.chars = "".join(dict.fromkeys(allowed_chars))
+        if len(self.chars) < 2:
+            raise ValueError("at least 2 different characters are required")
+        if len(self.chars) > 256:
+            # each character is chosen with one random byte
+            raise ValueError("at most 256 different characters are allowed")
+        self.length = length
+        self.used = set(passphrase for passphrase in used or [] if passphrase)
+        count = len(self.chars)
+        limit = 256 - 256 % count
+        self._rejected = bytes(range(limit, 256))
+        self._ascii = all(ord(char) < 128 for char in self.chars)
+        if self._ascii:
+            self._table = bytes(ord(self.chars[byte % count]) for byte in range(256))
+
+    def generate(self, count: int) -> list:
+        """
+        Return `count` new passphrases
+        """
+        if len(self.used) + count > len(self.chars) ** self.length:
+            raise ValueError(
+                f"unable to generate {count} unique passphrases of {self.length} characters"
+            )
+        passphrases = []
+        while len(passphrases) < count:
+            chars = self._random_chars((count - len(passphrases)) * self.length)
+            for start in range(0, len(chars) - self.length + 1, self.length):
+                passphrase = chars[start : start + self.length]
+                if passphrase in self.used:
+                    LOGGER.debug("generate:passphrase already used, generating a new one")
+                    continue
+                self.used.add(passphrase)
+                passphrases.append(passphrase)
+        return passphrases
+
+    def _random_chars(self, count: int) -> str:
+        # with the rejection sampling, at least half of the bytes are kept
+        result = ""
+        while len(result) < count:
+            size = (count - len(result)) * 256 // (256 - len(self._rejected)) + 16
+            accepted = os.urandom(size).translate(None, self._rejected)
+            if self._ascii:
+                result += accepted.translate(self._table).decode("ascii")
+            else:
+                result += "".join(self.chars[byte % len(self.chars)] for byte in accepted)
+        return result[:count]
@@ -9,10 +9,19 @@
 -------------------------------------------------------------------------------
 Script managing the communication with the Mist Cloud
 """
-import random
 import logging
+import copy
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import mistapi
+from mist_ratelimit import ApiThrottle
+from mist_inventory import PskInventory
+from mist_cache import PskCache
+from mist_reconcile import normalize
+from mist_metrics import METRICS
+from mist_records import Psk
+from mist_passphrase import PassphraseGenerator
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
@@ -32,43 +41,288 @@ class Mist:
         self.psk_max_usage = config.get("psk_max_usage")
         self.allowed_chars = config.get("allowed_chars")
         self.excluded_psks = config.get("excluded_psks")
+        self.delete_workers = config.get("delete_workers", 1)
+        self.create_workers = config.get("create_workers", 1)
+        self.create_batch_size = config.get("create_batch_size", 100)
+        self.create_batch_min = config.get("create_batch_min", 10)
+        self.create_batch_max = config.get("create_batch_max", 500)
+        self.create_target_latency = config.get("create_target_latency", 10)
+        self.list_workers = config.get("list_workers", 1)
+        self.cache_file = config.get("cache_file")
+        self.cache_max_age = config.get("cache_max_age", 3600)
+        # shared by all the threads and targets
+        self.throttle = ApiThrottle(
+            rate=config.get("api_rate", 0),
+            hourly_quota=config.get("api_hourly_quota", 0),
+            max_concurrency=config.get("api_max_concurrency", 0),
+            retries=config.get("api_retries", 3),
+        )
         self.apisession = mistapi.APISession(
             host=config.get("host"), apitoken=config.get("api_token")
         )
+        self._login()
+
+    def _login(self):
+        """
+        Log in and configure the HTTP session. mistapi replaces the HTTP
+        session when logging in with login/password, so the response hooks
+        are attached again after each login
+        """
         self.apisession.login()
+        # the throttled requests are retried by the ApiThrottle, which shares
+        # the Retry-After pause with the other threads. mistapi must not retry
+        # them too (up to 4 attempts for each of the ApiThrottle ones)
+        self.apisession._MAX_429_RETRIES = 0
+        hooks = self.apisession._session.hooks["response"]
+        # count all the HTTP requests, and pause all the threads as soon as a
+        # request is throttled
+        for hook in [METRICS.api_response, self.throttle.response_hook]:
+            if hook not in hooks:
+                hooks.append(hook)
 
-    def _get_random_alphanumeric_string(self):
-        result_str = "".join(
-            (random.choice(self.allowed_chars) for i in range(self.psk_length))
-        )
-        return result_str
+    def check_session(self):
+        """
+        Check the API session is still valid, and log in again if not.
+        Used in daemon mode, where the session is kept between the runs
+        """
+        try:
+            response = self.throttle.call(mistapi.api.v1.self.self.getSelf, self.apisession)
+            if response.status_code == 200:
+                LOGGER.debug("check_session:session is valid")
+                return True
+            LOGGER.warning(f"check_session:got HTTP {response.status_code}. Logging in again")
+        except:
+            LOGGER.warning("check_session:session check failed. Logging in again", exc_info=True)
+        # mistapi does not log in again while the session is flagged as authenticated
+        self.apisession._authenticated = False
+        self._login()
+        return False
 
-    def get_users(self, mist_user_list:list=[]):
+    def for_target(self, scope: str, scope_id: str, ssid: str):
+        """
+        Return a copy of this object for another scope/SSID. The copy
+        shares the API session and the rate limiter
+        """
+        target = copy.copy(self)
+        target.scope = scope
+        target.scope_id = scope_id
+        target.ssid = ssid
+        return target
+
+    def _get_passphrase_generator(self, inventory: PskInventory = None):
+        used = None
+        if inventory is not None:
+            used = [psk.passphrase for psk in inventory.psks()]
+        return PassphraseGenerator(self.allowed_chars, self.psk_length, used)
+
+    def get_inventory(self, offline: bool = False, psks: list = None):
+        """
+        Request the list of PSKs and return it as a PskInventory.
+        If the cache is enabled, the cached PSKs are used as long as the
+        cache is not older than `cache_max_age` and the number of PSKs in
+        the Mist Cloud did not change. With `offline`, the cached PSKs are
+        used without requesting the Mist Cloud.
+        The validation of the cache is best-effort: the PSK list can not be
+        filtered or sorted by modification time, so a PSK deleted in the Mist
+        Cloud while another one was created is only detected if it is on a
+        sampled page (see `_sample_ppks`), or at the next full reload.
+        With `psks` (when a run is resumed), the inventory only contains
+        these PSKs and the list is not requested.
+        """
         print(f"Requesting the list of PSKs ".ljust(79, "."), end="", flush=True)
         LOGGER.info(f"Requesting the list of PSKs")
         try:
-            psks = self.get_ppks()
-            for psk in psks:
-                mist_user_list.append({"name": psk["name"], "id": psk["id"]})
+            cache = None
+            if self.cache_file:
+                cache = PskCache(self.cache_file, self.scope, self.scope_id, self.ssid)
+                if psks is None:
+                    psks = self._load_cache(cache, offline)
+            if psks is None:
+                psks = self.get_ppks()
+                if cache:
+                    cache.save_all(psks)
+            inventory = PskInventory(psks, cache)
             print("\033[92m\u2714\033[0m")
-            LOGGER.info(f"Got {len(mist_user_list)} users")
-            return mist_user_list
+            LOGGER.info(f"Got {len(inventory)} psks")
+            return inventory
         except:
             print("\033[31m\u2716\033[0m")
             LOGGER.critical("Exception occurred", exc_info=True)
             sys.exit(2)
 
+    def _load_cache(self, cache: PskCache, offline: bool = False):
+        age = cache.age()
+        if age is None:
+            LOGGER.info("_load_cache:no cached psks. full reload required")
+            return None
+        if age > self.cache_max_age:
+            LOGGER.info(f"_load_cache:cache is {int(age)}s old. full reload required")
+            return None
+        psks = cache.load()
+        if offline:
+            LOGGER.info(f"_load_cache:offline mode, using {len(psks)} cached psks")
+            return psks
+        sample = self._sample_ppks()
+        if sample is None:
+            LOGGER.info("_load_cache:unable to get the number of psks. full reload required")
+            return None
+        total, sampled_psks = sample
+        if total != len(psks):
+            LOGGER.info(f"_load_cache:{total} psks in Mist, {len(psks)} in cache. full reload required")
+            return None
+        if not self._check_sample(psks, sampled_psks):
+            return None
+        if not self._resolve_ppsk_ids(cache, psks):
+            return None
+        LOGGER.info(f"_load_cache:using {len(psks)} cached psks")
+        return psks
+
+    def _sample_ppks(self, limit: int = 100):
+        """
+        Return the number of PSKs in the Mist Cloud and the PSKs of the first
+        and the last pages, or None if the number of PSKs is unknown. The
+        PSKs re-created since the cache was saved are usually on the last
+        page, but the order of the list is not guaranteed by the API
+        """
+        response = self._list_ppks_page(1, limit)
+        if response.status_code != 200 or not response.headers:
+            return None
+        total = response.headers.get("X-Page-Total")
+        if total is None:
+            return None
+        total = int(total)
+        psks = list(response.data)
+        last_page = -(-total // limit)
+        if last_page > 1:
+            response = self._list_ppks_page(last_page, limit)
+            if response.status_code != 200:
+                return None
+            psks += response.data
+        return total, psks
+
+    def _check_sample(self, psks: list, sampled_psks: list):
+        """
+        Check the sampled PSKs are in the cache with the same name and
+        passphrase, so a PSK deleted and re-created, or a passphrase changed,
+        is detected even if the number of PSKs did not change
+        """
+        by_id = {psk.id: psk for psk in psks if psk.id}
+        # the PSKs created with the import API are cached without their id
+        without_id = {(psk.name, psk.passphrase) for psk in psks if not psk.id}
+        for psk in sampled_psks:
+            cached = by_id.get(psk.get("id"))
+            if cached:
+                changed = cached.name != psk.get("name") or cached.passphrase != psk.get("passphrase")
+            else:
+                changed = (psk.get("name"), psk.get("passphrase")) not in without_id
+            if changed:
+                LOGGER.info(f"_check_sample:psk {psk.get('name')} changed in Mist. full reload required")
+                return False
+        return True
+
+    def refresh_ppsks(self, inventory: PskInventory, names: list):
+        """
+        Replace the PSKs of the users `names` in the inventory with the ones
+        currently in the Mist Cloud. Used before emailing the passphrases of
+        PSKs loaded from the cache, as a passphrase may have been changed in
+        the Mist Cloud since the cache was saved
+        """
+        names = [name for name in dict.fromkeys(names) if "," not in name]
+        for start in range(0, len(names), 100):
+            batch = names[start : start + 100]
+            found = {}
+            for page in self._iter_ppks_pages(name=",".join(batch)):
+                for psk in page:
+                    found.setdefault(normalize(psk.get("name")), []).append(psk)
+            for name in batch:
+                inventory.replace(name, found.get(normalize(name), []))
+        inventory.commit()
+
+    def _resolve_ppsk_ids(self, cache: PskCache, psks: list):
+        # the PSKs created with the import API are cached without their id
+        missing = {psk.name: psk for psk in psks if not psk.id}
+        names = list(missing)
+        for start in range(0, len(names), 100):
+            batch = [name for name in names[start : start + 100] if "," not in name]
+            if not batch:
+                continue
+            for page in self._iter_ppks_pages(name=",".join(batch)):
+                for psk in page:
+                    if psk.get("name") in missing:
+                        missing.pop(psk["name"]).id = psk["id"]
+                        cache.set_id(psk["name"], psk["id"])
+        cache.commit()
+        if missing:
+            LOGGER.info(f"_resolve_ppsk_ids:{len(missing)} cached psks not found. full reload required")
+            return False
+        return True
+
     def get_ppks(self):
+        data = []
+        for page in self.iter_ppks():
+            data += [Psk.from_dict(psk) for psk in page]
+        return data
+
+    def iter_ppks(self):
+        """
+        Generator returning the PSKs page by page, in order.
+        The first page gives the total number of PSKs, then the next pages
+        are requested by `list_workers` threads at the same time.
+        """
+        limit = 1000
+        response = self._list_ppks_page(1, limit)
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.data}")
+        total = response.headers.get("X-Page-Total") if response.headers else None
+        if total is None:
+            # no pagination information, the next pages are requested one by one
+            yield response.data
+            if len(response.data) >= limit:
+                yield from self._iter_ppks_pages(limit, start=2)
+            return
+        yield response.data
+        pages = range(2, -(-int(total) // limit) + 1)
+        if not pages:
+            return
+        LOGGER.debug(f"iter_ppks:{total} psks, requesting {len(pages)} more pages")
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            for response in executor.map(lambda page: self._list_ppks_page(page, limit), pages):
+                if response.status_code != 200:
+                    raise Exception(f"HTTP {response.status_code}: {response.data}")
+                yield response.data
+
+    def _iter_ppks_pages(self, limit: int = 1000, name: str = None, start: int = 1):
+        """
+        Generator returning the PSKs page by page, starting at page `start`.
+        Used instead of mistapi.get_all, as the mistapi retries of the
+        throttled requests are disabled: each page goes through the throttle
+        and its status is checked
+        """
+        page = start
+        while True:
+            response = self._list_ppks_page(page, limit, name)
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}: {response.data}")
+            yield response.data
+            total = response.headers.get("X-Page-Total") if response.headers else None
+            if total is not None:
+                if page * limit >= int(total):
+                    return
+            elif len(response.data) < limit:
+                return
+            page += 1
+
+    def _list_ppks_page(self, page: int, limit: int, name: str = None):
         if self.scope == "orgs":
-            response = mistapi.api.v1.orgs.psks.listOrgPsks(
-                self.apisession, self.scope_id, ssid=self.ssid, limit=1000
+            return self.throttle.call(
+                mistapi.api.v1.orgs.psks.listOrgPsks,
+                self.apisession, self.scope_id, name=name, ssid=self.ssid, limit=limit, page=page
             )
         else:
-            response = mistapi.api.v1.sites.psks.listSitePsks(
-                self.apisession, self.scope_id, ssid=self.ssid,limit=1000
+            return self.throttle.call(
+                mistapi.api.v1.sites.psks.listSitePsks,
+                self.apisession, self.scope_id, name=name, ssid=self.ssid, limit=limit, page=page
             )
-        data = mistapi.get_all(self.apisession, response)
-        return data
 
     def delete_ppsk(self, psk_id, dry_run: bool = False):
         LOGGER.debug(f"deleting psk with id {psk_id}")
@@ -76,42 +330,133 @@ class Mist:
             LOGGER.info("dry run mode... I'm not deleting the psk")
             return True
         else:
-            if self.scope == "orgs":
-                response = mistapi.api.v1.orgs.psks.deleteOrgPsk(
-                    self.apisession, self.scope_id, psk_id
-                ).data
-            else:
-                response = mistapi.api.v1.sites.psks.listSitePsks(
-                    self.apisession, self.scope_id, psk_id
-                ).data
-            return response
+            return self._delete_ppsk_request(psk_id).data
 
-    def create_ppsk(self, user, dry_run: bool = False):
+    def delete_user_ppsks(self, name: str, dry_run: bool = False):
+        """
+        Delete the PSKs of a single user, without requesting the whole PSK
+        list. Used to deprovision a user as soon as the LDAP change is
+        received. Returns a dict with the result of the deletion for each
+        psk_id.
+        """
+        if "," in name:
+            # the name filter of the Mist API is a comma separated list
+            LOGGER.warning(f"delete_user_ppsks:unable to filter the psks on name {name}")
+            return {}
+        psk_ids = [
+            psk["id"]
+            for page in self._iter_ppks_pages(name=name)
+            for psk in page
+            if normalize(psk.get("name")) == normalize(name)
+        ]
+        LOGGER.debug(f"delete_user_ppsks:{len(psk_ids)} psks found for user {name}")
+        results = self.delete_ppsks(psk_ids, dry_run)
+        if self.cache_file and not dry_run:
+            cache = PskCache(self.cache_file, self.scope, self.scope_id, self.ssid)
+            for psk_id, deleted in results.items():
+                if deleted:
+                    cache.remove(psk_id)
+            cache.close()
+        return results
+
+    def delete_ppsks(self, psk_ids: list, dry_run: bool = False, on_deleted=None):
+        """
+        Delete a list of PSKs and return a dict with the result of the
+        deletion for each psk_id.
+        At the org level, the PSKs are first deleted in batches with the
+        bulk delete API. The PSKs that could not be deleted this way (and
+        all the PSKs at the site level) are deleted one by one by
+        `delete_workers` threads sharing the same rate limiter.
+        `on_deleted(psk_ids)` is called as soon as PSKs are deleted.
+        """
+        if dry_run:
+            LOGGER.info("delete_ppsks:dry run mode... I'm not deleting the psks")
+            return {psk_id: True for psk_id in psk_ids}
+        results = {}
+        remaining = psk_ids
+        if self.scope == "orgs":
+            remaining = []
+            batch_size = 100
+            for start in range(0, len(psk_ids), batch_size):
+                batch = psk_ids[start : start + batch_size]
+                LOGGER.debug(f"delete_ppsks:bulk deleting psks {start} to {start + len(batch)}")
+                try:
+                    response = self.throttle.call(
+                        mistapi.api.v1.orgs.psks.deleteOrgPskList,
+                        self.apisession, self.scope_id, {"psk_ids": batch}
+                    )
+                    deleted = response.status_code == 200
+                except:
+                    LOGGER.error("Exception occurred", exc_info=True)
+                    deleted = False
+                if deleted:
+                    for psk_id in batch:
+                        results[psk_id] = True
+                    if on_deleted:
+                        on_deleted(batch)
+                else:
+                    LOGGER.warning("delete_ppsks:bulk delete failed. Will delete the psks one by one")
+                    remaining += batch
+
+        with ThreadPoolExecutor(max_workers=self.delete_workers) as executor:
+            futures = {
+                executor.submit(self._delete_ppsk_request, psk_id): psk_id
+                for psk_id in remaining
+            }
+            for future in as_completed(futures):
+                psk_id = futures[future]
+                try:
+                    results[psk_id] = future.result().status_code == 200
+                except:
+                    LOGGER.error("Exception occurred", exc_info=True)
+                    results[psk_id] = False
+                if not results[psk_id]:
+                    LOGGER.error(f"delete_ppsks:unable to delete psk id {psk_id}")
+                elif on_deleted:
+                    on_deleted([psk_id])
+        return results
+
+    def _delete_ppsk_request(self, psk_id):
+        if self.scope == "orgs":
+            return self.throttle.call(
+                mistapi.api.v1.orgs.psks.deleteOrgPsk,
+                self.apisession, self.scope_id, psk_id
+            )
+        else:
+            return self.throttle.call(
+                mistapi.api.v1.sites.psks.deleteSitePsk,
+                self.apisession, self.scope_id, psk_id
+            )
+
+    def create_ppsk(self, user, dry_run: bool = False, inventory: PskInventory = None):
         print(" Creating the PPSK for user ".ljust(79, "."), end="", flush=True)
-        psk = self._get_random_alphanumeric_string()
+        # the passphrases of the `inventory` PSKs are not reused
+        psk = self._get_passphrase_generator(inventory).generate(1)[0]
         psk_data = {
             "usage": "multi",
-            "name": user["name"],
-            "email": user.get("email"),
+            "name": user.name,
+            "email": user.email,
             "ssid": self.ssid,
             "vlan_id": self.psk_vlan,
             "passphrase": psk,
             "max_usage": self.psk_max_usage,
         }
         try:
-            LOGGER.debug(f"creating psk for user {user['name']}")
+            LOGGER.debug(f"creating psk for user {user.name}")
             if dry_run:
                 response = psk_data                
                 response["id"] = 1
                 LOGGER.info("dry run mode... I'm not creating the psk")
             else:
                 if self.scope == "orgs":
-                    response = mistapi.api.v1.orgs.psks.createOrgPsk(
-                        self.apisession, self.scope_id, psk_data
+                    response = self.throttle.call(
+                        mistapi.api.v1.orgs.psks.createOrgPsk,
+                        self.apisession, self.scope_id, psk_data, idempotent=False
                     ).data
                 else:
-                    response = mistapi.api.v1.sites.psks.createSitePsk(
-                        self.apisession, self.scope_id, psk_data
+                    response = self.throttle.call(
+                        mistapi.api.v1.sites.psks.createSitePsk,
+                        self.apisession, self.scope_id, psk_data, idempotent=False
                     ).data
 
             LOGGER.debug(response)
@@ -132,90 +477,159 @@ class Mist:
             LOGGER.critical("Exception occurred", exc_info=True)
             return None
 
-    def create_ppsk_bulk(self, users, dry_run: bool = False):
+    def create_ppsk_bulk(self, users, dry_run: bool = False, inventory: PskInventory = None, on_created=None):
+        """
+        Create the PSKs with the import API.
+        Up to `create_workers` batches are sent at the same time, and the
+        payload of the next batch is built while the previous ones are
+        processed by the Mist Cloud. The batch size is adjusted after each
+        response: it is increased while the batches are created without
+        errors within `create_target_latency` seconds, and halved otherwise.
+        The created PSKs are added to the `inventory`, if provided, and
+        `on_created(psks)` is called with the PSKs created by each batch.
+        """
         if dry_run:
             dry_run_string = "DRY RUN - "
         else:
             dry_run_string = ""
         stop_index = len(users)
-        run = 0
-        batch_size = 100
-        while run * batch_size < stop_index:
-            user_names = []
-            run += 1
-            start = (run - 1) * batch_size
-            stop = run * batch_size
-            psks_to_create = users[ start : stop ]
-            psks_data = []
-            print()
-            print(
-                    f" {dry_run_string}BATCH {start} "
-                    f"to {stop} ".center(79, "-")
-                )
-            for user in psks_to_create:
-                LOGGER.debug(
-                        f"create_ppsk_bulk:create_ppsk_bulk:"
-                        f"creating psk for user {user['name']}"
-                    )
-                passphrase = self._get_random_alphanumeric_string()
-                psk = {
-                    "usage": "multi",
-                    "name": user["name"],
-                    "email": user.get("email"),
-                    "ssid": self.ssid,
-                    "vlan_id": self.psk_vlan,
-                    "passphrase": passphrase,
-                    "max_usage": self.psk_max_usage,
-                    "notify_on_create_or_edit": self.psk_email,
-                }
-                psks_data.append(psk)
-                user_names.append(user["name"])
-            try:
-                print(
-                        f"sending request for psk batch "
-                        f"{start} to {stop} "
-                        .ljust(79, "."), end="", flush=True
-                    )
-                LOGGER.debug(
+        start = 0
+        batch_size = self.create_batch_size
+        in_flight = {}
+        # the new passphrases are different from the ones of the inventory
+        generator = self._get_passphrase_generator(inventory)
+        with ThreadPoolExecutor(max_workers=self.create_workers) as executor:
+            while start < stop_index or in_flight:
+                while start < stop_index and len(in_flight) < self.create_workers:
+                    stop = min(start + batch_size, stop_index)
+                    psks_to_create = users[start:stop]
+                    passphrases = generator.generate(len(psks_to_create))
+                    psks_data = [
+                        self._build_ppsk(user, passphrase)
+                        for user, passphrase in zip(psks_to_create, passphrases)
+                    ]
+                    LOGGER.debug(
                         f"create_ppsk_bulk:sending request for psk batch "
                         f"{start} to {stop}"
+                    )
+                    future = self._submit_import(executor, psks_data, dry_run)
+                    in_flight[future] = (start, stop, psks_to_create, psks_data)
+                    start = stop
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_start, batch_stop, psks_to_create, psks_data = in_flight.pop(future)
+                    print()
+                    print(
+                            f" {dry_run_string}BATCH {batch_start} "
+                            f"to {batch_stop} ".center(79, "-")
+                        )
+                    elapsed = self._process_ppsk_batch(
+                        future, batch_start, batch_stop, psks_to_create, psks_data, inventory, on_created
+                    )
+                    batch_size = self._adapt_batch_size(batch_size, elapsed)
+
+        return users
+
+    def _build_ppsk(self, user, passphrase: str):
+        LOGGER.debug(
+                f"create_ppsk_bulk:create_ppsk_bulk:"
+                f"creating psk for user {user.name}"
+            )
+        return {
+            "usage": "multi",
+            "name": user.name,
+            "email": user.email,
+            "ssid": self.ssid,
+            "vlan_id": self.psk_vlan,
+            "passphrase": passphrase,
+            "max_usage": self.psk_max_usage,
+            "notify_on_create_or_edit": self.psk_email,
+        }
+
+    def _submit_import(self, executor, psks_data, dry_run: bool = False):
+        """
+        Start the import of a batch and return its future. The batch
+        results are processed by the calling thread
+        """
+        return executor.submit(self._import_ppsks, psks_data, dry_run)
+
+    def _import_ppsks(self, psks_data, dry_run: bool = False):
+        if dry_run:
+            LOGGER.info("create_ppsk_bulk:dry run mode... I'm not creating the psks")
+            return {"updated":[],"errors":[]}, 0
+        start = time.monotonic()
+        # the import creates or updates the PSKs by name, with the name and
+        # the passphrase generated before the request: replaying a batch
+        # after a failure creates no duplicate
+        if self.scope == "orgs":
+            response = self.throttle.call(
+                mistapi.api.v1.orgs.psks.importOrgPsks,
+                self.apisession, self.scope_id, psks_data, idempotent=True
+            )
+        else:
+            response = self.throttle.call(
+                mistapi.api.v1.sites.psks.importSitePsks,
+                self.apisession, self.scope_id, psks_data, idempotent=True
+            )
+        elapsed = time.monotonic() - start
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.data}")
+        return response.data, elapsed
+
+    def _process_ppsk_batch(self, future, start, stop, psks_to_create, psks_data, inventory, on_created=None):
+        """
+        Update the users with the batch result and return the request
+        duration, or None if the batch failed
+        """
+        print(
+                f"sending request for psk batch "
+                f"{start} to {stop} "
+                .ljust(79, "."), end="", flush=True
+            )
+        try:
+            response, elapsed = future.result()
+        except:
+            print("\033[31m\u2716\033[0m")
+            LOGGER.critical("Exception occurred", exc_info=True)
+            return None
+        print("\033[92m\u2714\033[0m")
+        LOGGER.debug(response)
+        LOGGER.debug(f"create_ppsk_bulk:batch {start} to {stop} processed in {elapsed:.2f}s")
+        METRICS.count("create_batches")
+        METRICS.count("create_batch_seconds", elapsed)
+        for error in response.get("errors", []):
+            LOGGER.error(f"create_ppsk_bulk:{error}")
+        updated = set(response.get("updated", []))
+        if on_created:
+            on_created([psk for psk in psks_data if psk["name"] in updated])
+        for user, psk in zip(psks_to_create, psks_data):
+            print(
+                    f"Checking PPSK creation for user {user.name} "
+                    .ljust(79, "."), end="", flush=True
                 )
-                if dry_run:
-                    response = {"updated":[],"errors":[]}
-                    LOGGER.info("create_ppsk_bulk:dry run mode... I'm not creating the psks")
-                else:
-                    if self.scope == "orgs":
-                        response = mistapi.api.v1.orgs.psks.importOrgPsks(
-                            self.apisession, self.scope_id, psks_data
-                        ).data
-                    else:
-                        response = mistapi.api.v1.sites.psks.importSitePsks(
-                            self.apisession, self.scope_id, psks_data
-                        ).data
+            if user.name in updated:
+                user.psk_added = True
+                if inventory is not None:
+                    # the import response only contains the names, the id is unknown
+                    inventory.add(psk)
+                if self.psk_email:
+                    user.email_sent = True
+
                 print("\033[92m\u2714\033[0m")
-                LOGGER.debug(response)
-                for error in response.get("errors", []):
-                    LOGGER.error(f"create_ppsk_bulk:{error}")
-                for user in users:
-                    if user["name"] in user_names:
-                        print(
-                                f"Checking PPSK creation for user {user['name']} "
-                                .ljust(79, "."), end="", flush=True
-                            )
-                        if user["name"] in response["updated"]:
-                            user["psk_added"] = True
-                            if self.psk_email:
-                                user["email_sent"] = True
-
-                            print("\033[92m\u2714\033[0m")
-                            LOGGER.info(f"create_ppsk_bulk:psk {user['name']} created")
-                        else:
-                            print("\033[31m\u2716\033[0m")
-                            LOGGER.error(f"create_ppsk_bulk:psk {user['name']} not created")
-                            LOGGER.error("Exception occurred", exc_info=True)
-
-            except:
+                LOGGER.info(f"create_ppsk_bulk:psk {user.name} created")
+            else:
                 print("\033[31m\u2716\033[0m")
-                LOGGER.critical("Exception occurred", exc_info=True)
+                LOGGER.error(f"create_ppsk_bulk:psk {user.name} not created")
+        if response.get("errors"):
+            return None
+        return elapsed
 
-        return users
+    def _adapt_batch_size(self, batch_size, elapsed):
+        if elapsed is None or elapsed > self.create_target_latency:
+            new_batch_size = max(self.create_batch_min, batch_size // 2)
+        else:
+            new_batch_size = min(self.create_batch_max, batch_size + max(1, batch_size // 4))
+        if new_batch_size != batch_size:
+            LOGGER.debug(f"create_ppsk_bulk:batch size changed from {batch_size} to {new_batch_size}")
+        return new_batch_size
@@ -1,27 +1,38 @@
+from io import BytesIO
 import qrcode
 
-def get_qrcode(ssid, psk):
+def _get_qrcode(ssid, psk, box_size=10):
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
+        box_size=box_size,
         border=4,
     )
-    
+
     qr.add_data("WIFI:S:{0};T:WPA;P:{1};;".format(ssid, psk))
     qr.make(fit=True)
-    return qr.get_matrix()
+    return qr
+
+def get_qrcode(ssid, psk):
+    return _get_qrcode(ssid, psk).get_matrix()
 
+# the QRCodes are not cached: each passphrase is only rendered once, and the
+# cache would keep the passphrases in memory
 def get_qrcode_as_html(ssid, psk):
     qr = get_qrcode(ssid, psk)
-    qr_html = ""
     fg_color = "#eee"
     bg_color = "black"
-    for i in qr:
-        qr_html+="<tr>"
-        for j in i:
-            if j: color = bg_color
-            else: color = fg_color
-            qr_html +="<td style=\"background-color:{0}; height:5px; width: 5px; padding: 0px; margin: 0px\"></td>\r\n".format(color)
-        qr_html+="</tr>\r\n"
-    return qr_html
\ No newline at end of file
+    cells = {
+        color: "<td style=\"background-color:{0}; height:5px; width: 5px; padding: 0px; margin: 0px\"></td>\r\n".format(color)
+        for color in (fg_color, bg_color)
+    }
+    return "".join(
+        "<tr>" + "".join(cells[bg_color] if j else cells[fg_color] for j in i) + "</tr>\r\n"
+        for i in qr
+    )
+
+def get_qrcode_as_png(ssid, psk):
+    img = _get_qrcode(ssid, psk, box_size=4).make_image(fill_color="black", back_color="white")
+    data = BytesIO()
+    img.save(data, format="PNG", optimize=True)
+    return data.getvalue()
@@ -0,0 +1,253 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the rate of the requests sent to the Mist Cloud
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from mist_metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket shared by all the threads sending requests to
+    the Mist Cloud. `rate` is the number of requests per second (0 to
+    disable the limit) and `burst` the number of requests that can be sent
+    at once.
+    """
+
+    def __init__(self, rate: float = 0, burst: int = None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+        """
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return
+            LOGGER.debug(f"acquire:rate limit reached, waiting {wait:.3f}s")
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """
+        Same as `acquire`, without blocking the event loop
+        """
+        while True:
+            wait = self._reserve()
+            if not wait:
+                return
+            LOGGER.debug(f"acquire_async:rate limit reached, waiting {wait:.3f}s")
+            await asyncio.sleep(wait)
+
+    def _reserve(self):
+        """
+        Take a token and return 0, or return the time to wait for the next one
+        """
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class ApiThrottle:
+    """
+    Class wrapped around all the requests sent to the Mist Cloud, and shared
+    by all the threads and targets:
+    - the requests go through the `rate` token bucket (requests per second)
+      and, if `hourly_quota` is set, through a second token bucket refilled
+      with `hourly_quota` requests per hour,
+    - at most `max_concurrency` requests are sent at the same time. This
+      limit is halved when a request is throttled or fails, and increased
+      again after successful requests (AIMD),
+    - when a HTTP 429 is received (including the ones retried by mistapi),
+      all the threads wait for the Retry-After delay,
+    - the throttled requests are retried up to `retries` times, and the
+      requests failing with a server or connection error are retried only
+      if they are idempotent.
+    """
+
+    def __init__(
+        self,
+        rate: float = 0,
+        hourly_quota: int = 0,
+        max_concurrency: int = 0,
+        retries: int = 3,
+        default_retry_after: float = 5,
+    ):
+        self.limiters = [RateLimiter(rate)]
+        if hourly_quota:
+            # up to one minute of the quota can be sent at once
+            self.limiters.append(
+                RateLimiter(hourly_quota / 3600, burst=max(1, hourly_quota // 60))
+            )
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.retries = retries
+        self.default_retry_after = default_retry_after
+        self._in_flight = 0
+        self._successes = 0
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+    def call(self, function, *args, idempotent: bool = True, **kwargs):
+        """
+        Call the mistapi `function` and return its response. The throttled
+        requests are retried, as they were not processed by the Mist Cloud
+        """
+        attempt = 0
+        while True:
+            self._wait_pause()
+            for limiter in self.limiters:
+                limiter.acquire()
+            self._enter()
+            try:
+                response = function(*args, **kwargs)
+            finally:
+                self._exit()
+            delay = self._check(response, attempt, idempotent)
+            if delay is None:
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, function, *args, idempotent: bool = True, slot=None, **kwargs):
+        """
+        Same as `call` for the coroutine `function`. The number of requests
+        sent at the same time is limited by the `slot` of the caller (e.g. an
+        asyncio.Semaphore, as the event loop can not wait for the other
+        threads). The slot is acquired before the rate limit tokens, so the
+        requests waiting for a slot do not hold tokens. The throttled and
+        failed requests still reduce the concurrency of the threads
+        """
+        attempt = 0
+        while True:
+            async with slot or contextlib.nullcontext():
+                wait = self._pause_remaining()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self._pause_remaining()
+                for limiter in self.limiters:
+                    await limiter.acquire_async()
+                response = await function(*args, **kwargs)
+            delay = self._check(response, attempt, idempotent)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _check(self, response, attempt: int, idempotent: bool):
+        """
+        Return None if the `response` is final, or the time to wait before
+        retrying the request
+        """
+        status = response.status_code
+        if status == 429:
+            self._pause(self._retry_after(response))
+            self._failed()
+            # the pause is waited before the next attempt
+            delay = 0
+        elif status is None or status >= 500:
+            self._failed()
+            if not idempotent:
+                return None
+            # connection or server error: exponential backoff for this request only
+            delay = 2**attempt
+            if attempt < self.retries:
+                LOGGER.warning(f"call:got HTTP {status}, retrying in {delay}s")
+        else:
+            self._succeeded()
+            return None
+        if attempt >= self.retries:
+            LOGGER.error(f"call:request failed after {self.retries} retries")
+            METRICS.count("api_retries_exhausted")
+            return None
+        LOGGER.info(f"call:retrying request (attempt {attempt + 1}/{self.retries})")
+        METRICS.count("api_retries_throttled" if status == 429 else "api_retries_failed")
+        return delay
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook pausing all the threads as soon as a request
+        is throttled, including the requests retried by mistapi
+        """
+        if response.status_code == 429:
+            self._pause(self._retry_after(response))
+
+    def _pause(self, delay: float):
+        with self._condition:
+            until = time.monotonic() + delay
+            if until > self._paused_until:
+                LOGGER.warning(f"_pause:HTTP 429 received, pausing the requests for {delay}s")
+                self._paused_until = until
+
+    def _retry_after(self, response):
+        try:
+            return max(0, float(response.headers.get("Retry-After")))
+        except:
+            return self.default_retry_after
+
+    def _pause_remaining(self):
+        with self._condition:
+            return self._paused_until - time.monotonic()
+
+    def _wait_pause(self):
+        while True:
+            wait = self._pause_remaining()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _enter(self):
+        with self._condition:
+            while self.concurrency and self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _exit(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _failed(self):
+        with self._condition:
+            self._successes = 0
+            if self.concurrency > 1:
+                self.concurrency = max(1, self.concurrency // 2)
+                LOGGER.debug(f"_failed:concurrency reduced to {self.concurrency}")
+
+    def _succeeded(self):
+        with self._condition:
+            if not self.max_concurrency or self.concurrency >= self.max_concurrency:
+                return
+            self._successes += 1
+            if self._successes >= self.concurrency:
+                self._successes = 0
+                self.concurrency += 1
+                LOGGER.debug(f"_succeeded:concurrency increased to {self.concurrency}")
+                self._condition.notify_all()
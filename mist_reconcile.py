@@ -0,0 +1,78 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script computing the differences between the LDAP users and the Mist PSKs
+"""
+import logging
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+def normalize(name) -> str:
+    """
+    Return the key used to match a LDAP user with a Mist PSK
+    """
+    if not name:
+        return ""
+    return str(name).lower()
+
+
+class MistReconcile:
+    """
+    Class indexing the LDAP users and the Mist PSKs by normalized name and
+    splitting them into the PSKs to create, to delete and the unchanged ones.
+    Each list is read once, so the cost is linear in the number of entries.
+    """
+
+    def __init__(self, ldap_user_list, mist_user_list):
+        self.ldap_index = {}
+        self.mist_index = {}
+        self.to_create = []
+        self.to_delete = []
+        self.unchanged = []
+        self._index_ldap(ldap_user_list)
+        self._index_mist(mist_user_list)
+        self._diff()
+        LOGGER.info(
+            f"reconcile:{len(self.to_create)} to create, "
+            f"{len(self.to_delete)} to delete, "
+            f"{len(self.unchanged)} unchanged"
+        )
+
+    def _index_ldap(self, ldap_user_list):
+        for user in ldap_user_list:
+            key = user.key
+            if not key:
+                continue
+            if key in self.ldap_index:
+                LOGGER.warning(f"reconcile:duplicate LDAP user {user.name}")
+            else:
+                self.ldap_index[key] = user
+
+    def _index_mist(self, mist_user_list):
+        # several PSKs may share the same name, so keep all of them
+        for psk in mist_user_list:
+            self.mist_index.setdefault(psk.key, []).append(psk)
+
+    def _diff(self):
+        for key, user in self.ldap_index.items():
+            if key in self.mist_index:
+                self.unchanged.append(user)
+            else:
+                self.to_create.append(user)
+        for key, psks in self.mist_index.items():
+            if key not in self.ldap_index:
+                self.to_delete.extend(psks)
+
+    def ldap_users(self):
+        """
+        Return the LDAP users (deduplicated, in the LDAP order)
+        """
+        return list(self.ldap_index.values())
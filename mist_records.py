@@ -0,0 +1,107 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script defining the records used to store the LDAP users and the Mist PSKs
+"""
+import sys
+from mist_reconcile import normalize
+
+
+def _key(name):
+    # most of the names are already normalized, so the key shares their string
+    key = normalize(name)
+    return name if key == name else key
+
+
+class Record:
+    """
+    Base class of the records. The records use __slots__ instead of a
+    __dict__, so each one only stores its values and not the field names,
+    which saves several hundred MB with hundreds of thousands of users.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.FIELDS)
+        return f"{type(self).__name__}({values})"
+
+
+class LdapUser(Record):
+    """
+    User retrieved from LDAP. `key` is the normalized name used to match
+    the user with the Mist PSKs
+    """
+
+    __slots__ = ("name", "email", "key")
+    FIELDS = ("name", "email")
+
+    def __init__(self, name: str, email: str = ""):
+        self.name = name
+        self.email = email or ""
+        self.key = _key(name)
+
+
+class Psk(Record):
+    """
+    PSK retrieved from the Mist Cloud. Only the fields used by the script
+    are kept. The SSID and VLAN values are shared by most of the PSKs, so
+    they are interned
+    """
+
+    __slots__ = ("id", "name", "passphrase", "ssid", "email", "vlan_id", "key")
+    FIELDS = ("id", "name", "passphrase", "ssid", "email", "vlan_id")
+
+    def __init__(self, id=None, name=None, passphrase=None, ssid=None, email=None, vlan_id=None):
+        self.id = id
+        self.name = name
+        self.passphrase = passphrase
+        self.ssid = sys.intern(ssid) if isinstance(ssid, str) else ssid
+        self.email = email
+        self.vlan_id = sys.intern(vlan_id) if isinstance(vlan_id, str) else vlan_id
+        self.key = _key(name)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{field: data.get(field) for field in cls.FIELDS})
+
+
+class UserReport(Record):
+    """
+    Result of the PSK creation and of the email for a LDAP user
+    """
+
+    __slots__ = ("name", "email", "psk_added", "email_sent", "target", "key")
+    FIELDS = ("name", "email", "psk_added", "email_sent", "target")
+
+    def __init__(self, name: str, email: str = "", psk_added: bool = False, email_sent: bool = False):
+        self.name = name
+        self.email = email or ""
+        self.psk_added = psk_added
+        self.email_sent = email_sent
+        self.target = None
+        self.key = _key(name)
+
+
+class DeleteReport(Record):
+    """
+    Result of the deletion of a PSK
+    """
+
+    __slots__ = ("name", "psk_deleted", "target")
+    FIELDS = ("name", "psk_deleted", "target")
+
+    def __init__(self, name: str, psk_deleted: bool = False):
+        self.name = name
+        self.psk_deleted = psk_deleted
+        self.target = None
@@ -0,0 +1,133 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the schedule of the synchronizations in daemon mode
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+
+class CronSchedule:
+    """
+    Class parsing a cron expression ("minute hour day month weekday").
+    Each field supports "*", "a", "a-b", "a,b" and "/step".
+    """
+
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"invalid cron expression \"{expression}\"")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        # 0 and 7 are both Sunday
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _parse_field(self, field: str, low: int, high: int):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+            if part == "*":
+                start, stop = low, high
+            elif "-" in part:
+                start, stop = [int(value) for value in part.split("-", 1)]
+            else:
+                start = stop = int(part)
+            if start < low or stop > high or start > stop or step < 1:
+                raise ValueError(f"invalid cron field \"{field}\"")
+            values.update(range(start, stop + 1, step))
+        return values
+
+    def _match_day(self, date: datetime):
+        day = date.day in self.days
+        weekday = (date.weekday() + 1) % 7 in self.weekdays
+        # same as cron: if both fields are restricted, one of them must match
+        if not self.any_day and not self.any_weekday:
+            return day or weekday
+        return day and weekday
+
+    def next_run(self, after: datetime) -> datetime:
+        """
+        Return the first matching minute after `after`
+        """
+        date = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = date + timedelta(days=366 * 4)
+        while date < limit:
+            if date.month not in self.months:
+                date = (date.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._match_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
+        raise ValueError(f"cron expression \"{self.expression}\" never matches")
+
+
+class Scheduler:
+    """
+    Class running a job at a fixed interval (in seconds) or on a cron
+    schedule. The job is run in the current thread, so two runs never
+    overlap: if a run is longer than the interval, the missed runs are
+    skipped.
+    """
+
+    def __init__(self, interval: int = None, cron: str = None):
+        self.interval = interval
+        self.cron = CronSchedule(cron) if cron else None
+        if not self.interval and not self.cron:
+            raise ValueError("an interval or a cron schedule is required")
+
+    def next_run(self, last_start: datetime) -> datetime:
+        now = datetime.now()
+        if self.cron:
+            return self.cron.next_run(now)
+        runs = int((now - last_start).total_seconds() // self.interval) + 1
+        if runs > 1:
+            LOGGER.warning(f"scheduler:last run took longer than the interval, skipping {runs - 1} run(s)")
+        return last_start + timedelta(seconds=self.interval * runs)
+
+    def run_forever(self, job):
+        """
+        Run the job according to the schedule. The exceptions raised by the
+        job are logged and do not stop the scheduler
+        """
+        if self.cron:
+            next_run = self.cron.next_run(datetime.now())
+        else:
+            next_run = datetime.now()
+        while True:
+            wait = (next_run - datetime.now()).total_seconds()
+            if wait > 0:
+                LOGGER.info(f"scheduler:next run at {next_run}")
+                print(f"Next synchronization at {next_run:%Y-%m-%d %H:%M:%S}")
+                time.sleep(wait)
+            start = datetime.now()
+            try:
+                job()
+            except (Exception, SystemExit):
+                LOGGER.error("scheduler:run failed", exc_info=True)
+                print("\033[31m\u2716\033[0m Synchronization failed. Check the logs for more details")
+            next_run = self.next_run(start)
@@ -11,15 +11,113 @@ Script managing the communication with the SMTP Server
 """
 import smtplib
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 from datetime import datetime
-from mist_qrcode import get_qrcode_as_html
+from mist_qrcode import get_qrcode_as_html, get_qrcode_as_png
+from mist_template import get_template
+from mist_metrics import METRICS
+from mist_output import line_printer
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
 
+class SmtpPool():
+    """
+    Class keeping up to `size` authenticated SMTP sessions open, so the
+    connection, TLS handshake and login are only done once per session
+    """
+    def __init__(self, smtp, host, port, username, password, size:int=1):
+        self.smtp = smtp
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self._sessions = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        LOGGER.debug(f"SmtpPool:opening a new session to {self.host}:{self.port}")
+        session = self.smtp(self.host, self.port)
+        if self.username and self.password:
+            session.login(self.username, self.password)
+        return session
+
+    def _get(self):
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._sessions.get()
+
+    def _release(self, session):
+        if session:
+            self._sessions.put(session)
+        else:
+            with self._lock:
+                self._created -= 1
+
+    def sendmail(self, from_email, receivers, msg):
+        """
+        Send the message with one of the pooled sessions. If the server
+        closed the session, a new one is opened and the message is sent
+        again
+        """
+        session = self._get()
+        try:
+            try:
+                session.sendmail(from_email, receivers, msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                LOGGER.info("SmtpPool:session closed by the server. Reconnecting")
+                self._close(session)
+                session = None
+                session = self._connect()
+                session.sendmail(from_email, receivers, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self._close(session)
+            session = None
+            raise
+        finally:
+            self._release(session)
+
+    def _close(self, session):
+        if not session:
+            return
+        try:
+            session.quit()
+        except:
+            try:
+                session.close()
+            except:
+                pass
+
+    def close(self):
+        """
+        Close all the pooled sessions
+        """
+        while True:
+            try:
+                session = self._sessions.get_nowait()
+            except queue.Empty:
+                break
+            self._close(session)
+            with self._lock:
+                self._created -= 1
+
+
 class MistSmtp():
     """
     Class managing the requests to the SMTP Server
@@ -36,60 +134,122 @@ class MistSmtp():
             self.logo_url = config["logo_url"]
             self.email_psk_to_users = config["email_psk_to_users"]
             self.enable_qrcode = config["enable_qrcode"]
+            self.qrcode_format = config.get("qrcode_format", "html")
             self.report_enabled = config["report_enabled"]
             self.report_receivers = config["report_receivers"]
             self.template = config["template"]
+            self.pool_size = config.get("pool_size", 1)
             if self.use_ssl:
                 self.smtp = smtplib.SMTP_SSL
             else: self.smtp = smtplib.SMTP
+            self.pool = SmtpPool(
+                self.smtp, self.host, self.port, self.username, self.password, self.pool_size
+            )
         else:
+            self.pool = None
+            self.pool_size = 1
             self.email_psk_to_users = False
             self.report_enabled = False
 
-    def _send_email(self, receivers, msg, log_message, dry_run:bool=False):
-        print(f"{log_message} ".ljust(79, "."), end="", flush=True)
+    def _send_email(self, receivers, msg, log_message, dry_run:bool=False, print_line=None):
+        print_line = print_line or line_printer()
         LOGGER.info(f"_send_email:{log_message}")
         LOGGER.debug(self.from_email)
         LOGGER.debug(receivers)
         try:
             if not dry_run:
-                with self.smtp(self.host, self.port) as smtp:
-                    if self.username and self.password:
-                        smtp.login(self.username, self.password)
-                    smtp.sendmail(self.from_email, receivers, msg)
-            print("\033[92m\u2714\033[0m")
+                with METRICS.phase("email_send"):
+                    self.pool.sendmail(self.from_email, receivers, msg)
+                METRICS.add_items("email_send")
+                METRICS.count("email_bytes_sent", len(msg))
+            # printed in one call as the emails can be sent by several threads
+            print_line(f"{log_message} ".ljust(79, ".") + "\033[92m\u2714\033[0m")
             LOGGER.info("_send_email:email sent")
             return True
         except:
-            print('\033[31m\u2716\033[0m')
+            print_line(f"{log_message} ".ljust(79, ".") + '\033[31m\u2716\033[0m')
             LOGGER.critical("Exception occurred", exc_info=True)
             return False
 
-    def send_psk(self, psk, ssid, user_name, user_email, dry_run:bool=False):
+    def close(self):
+        """
+        Close the SMTP sessions
+        """
+        if self.pool:
+            self.pool.close()
+
+    def send_psk(self, psk, ssid, user_name, user_email, dry_run:bool=False, print_line=None):
         if self.email_psk_to_users:
+            with METRICS.phase("email_render"):
+                msg = self._build_psk_email(psk, ssid, user_name, user_email)
+            METRICS.add_items("email_render")
+            return self._send_email(
+                user_email, msg,
+                f"Sending psk email to {user_name} {user_email}", dry_run, print_line)
+
+    def _build_psk_email(self, psk, ssid, user_name, user_email):
+        qr_png = None
+        if not self.enable_qrcode:
+            qr_info = ""
+            qr_html = ""
+        elif self.qrcode_format == "png":
+            # the QRCode is attached as an image and referenced by its Content-ID
+            qr_info = "You can also scan the QRCode below to configure your device:"
+            qr_html = "<tr><td><img src=\"cid:qrcode\" alt=\"QRCode\" /></td></tr>"
+            qr_png = get_qrcode_as_png(ssid, psk)
+        else:
+            qr_info = "You can also scan the QRCode below to configure your device:"
+            qr_html = get_qrcode_as_html(ssid, psk)
+
+        if qr_png:
+            msg = MIMEMultipart('related')
+        else:
             msg = MIMEMultipart('alternative')
-            msg["Subject"] = "Your Personal Wi-Fi access code"
-            msg["From"] = f"{self.from_name} <{self.from_email}>"
-            msg["To"] = f"{user_name} <{user_email}>"
-
-            if self.enable_qrcode:
-                qr_info = "You can also scan the QRCode below to configure your device:"
-                qr_html = get_qrcode_as_html(ssid, psk)
-            else:
-                qr_info = ""
-                qr_html = ""
-
-            # Use the variable in the open function
-            with open(self.template, "r") as template:
-                html = template.read()
-            html = html.format(self.logo_url, user_name, ssid, psk, qr_info, qr_html)
-            msg_body = MIMEText(html, "html")
-            msg.attach(msg_body)
+        msg["Subject"] = "Your Personal Wi-Fi access code"
+        msg["From"] = f"{self.from_name} <{self.from_email}>"
+        msg["To"] = f"{user_name} <{user_email}>"
 
-            return self._send_email(
-                user_email, msg.as_string(),
-                f"Sending psk email to {user_name} {user_email}", dry_run)
+        html = get_template(self.template).render(
+                self.logo_url, user_name, ssid, psk, qr_info, qr_html,
+                logo_url=self.logo_url,
+                user_name=user_name,
+                user_email=user_email,
+                ssid=ssid,
+                psk=psk,
+                qr_info=qr_info,
+                qr_code=qr_html
+            )
+        msg_body = MIMEText(html, "html")
+        msg.attach(msg_body)
+        if qr_png:
+            qr_image = MIMEImage(qr_png, "png")
+            qr_image.add_header("Content-ID", "<qrcode>")
+            qr_image.add_header("Content-Disposition", "inline", filename="qrcode.png")
+            msg.attach(qr_image)
+        return msg.as_string()
+
+    def send_psks(self, emails:list, dry_run:bool=False, on_sent=None):
+        """
+        Send the PSK emails with `pool_size` threads.
+        `emails` is a list of (psk, ssid, user_name, user_email) tuples.
+        `on_sent(user_name)` is called as soon as an email is sent.
+        Return the result of each email, in the same order
+        """
+        # the lines printed by the pool threads keep the prefix of the target
+        print_line = line_printer()
+
+        def send(psk, ssid, user_name, user_email):
+            result = self.send_psk(psk, ssid, user_name, user_email, dry_run, print_line)
+            if result and on_sent:
+                on_sent(user_name)
+            return result
 
+        with ThreadPoolExecutor(max_workers=max(1, self.pool_size)) as executor:
+            futures = [
+                executor.submit(send, psk, ssid, user_name, user_email)
+                for psk, ssid, user_name, user_email in emails
+            ]
+            return [future.result() for future in futures]
 
     def send_report(self, added_psks, removed_psks, dry_run:bool=False):
         if self.report_enabled and not dry_run:
@@ -101,26 +261,34 @@ class MistSmtp():
 
             add_table=""
             for psk in added_psks:
-                name = psk["name"] if "name" in psk else ""
-                email = psk["email"] if "email" in psk else ""
-                created = "Yes" if psk["psk_added"] else "No"
-                sent = "Yes" if psk["email_sent"] else "No"
+                name = psk.name or ""
+                if psk.target:
+                    name = f"{name} ({psk.target})"
+                email = psk.email or ""
+                created = "Yes" if psk.psk_added else "No"
+                sent = "Yes" if psk.email_sent else "No"
                 add_table += f"<tr><td>{name}</td><td>{email}</td><td>{created}</td><td>{sent}</td></tr>"
 
             delete_table=""
             for psk in removed_psks:
-                name = psk["psk"] if "psk" in psk else ""
-                deleted = "Yes" if psk["psk_deleted"] else "No"
+                name = psk.name or ""
+                if psk.target:
+                    name = f"{name} ({psk.target})"
+                deleted = "Yes" if psk.psk_deleted else "No"
                 delete_table += f"<tr><td>{name}</td><td>{deleted}</td></tr>"
-            with open("report_template.html", "r") as template:
-                html = template.read()
-            html = html.format(
+            html = get_template("report_template.html").render(
                     self.logo_url,
                     datetime.today(),
                     len(added_psks),
                     add_table,
                     len(removed_psks),
-                    delete_table
+                    delete_table,
+                    logo_url=self.logo_url,
+                    date=datetime.today(),
+                    added_count=len(added_psks),
+                    added_table=add_table,
+                    removed_count=len(removed_psks),
+                    removed_table=delete_table
                 )
             msg_body = MIMEText(html, "html")
             msg.attach(msg_body)
@@ -0,0 +1,66 @@
+"""
+-------------------------------------------------------------------------------
+
+    Written by Thomas Munzer (tmunzer@juniper.net)
+    Github repository: https://github.com/tmunzer/mist_ldap_sync/
+
+    This script is licensed under the MIT License.
+
+-------------------------------------------------------------------------------
+Script managing the email templates
+"""
+import os
+import logging
+import threading
+from string import Formatter
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.DEBUG)
+
+_FORMATTER = Formatter()
+_TEMPLATES = {}
+_LOCK = threading.Lock()
+
+
+class MistTemplate:
+    """
+    Class managing an email template.
+    The template file is read and parsed once, then each `render` only
+    fills the placeholders. The placeholders can be positional ({0}, {1},
+    ...) or named ({user_name}, {psk}, ...), and "{{" / "}}" are used for
+    the literal curly brackets, like with `str.format`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, "r") as template:
+            self.parts = list(_FORMATTER.parse(template.read()))
+        LOGGER.debug(f"template {path} loaded")
+
+    def render(self, *args, **kwargs) -> str:
+        """
+        Return the template filled with the positional and named values
+        """
+        html = []
+        for literal, field_name, format_spec, conversion in self.parts:
+            html.append(literal)
+            if field_name is not None:
+                value, _ = _FORMATTER.get_field(field_name, args, kwargs)
+                value = _FORMATTER.convert_field(value, conversion)
+                html.append(_FORMATTER.format_field(value, format_spec))
+        return "".join(html)
+
+
+def get_template(path: str) -> MistTemplate:
+    """
+    Return the template from the process cache. The template is loaded
+    again if the file was modified since it was parsed
+    """
+    mtime = os.path.getmtime(path)
+    with _LOCK:
+        template = _TEMPLATES.get(path)
+        if not template or template.mtime != mtime:
+            template = MistTemplate(path)
+            _TEMPLATES[path] = template
+    return template
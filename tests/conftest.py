@@ -0,0 +1,59 @@
+"""
+The scripts are flat modules in the repository root
+"""
+import os
+import sys
+import pytest
+import requests
+import mistapi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeApiSession:
+    """
+    mistapi session without login, the requests are faked by the tests
+    """
+
+    def __init__(self, **kwargs):
+        self._session = requests.Session()
+        self._cloud_uri = "api.mist.local"
+
+    def login(self):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data if data is not None else {}
+        self.headers = headers or {}
+        self.next = None
+
+
+@pytest.fixture
+def fake_apisession(monkeypatch):
+    monkeypatch.setattr(mistapi, "APISession", FakeApiSession)
+
+
+@pytest.fixture
+def fake_psk_api(monkeypatch, fake_apisession):
+    """
+    Fake org PSK list API, returning the PSKs of the list (filtered by name
+    and paginated like the Mist API)
+    """
+    psks = []
+
+    def list_psks(session, org_id, name=None, ssid=None, limit=100, page=1):
+        data = psks
+        if name:
+            names = name.split(",")
+            data = [psk for psk in psks if psk["name"] in names]
+        limit = limit or 100
+        page = page or 1
+        return FakeResponse(
+            200, data[(page - 1) * limit : page * limit], {"X-Page-Total": str(len(data))}
+        )
+
+    monkeypatch.setattr(mistapi.api.v1.orgs.psks, "listOrgPsks", list_psks)
+    return psks
@@ -0,0 +1,96 @@
+import io
+import sys
+import pytest
+from mist_async import AsyncEngine, AsyncMist, AsyncMistSmtp, AsyncResponse
+from mist_cache import PskCache
+from mist_inventory import PskInventory
+from mist_output import TargetOutput
+from mist_records import UserReport
+
+
+@pytest.fixture
+def mist(monkeypatch, fake_apisession):
+    engine = AsyncEngine(concurrency=4)
+    mist = AsyncMist(
+        {
+            "scope": "orgs",
+            "scope_id": "org",
+            "ssid": "ssid",
+            "psk_length": 12,
+            "allowed_chars": "abcdefghjkmnpqrstuvwxyz23456789",
+            "create_workers": 3,
+            "create_batch_size": 10,
+            "create_batch_min": 10,
+        },
+        engine,
+    )
+    mist.requests = []
+
+    async def send_request(method, uri, params=None, body=None):
+        mist.requests.append((method, uri))
+        if uri.endswith("/import"):
+            return AsyncResponse(200, {}, {"updated": [psk["name"] for psk in body], "errors": []})
+        return AsyncResponse(200, {}, {})
+
+    monkeypatch.setattr(mist, "_send_request", send_request)
+    yield mist
+    engine.close()
+
+
+def test_import_with_cache(mist, tmp_path):
+    # the import results are saved in the cache by the thread which opened it
+    cache = PskCache(str(tmp_path / "cache.db"), "orgs", "org", "ssid")
+    inventory = PskInventory([], cache)
+    users = [UserReport(f"user{i}", f"user{i}@example.com") for i in range(45)]
+    mist.create_ppsk_bulk(users, inventory=inventory)
+    inventory.close()
+    assert all(user.psk_added for user in users)
+    assert len(inventory) == 45
+    cached = PskCache(str(tmp_path / "cache.db"), "orgs", "org", "ssid").load()
+    assert sorted(psk.name for psk in cached) == sorted(user.name for user in users)
+    assert len({psk.passphrase for psk in cached}) == 45
+
+
+def test_delete_with_bounded_workers(mist):
+    deleted = []
+    results = mist.delete_ppsks([f"id{i}" for i in range(250)], on_deleted=deleted.extend)
+    assert all(results.values()) and len(results) == 250
+    assert sorted(deleted) == sorted(results)
+    assert [method for method, _ in mist.requests] == ["POST"] * 3
+
+
+def test_emails_printed_with_the_target_prefix(monkeypatch):
+    class Session:
+        async def sendmail(self, sender, receivers, msg):
+            if receivers == ["bob@example.com"]:
+                raise Exception("rejected")
+
+        async def quit(self):
+            pass
+
+        def close(self):
+            pass
+
+    async def connect():
+        return Session()
+
+    engine = AsyncEngine(concurrency=4)
+    smtp = AsyncMistSmtp({"enabled": False}, engine)
+    smtp.email_psk_to_users = True
+    smtp.from_email = "mist@example.com"
+    monkeypatch.setattr(smtp, "_connect", connect)
+    monkeypatch.setattr(smtp, "_build_psk_email", lambda *args: "message")
+    stream = io.StringIO()
+    output = TargetOutput(stream)
+    monkeypatch.setattr(sys, "stdout", output)
+    try:
+        with output.target("site"):
+            results = smtp.send_psks(
+                [("psk", "ssid", name, f"{name}@example.com") for name in ["alice", "bob"]]
+            )
+    finally:
+        engine.close()
+    assert results == [True, False]
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 2
+    assert all(line.startswith("[site] Sending psk email to ") for line in lines)
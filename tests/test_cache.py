@@ -0,0 +1,68 @@
+from mist_cache import PskCache
+from mist_inventory import PskInventory
+from mist_psk import Mist
+from mist_records import Psk
+
+CONFIG = {"scope": "orgs", "scope_id": "org", "ssid": "ssid"}
+
+
+def psk(psk_id, name, passphrase):
+    return {"id": psk_id, "name": name, "passphrase": passphrase, "ssid": "ssid"}
+
+
+def cache_with(tmp_path, psks):
+    cache = PskCache(str(tmp_path / "cache.db"), "orgs", "org", "ssid")
+    cache.save_all([Psk.from_dict(item) for item in psks])
+    return cache
+
+
+def test_cache_used_when_unchanged(tmp_path, fake_psk_api):
+    fake_psk_api += [psk(f"id{i}", f"user{i}", f"pass{i}") for i in range(250)]
+    cache = cache_with(tmp_path, fake_psk_api)
+    psks = Mist(CONFIG)._load_cache(cache)
+    assert psks is not None and len(psks) == 250
+
+
+def test_cache_reloaded_when_psk_recreated(tmp_path, fake_psk_api):
+    fake_psk_api += [psk(f"id{i}", f"user{i}", f"pass{i}") for i in range(250)]
+    cache = cache_with(tmp_path, fake_psk_api)
+    # same number of PSKs: one deleted, one created
+    fake_psk_api.pop(10)
+    fake_psk_api.append(psk("new", "user10", "other"))
+    assert Mist(CONFIG)._load_cache(cache) is None
+
+
+def test_cache_reloaded_after_max_age(tmp_path, fake_psk_api, monkeypatch):
+    fake_psk_api += [psk("id1", "user1", "pass1")]
+    cache = cache_with(tmp_path, fake_psk_api)
+    monkeypatch.setattr(cache, "age", lambda: 3601)
+    # the check of the cache is best-effort, so it is reloaded every hour by default
+    assert Mist(CONFIG)._load_cache(cache) is None
+
+
+def test_cache_reloaded_when_passphrase_changed(tmp_path, fake_psk_api):
+    fake_psk_api += [psk("id1", "user1", "pass1"), psk("id2", "user2", "pass2")]
+    cache = cache_with(tmp_path, fake_psk_api)
+    fake_psk_api[0] = psk("id1", "user1", "rotated")
+    assert Mist(CONFIG)._load_cache(cache) is None
+
+
+def test_refresh_ppsks(tmp_path, fake_psk_api):
+    fake_psk_api += [psk("id1", "user1", "pass1"), psk("id2", "user2", "pass2")]
+    cache = cache_with(tmp_path, fake_psk_api)
+    inventory = PskInventory(cache.load(), cache)
+    fake_psk_api[0] = psk("id1", "user1", "rotated")
+    Mist(CONFIG).refresh_ppsks(inventory, ["user1"])
+    assert [item.passphrase for item in inventory.get("user1")] == ["rotated"]
+    assert [item.passphrase for item in inventory.get("user2")] == ["pass2"]
+    inventory.close()
+    cached = PskCache(str(tmp_path / "cache.db"), "orgs", "org", "ssid").load()
+    assert sorted(item.passphrase for item in cached) == ["pass2", "rotated"]
+
+
+def test_cache_file_only_readable_by_owner(tmp_path):
+    path = tmp_path / "cache.db"
+    path.write_bytes(b"")
+    path.chmod(0o644)
+    PskCache(str(path), "orgs", "org", "ssid").close()
+    assert path.stat().st_mode & 0o777 == 0o600
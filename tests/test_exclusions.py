@@ -0,0 +1,54 @@
+import pytest
+from mist_exclusions import PskExclusions
+
+
+def test_names_globs_and_regexes():
+    exclusions = PskExclusions(["Guest", " svc-* ", "re:^printer-\\d+$", "# comment", ""])
+    assert "guest" in exclusions
+    assert "SVC-backup" in exclusions
+    assert "printer-12" in exclusions
+    assert "printer-x" not in exclusions
+    assert "guest2" not in exclusions
+    assert "" not in exclusions
+    assert None not in exclusions
+    assert len(exclusions) == 3
+
+
+def test_regexes_are_fully_matched():
+    exclusions = PskExclusions(["re:lab", "lab?"])
+    assert "lab" in exclusions
+    assert "lab1" in exclusions
+    assert "mylab" not in exclusions
+    assert "lab12" not in exclusions
+
+
+def test_regexes_not_combined():
+    exclusions = PskExclusions(["re:(a+)-\\1", "re:(?i)kiosk-.*", "re:(?P<x>b)(?P=x)", "re:(?P<x>c)", "re:dev-.*"])
+    assert "aa-aa" in exclusions
+    assert "aa-a" not in exclusions
+    assert "Kiosk-1" in exclusions
+    assert "bb" in exclusions
+    assert "c" in exclusions
+    assert "dev-1" in exclusions
+    assert "other" not in exclusions
+    assert len(exclusions.separate) == 4
+    assert len(exclusions) == 5
+
+
+def test_escaped_backslash_is_combined():
+    exclusions = PskExclusions(["re:a\\\\1"])
+    assert "a\\1" in exclusions
+    assert exclusions.separate == []
+
+
+def test_invalid_regex_names_the_entry():
+    with pytest.raises(ValueError, match="re:printer-\\("):
+        PskExclusions(["guest", "re:printer-("])
+
+
+def test_load(tmp_path):
+    path = tmp_path / "exclusions.txt"
+    path.write_text("# excluded\nkiosk-*\n\nre:room-[0-9]+\n")
+    exclusions = PskExclusions.load("guest,admin", str(path))
+    assert all(name in exclusions for name in ["guest", "ADMIN", "kiosk-3", "room-101"])
+    assert str(exclusions) == "2 names, 2 patterns"
@@ -0,0 +1,134 @@
+import json
+import os
+import stat
+import pytest
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+from mist_groups import GroupExpander
+from mist_ldap_connections import LdapConnectionPool
+
+BASE_DN = "DC=example,DC=com"
+GROUP = f"CN=wifi,{BASE_DN}"
+NESTED = f"CN=nested,{BASE_DN}"
+ATTRIBUTES = ["userPrincipalName", "mail", "objectClass", "userAccountControl"]
+# the mock strategy does not support the extensible match filters
+ENABLED = "(userAccountControl=512)"
+
+
+def user_dn(name):
+    return f"CN={name},OU=Users,{BASE_DN}"
+
+
+class Directory:
+    """
+    Mock directory: the wifi group contains alice and the nested group,
+    which contains bob, carol (disabled) and the wifi group (cycle)
+    """
+
+    def __init__(self):
+        self.server = Server("mock", get_info=OFFLINE_AD_2012_R2)
+        conn = self.connect(bind=False)
+        conn.strategy.add_entry("cn=admin", {"userPassword": "secret", "sn": "admin"})
+        conn.strategy.add_entry(GROUP, {"objectClass": ["top", "group"], "uSNChanged": 10, "memberOf": [NESTED]})
+        conn.strategy.add_entry(NESTED, {"objectClass": ["top", "group"], "uSNChanged": 11, "memberOf": [GROUP]})
+        for name, group, uac in [("alice", GROUP, 512), ("bob", NESTED, 512), ("carol", NESTED, 514)]:
+            conn.strategy.add_entry(
+                user_dn(name),
+                {
+                    "objectClass": ["top", "person", "user"],
+                    "userPrincipalName": name,
+                    "mail": f"{name}@example.com",
+                    "memberOf": [group],
+                    "userAccountControl": uac,
+                    "uSNChanged": 20,
+                },
+            )
+        self.conn = self.connect()
+        self.searches = []
+
+    def connect(self, bind=True):
+        conn = Connection(self.server, user="cn=admin", password="secret", client_strategy=MOCK_SYNC)
+        if bind:
+            conn.bind()
+        return conn
+
+    def paged_search(self, conn, **kwargs):
+        self.searches.append(kwargs["search_filter"])
+        return conn.extend.standard.paged_search(**kwargs)
+
+    def modify(self, dn, usn, **attributes):
+        changes = {key: [("MODIFY_REPLACE", [value])] for key, value in attributes.items()}
+        changes["uSNChanged"] = [("MODIFY_REPLACE", [usn])]
+        self.conn.modify(dn, changes)
+
+
+@pytest.fixture
+def directory():
+    return Directory()
+
+
+def expand(directory, cache_file=None, server="dc1", usn=100):
+    expander = GroupExpander(
+        directory.connect,
+        BASE_DN,
+        ATTRIBUTES,
+        workers=2,
+        cache_file=cache_file,
+        paged_search=directory.paged_search,
+        user_filter=ENABLED,
+    )
+    expander._get_root_dse = lambda conn: {"dsServiceName": server, "highestCommittedUSN": usn}
+    directory.searches = []
+    users = {entry["attributes"]["userPrincipalName"]: entry["attributes"] for entry in expander.expand(GROUP)}
+    return expander, users
+
+
+def test_expand_nested_groups(directory):
+    expander, users = expand(directory)
+    assert sorted(users) == ["alice", "bob"]
+    assert expander.groups == {GROUP.lower(), NESTED.lower()}
+
+
+def test_cached_members_updated_with_the_changed_users(directory, tmp_path):
+    cache_file = str(tmp_path / "groups.json")
+    expand(directory, cache_file, usn=100)
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+
+    # no change: only the changed members are requested
+    _, users = expand(directory, cache_file, usn=100)
+    assert sorted(users) == ["alice", "bob"]
+    assert all("(uSNChanged>=101)" in search for search in directory.searches)
+
+    # bob disabled, carol enabled, alice email changed: the groups did not change
+    directory.modify(user_dn("bob"), 101, userAccountControl=514)
+    directory.modify(user_dn("carol"), 102, userAccountControl=512)
+    directory.modify(user_dn("alice"), 103, mail="new@example.com")
+    _, users = expand(directory, cache_file, usn=103)
+    assert sorted(users) == ["alice", "carol"]
+    assert users["alice"]["mail"] == "new@example.com"
+    with open(cache_file) as f:
+        assert json.load(f)["usn"] == 103
+
+    # membership changed: the members of the group are requested again
+    directory.modify(NESTED, 104)
+    _, users = expand(directory, cache_file, usn=104)
+    assert sorted(users) == ["alice", "carol"]
+    assert any("uSNChanged" not in search for search in directory.searches)
+
+
+def test_cache_not_used_with_another_dc(directory, tmp_path):
+    cache_file = str(tmp_path / "groups.json")
+    expand(directory, cache_file, server="dc1")
+    expand(directory, cache_file, server="dc2")
+    assert not any("uSNChanged" in search for search in directory.searches)
+
+
+def test_pool_evicts_the_connections_to_a_failed_server(directory):
+    pool = LdapConnectionPool(directory.connect)
+    conn = pool.get()
+    assert pool.get() is conn
+    pool.evict(Server("other"))
+    assert pool.get() is conn
+    pool.evict(directory.server)
+    assert conn.closed
+    assert pool.get() is not conn
+    pool.close()
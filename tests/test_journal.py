@@ -0,0 +1,54 @@
+import os
+import stat
+from mist_journal import RunJournal
+from mist_records import LdapUser, Psk
+
+
+def record_interrupted_run(path):
+    journal = RunJournal(path)
+    journal.plan("target", [LdapUser("alice", "a@x"), LdapUser("bob", "b@x")], [Psk("1", "old")])
+    journal.created("target", [{"name": "alice", "passphrase": "secret", "ssid": "ssid", "vlan_id": 10}])
+    journal.deleted("target", ["1"])
+    journal.email_sent("target", "alice")
+    journal.close(False)
+
+
+def test_resume_interrupted_run(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    record_interrupted_run(path)
+    # last entry partially written when the process was killed
+    with open(path, "a") as f:
+        f.write('{"type": "created", "target": "target", "psks": [["bob"')
+
+    journal = RunJournal(path, resume=True)
+    state = journal.get("target")
+    assert state["create"] == [["alice", "a@x"], ["bob", "b@x"]]
+    assert state["delete"] == [["1", "old"]]
+    assert state["created"] == {"alice": ("secret", "ssid", 10)}
+    assert state["deleted"] == {"1"}
+    assert state["emails"] == {"alice"}
+    assert journal.all_planned(["target"])
+    assert not journal.all_planned(["target", "other"])
+
+    # the entries of the resumed run are appended after the incomplete one
+    journal.created("target", [{"name": "bob", "passphrase": "other", "ssid": "ssid"}])
+    journal.close(False)
+    assert RunJournal(path, resume=True).get("target")["created"]["bob"] == ("other", "ssid", None)
+
+
+def test_new_run_ignores_the_previous_one(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    record_interrupted_run(path)
+    journal = RunJournal(path)
+    assert journal.get("target") is None
+    journal.close(True)
+    assert not os.path.exists(path)
+
+
+def test_journal_readable_by_its_owner_only(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    with open(path, "w"):
+        pass
+    os.chmod(path, 0o644)
+    RunJournal(path).close(False)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
@@ -0,0 +1,226 @@
+import json
+import time
+import pytest
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_AD_2012_R2
+from ldap3.core.exceptions import LDAPCommunicationError
+from mist_ldap import MistLdap
+from mist_reconcile import MistReconcile
+
+BASE_DN = "DC=example,DC=com"
+GROUP = f"CN=wifi,{BASE_DN}"
+
+
+def user_dn(name):
+    return f"CN={name},OU=Users,{BASE_DN}"
+
+
+class MockLdap(MistLdap):
+    # the mock strategy does not support the extensible match filters
+    ENABLED_USERS = ""
+
+
+def make_directory():
+    server = Server("mock", get_info=OFFLINE_AD_2012_R2)
+    conn = Connection(server, user="cn=admin", password="secret", client_strategy=MOCK_SYNC)
+    conn.strategy.add_entry("cn=admin", {"userPassword": "secret", "sn": "admin"})
+    members = {"alice": 512, "bob": 514, "carol": 512}
+    conn.strategy.add_entry(GROUP, {"objectClass": ["top", "group"], "uSNChanged": 10, "member": [user_dn(name) for name in members]})
+    for name, uac in members.items():
+        conn.strategy.add_entry(
+            user_dn(name),
+            {
+                "objectClass": ["top", "person", "user"],
+                "userPrincipalName": name,
+                "mail": f"{name}@example.com",
+                "memberOf": [GROUP],
+                "userAccountControl": uac,
+            },
+        )
+    conn.bind()
+    return conn
+
+
+@pytest.fixture
+def directory():
+    return make_directory()
+
+
+@pytest.fixture
+def ldap(directory, monkeypatch):
+    ldap = MockLdap(
+        {
+            "host": "mock",
+            "base_dn": BASE_DN,
+            "search_group": GROUP,
+            "user_name": "userPrincipalName",
+            "user_email": "mail",
+        }
+    )
+    monkeypatch.setattr(ldap, "_connect", lambda: directory)
+    return ldap
+
+
+def test_search_skips_disabled_accounts(ldap):
+    assert sorted(user.name for user in ldap.iter_users()) == ["alice", "carol"]
+
+
+def test_search_filter_excludes_disabled_accounts():
+    assert "userAccountControl:1.2.840.113556.1.4.803:=2" in MistLdap.ENABLED_USERS
+
+
+def test_disabled_accounts_filtered_by_the_server(directory, monkeypatch):
+    # the mock strategy does not support the extensible match filters: the
+    # ACCOUNTDISABLE bit test is replaced with the userAccountControl of the
+    # disabled accounts of the directory
+    filters = []
+    search = directory.search
+
+    def mock_search(search_base, search_filter, *args, **kwargs):
+        filters.append(search_filter)
+        search_filter = search_filter.replace(MistLdap.ENABLED_USERS, "(!(userAccountControl=514))")
+        return search(search_base, search_filter, *args, **kwargs)
+
+    monkeypatch.setattr(directory, "search", mock_search)
+    ldap = MistLdap(
+        {
+            "host": "mock",
+            "base_dn": BASE_DN,
+            "search_group": GROUP,
+            "user_name": "userPrincipalName",
+            "user_email": "mail",
+        }
+    )
+    monkeypatch.setattr(ldap, "_connect", lambda: directory)
+    # only the server filter skips the disabled accounts
+    monkeypatch.setattr(ldap, "_is_disabled", lambda attributes: False)
+    assert sorted(user.name for user in ldap.iter_users()) == ["alice", "carol"]
+    assert any(MistLdap.ENABLED_USERS in search_filter for search_filter in filters)
+
+
+def test_watch_removes_disabled_and_adds_back_enabled_users(ldap, directory):
+    members = {}
+    disabled = set()
+    removed = []
+    ldap._check_members(members, removed.append, disabled)
+    assert sorted(members.values()) == ["alice", "carol"]
+    assert disabled == {user_dn("bob").lower()}
+
+    ldap._process_event({"dn": user_dn("alice"), "attributes": {"userAccountControl": 514}}, members, removed.append, disabled)
+    assert [user.name for user in removed] == ["alice"]
+    assert user_dn("alice").lower() in disabled
+
+    directory.modify(user_dn("bob"), {"userAccountControl": [("MODIFY_REPLACE", [512])]})
+    ldap._process_event({"dn": user_dn("bob"), "attributes": {"userAccountControl": 512}}, members, removed.append, disabled)
+    assert sorted(members.values()) == ["bob", "carol"]
+    assert disabled == {user_dn("alice").lower()}
+
+
+def test_incremental_search_does_not_fail_over(ldap, directory, tmp_path, monkeypatch):
+    ldap.host = "dc1,dc2"
+    ldap.servers = [Server("dc1"), Server("dc2")]
+    ldap.state_file = str(tmp_path / "state.json")
+    with open(ldap.state_file, "w") as f:
+        json.dump({
+            "server": "dc1",
+            "config": ldap._state_config(),
+            "usn": 100,
+            "full_sync_time": time.time(),
+            "entries": {user_dn("alice"): {"userPrincipalName": "alice", "mail": "alice@example.com"}},
+        }, f)
+    other = make_directory()
+    root_dses = {
+        id(directory): {"highestCommittedUSN": 200, "dsServiceName": "dc1"},
+        id(other): {"highestCommittedUSN": 5000, "dsServiceName": "dc2"},
+    }
+    monkeypatch.setattr(ldap, "_get_root_dse", lambda conn: root_dses[id(conn)])
+
+    def paged_search(**kwargs):
+        raise LDAPCommunicationError("connection lost")
+        yield
+
+    monkeypatch.setattr(directory.extend.standard, "paged_search", paged_search)
+    binds = []
+
+    def bind(exclude=None, **options):
+        binds.append(exclude)
+        return other
+
+    monkeypatch.setattr(ldap, "_bind", bind)
+
+    entries = list(ldap._incremental_search(directory))
+
+    # the changes are not requested from dc2 with the USN of dc1
+    assert len(binds) == 1
+    assert sorted(entry["dn"] for entry in entries) == [user_dn(name) for name in ["alice", "bob", "carol"]]
+    with open(ldap.state_file) as f:
+        state = json.load(f)
+    assert state["server"] == "dc2"
+    assert state["usn"] == 5000
+
+
+def test_stopping_the_iteration_does_not_exit(ldap, directory):
+    entries = ldap._search(directory)
+    users = ldap._process(entries)
+    assert next(users).name in ["alice", "carol"]
+    # GeneratorExit raised at the yield of _process and _search
+    users.close()
+    entries.close()
+
+
+def test_watch_only_checks_the_members_when_a_nested_group_changed(ldap, monkeypatch):
+    checks = []
+    monkeypatch.setattr(ldap, "_check_members", lambda *args: checks.append(args))
+    ldap.recursive_search = True
+    nested = f"CN=nested,{BASE_DN}"
+    ldap.nested_groups = {GROUP.lower(), nested.lower()}
+
+    def group_event(dn):
+        ldap._process_event({"dn": dn, "attributes": {"objectClass": ["top", "group"]}}, {}, None, set())
+
+    group_event(f"CN=unrelated,{BASE_DN}")
+    assert checks == []
+    group_event(nested)
+    group_event(GROUP)
+    assert len(checks) == 2
+    # nested groups unknown
+    ldap.nested_groups = None
+    group_event(f"CN=unrelated,{BASE_DN}")
+    assert len(checks) == 3
+
+
+def failing_after_first_entry(conn, monkeypatch):
+    paged_search = conn.extend.standard.paged_search
+
+    def search(**kwargs):
+        for entry in paged_search(**kwargs):
+            yield entry
+            raise LDAPCommunicationError("connection lost")
+
+    monkeypatch.setattr(conn.extend.standard, "paged_search", search)
+
+
+def test_search_fails_over_to_the_next_server(ldap, directory, monkeypatch):
+    ldap.servers = [Server("dc1"), Server("dc2")]
+    failing_after_first_entry(directory, monkeypatch)
+    other = make_directory()
+    binds = []
+
+    def bind(exclude=None, **options):
+        binds.append(exclude)
+        return other
+
+    monkeypatch.setattr(ldap, "_bind", bind)
+    entries = list(ldap._search(directory))
+    assert binds == [directory.server]
+    # the entries returned before the failover are returned again
+    dns = [entry["dn"] for entry in entries]
+    assert sorted(set(dns)) == [user_dn(name) for name in ["alice", "bob", "carol"]]
+    assert len(dns) == 4
+    # and ignored by the reconciliation
+    reconcile = MistReconcile(ldap._process(entries), [])
+    assert sorted(user.name for user in reconcile.to_create) == ["alice", "carol"]
+
+
+def test_bind_without_other_server(ldap):
+    with pytest.raises(LDAPCommunicationError, match="no other LDAP server"):
+        ldap._bind(exclude=ldap.servers[0])
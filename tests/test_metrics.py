@@ -0,0 +1,49 @@
+import json
+from mist_metrics import Metrics, PREFIX
+
+
+def collect():
+    metrics = Metrics()
+    with metrics.phase("sync"):
+        for _ in metrics.iterate("ldap_search", range(3)):
+            pass
+    metrics.api_call("GET", "/api/v1/orgs/9777c1a0-6ef6-11e6-8bbf-02e208b2d34f/psks?page=2", 200, 10, 100)
+    metrics.api_call("GET", "/api/v1/orgs/9777c1a0-6ef6-11e6-8bbf-02e208b2d34f/psks", 429)
+    metrics.count("emails_sent", 2)
+    metrics.finish(True)
+    return metrics
+
+
+def test_api_calls_grouped_by_endpoint():
+    data = collect().to_dict()
+    assert sorted((call["endpoint"], call["status"], call["count"]) for call in data["api_calls"]) == [
+        ("/api/v1/orgs/{id}/psks", "200", 1),
+        ("/api/v1/orgs/{id}/psks", "429", 1),
+    ]
+    assert data["counters"]["api_throttled"] == 1
+    assert data["counters"]["api_bytes_received"] == 100
+    assert data["phases"]["ldap_search"]["items"] == 3
+    assert data["success"] is True
+
+
+def test_export_json(tmp_path):
+    path = tmp_path / "metrics.json"
+    collect().export(str(path), "json")
+    data = json.loads(path.read_text())
+    assert data["counters"]["emails_sent"] == 2
+    assert set(data["phases"]) == {"sync", "ldap_search"}
+    assert not (tmp_path / "metrics.json.tmp").exists()
+
+
+def test_export_prometheus(tmp_path):
+    path = tmp_path / "metrics.prom"
+    collect().export(str(path))
+    lines = path.read_text().splitlines()
+    assert f"{PREFIX}_run_success 1" in lines
+    assert f'{PREFIX}_api_calls{{method="GET",endpoint="/api/v1/orgs/{{id}}/psks",status="429"}} 1' in lines
+    assert f'{PREFIX}_phase_items{{phase="ldap_search"}} 3' in lines
+    assert f"{PREFIX}_emails_sent 2" in lines
+    # every sample has a TYPE
+    names = {line.split("{")[0].split(" ")[0] for line in lines if not line.startswith("#")}
+    assert names <= {line.split(" ")[2] for line in lines if line.startswith("# TYPE")}
+
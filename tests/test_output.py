@@ -0,0 +1,41 @@
+import io
+import sys
+import threading
+from mist_output import TargetOutput, line_printer
+
+
+def test_target_lines_are_prefixed_and_not_interleaved():
+    stream = io.StringIO()
+    output = TargetOutput(stream)
+    started = threading.Barrier(2)
+
+    def target(name):
+        with output.target(name):
+            output.write("progress ...")
+            started.wait()
+            output.write("done\nnext")
+
+    threads = [threading.Thread(target=target, args=(name,)) for name in ["a", "b"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    output.write("report\n")
+    lines = stream.getvalue().splitlines()
+    assert sorted(lines[:4]) == ["[a] next", "[a] progress ...done", "[b] next", "[b] progress ...done"]
+    assert lines[4] == "report"
+
+
+def test_line_printer_keeps_the_target_of_the_calling_thread(monkeypatch):
+    stream = io.StringIO()
+    output = TargetOutput(stream)
+    monkeypatch.setattr(sys, "stdout", output)
+    with output.target("a"):
+        print_line = line_printer()
+        output.write("progress ...")
+        # e.g. a SMTP thread of the target
+        thread = threading.Thread(target=print_line, args=("email sent",))
+        thread.start()
+        thread.join()
+        output.write("done\n")
+    assert stream.getvalue().splitlines() == ["[a] email sent", "[a] progress ...done"]
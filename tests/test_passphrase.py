@@ -0,0 +1,47 @@
+import pytest
+from mist_inventory import PskInventory
+from mist_passphrase import PassphraseGenerator
+from mist_psk import Mist
+from mist_records import LdapUser, Psk
+
+
+def test_passphrases_use_the_allowed_characters():
+    passphrases = PassphraseGenerator("abc", 12).generate(500)
+    assert all(len(passphrase) == 12 for passphrase in passphrases)
+    assert set("".join(passphrases)) == set("abc")
+
+
+def test_non_ascii_characters():
+    passphrases = PassphraseGenerator("éàü", 8).generate(50)
+    assert set("".join(passphrases)) == set("éàü")
+
+
+def test_passphrases_are_unique():
+    generator = PassphraseGenerator("ab", 4, used=["aaaa", "bbbb", None])
+    passphrases = generator.generate(14)
+    assert len(set(passphrases)) == 14
+    assert not {"aaaa", "bbbb"} & set(passphrases)
+    # all the 16 combinations are used
+    with pytest.raises(ValueError):
+        generator.generate(1)
+
+
+def test_duplicated_characters_are_ignored():
+    assert PassphraseGenerator("aab", 4).chars == "ab"
+    with pytest.raises(ValueError):
+        PassphraseGenerator("aaa", 4)
+
+
+def test_too_many_characters():
+    chars = "".join(chr(0x100 + index) for index in range(257))
+    with pytest.raises(ValueError, match="at most 256"):
+        PassphraseGenerator(chars, 4)
+    assert len(PassphraseGenerator(chars[:256], 4).generate(10)) == 10
+
+
+def test_create_ppsk_does_not_reuse_the_inventory_passphrases(fake_apisession):
+    mist = Mist({"scope": "orgs", "scope_id": "org", "ssid": "ssid", "allowed_chars": "ab", "psk_length": 1})
+    inventory = PskInventory([Psk("1", "alice", passphrase="a")])
+    for _ in range(10):
+        psk = mist.create_ppsk(LdapUser("bob"), dry_run=True, inventory=inventory)
+        assert psk["passphrase"] == "b"
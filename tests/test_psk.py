@@ -0,0 +1,125 @@
+import mistapi
+import pytest
+import requests
+from conftest import FakeResponse
+from mist_metrics import METRICS
+from mist_psk import Mist
+
+CONFIG = {"scope": "orgs", "scope_id": "org", "ssid": "ssid"}
+
+
+def psk(index, name=None):
+    return {"id": f"id{index}", "name": name or f"user{index}", "passphrase": f"pass{index}", "ssid": "ssid"}
+
+
+@pytest.fixture
+def failing_pages(fake_psk_api, monkeypatch):
+    """
+    Fake PSK list API returning the given statuses before the real pages
+    """
+    statuses = {}
+    list_psks = mistapi.api.v1.orgs.psks.listOrgPsks
+
+    def list_failing(session, org_id, name=None, ssid=None, limit=100, page=1):
+        queue = statuses.get(page)
+        if queue:
+            return FakeResponse(queue.pop(0), {"detail": "error"}, {"Retry-After": "0"})
+        return list_psks(session, org_id, name=name, ssid=ssid, limit=limit, page=page)
+
+    monkeypatch.setattr(mistapi.api.v1.orgs.psks, "listOrgPsks", list_failing)
+    return statuses
+
+
+def test_pages_retried_when_throttled(fake_psk_api, failing_pages):
+    fake_psk_api += [psk(i, "alice") for i in range(5)] + [psk(9, "bob")]
+    failing_pages[2] = [429, 429]
+    pages = list(Mist(CONFIG)._iter_ppks_pages(limit=2, name="alice"))
+    assert [[item["id"] for item in page] for page in pages] == [["id0", "id1"], ["id2", "id3"], ["id4"]]
+
+
+def test_failed_page_raises(fake_psk_api, failing_pages):
+    fake_psk_api += [psk(i, "alice") for i in range(5)]
+    failing_pages[2] = [400]
+    with pytest.raises(Exception, match="HTTP 400"):
+        list(Mist(CONFIG)._iter_ppks_pages(limit=2, name="alice"))
+
+
+def test_delete_user_ppsks_lists_all_the_pages(fake_psk_api, failing_pages):
+    fake_psk_api += [psk(i, "alice") for i in range(1500)] + [psk(9999, "bob")]
+    failing_pages[2] = [429]
+    results = Mist(CONFIG).delete_user_ppsks("alice", dry_run=True)
+    assert len(results) == 1500
+
+
+def test_delete_in_bulk_then_one_by_one(fake_apisession, monkeypatch):
+    bulk = []
+    single = []
+
+    def delete_list(session, org_id, body):
+        bulk.append(body["psk_ids"])
+        # the second batch is rejected
+        return FakeResponse(200 if len(bulk) != 2 else 500)
+
+    def delete_one(session, org_id, psk_id):
+        single.append(psk_id)
+        return FakeResponse(404 if psk_id == "id150" else 200)
+
+    monkeypatch.setattr(mistapi.api.v1.orgs.psks, "deleteOrgPskList", delete_list)
+    monkeypatch.setattr(mistapi.api.v1.orgs.psks, "deleteOrgPsk", delete_one)
+    mist = Mist({**CONFIG, "api_retries": 0})
+    deleted = []
+    results = mist.delete_ppsks([f"id{i}" for i in range(250)], on_deleted=deleted.extend)
+    assert [len(batch) for batch in bulk] == [100, 100, 50]
+    assert sorted(single) == sorted(f"id{i}" for i in range(100, 200))
+    assert [psk_id for psk_id, result in results.items() if not result] == ["id150"]
+    assert sorted(deleted) == sorted(f"id{i}" for i in range(250) if i != 150)
+
+
+def test_pages_without_pagination_headers(fake_psk_api, monkeypatch):
+    fake_psk_api += [psk(i) for i in range(2500)]
+    list_psks = mistapi.api.v1.orgs.psks.listOrgPsks
+
+    def list_without_headers(*args, **kwargs):
+        response = list_psks(*args, **kwargs)
+        response.headers = {}
+        return response
+
+    monkeypatch.setattr(mistapi.api.v1.orgs.psks, "listOrgPsks", list_without_headers)
+    assert len(Mist(CONFIG).get_ppks()) == 2500
+
+
+class ExpiringApiSession:
+    """
+    Like mistapi: login does nothing while the session is authenticated,
+    and the login creates a new HTTP session
+    """
+
+    def __init__(self, **kwargs):
+        self._session = requests.Session()
+        self._cloud_uri = "api.mist.local"
+        self._authenticated = False
+        self.logins = 0
+
+    def login(self):
+        if self._authenticated:
+            return
+        self._session = requests.Session()
+        self._authenticated = True
+        self.logins += 1
+
+
+def test_check_session_logs_in_again(monkeypatch):
+    monkeypatch.setattr(mistapi, "APISession", ExpiringApiSession)
+    monkeypatch.setattr(mistapi.api.v1.self.self, "getSelf", lambda session: FakeResponse(401))
+    mist = Mist(CONFIG)
+    first_session = mist.apisession._session
+    assert mist.check_session() is False
+    assert mist.apisession.logins == 2
+    assert mist.apisession._session is not first_session
+    hooks = mist.apisession._session.hooks["response"]
+    assert hooks == [METRICS.api_response, mist.throttle.response_hook]
+    assert mist.apisession._MAX_429_RETRIES == 0
+
+    monkeypatch.setattr(mistapi.api.v1.self.self, "getSelf", lambda session: FakeResponse(200))
+    assert mist.check_session() is True
+    assert mist.apisession.logins == 2
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from mist_metrics import METRICS
+from mist_psk import Mist
+from mist_ratelimit import ApiThrottle
+from conftest import FakeResponse
+
+
+def responses(*statuses):
+    """
+    Fake mistapi function returning a response for each status, and
+    recording the calls
+    """
+    calls = []
+    queue = [FakeResponse(status, headers={"Retry-After": "0"}) for status in statuses]
+
+    def function(*args, **kwargs):
+        calls.append(args)
+        return queue.pop(0)
+
+    function.calls = calls
+    return function
+
+
+def test_check_success():
+    throttle = ApiThrottle(max_concurrency=4)
+    assert throttle._check(FakeResponse(200), 0, True) is None
+    assert throttle._check(FakeResponse(404), 0, True) is None
+    assert throttle.concurrency == 4
+
+
+def test_check_throttled_request_pauses_all_the_requests():
+    throttle = ApiThrottle(max_concurrency=4)
+    start = time.monotonic()
+    assert throttle._check(FakeResponse(429, headers={"Retry-After": "30"}), 0, False) == 0
+    assert throttle._paused_until >= start + 30
+    assert throttle.concurrency == 2
+
+
+def test_check_server_error_only_retried_if_idempotent():
+    throttle = ApiThrottle()
+    assert throttle._check(FakeResponse(503), 0, True) == 1
+    assert throttle._check(FakeResponse(None), 2, True) == 4
+    assert throttle._check(FakeResponse(503), 0, False) is None
+
+
+def test_check_last_attempt():
+    throttle = ApiThrottle(retries=2)
+    assert throttle._check(FakeResponse(429), 2, True) is None
+    assert throttle._check(FakeResponse(500), 2, True) is None
+
+
+def test_call_retries_throttled_requests(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda delay: None)
+    function = responses(429, 500, 200)
+    assert ApiThrottle().call(function, "session").status_code == 200
+    assert len(function.calls) == 3
+
+
+def test_call_counts_the_retries(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda delay: None)
+    METRICS.reset()
+    ApiThrottle().call(responses(429, 500, 200))
+    ApiThrottle(retries=1).call(responses(429, 429))
+    counters = METRICS.to_dict()["counters"]
+    assert counters["api_retries_throttled"] == 2
+    assert counters["api_retries_failed"] == 1
+    assert counters["api_retries_exhausted"] == 1
+
+
+def test_call_does_not_retry_non_idempotent_requests(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda delay: None)
+    function = responses(500, 200)
+    assert ApiThrottle().call(function, "session", idempotent=False).status_code == 500
+    assert len(function.calls) == 1
+
+
+def test_call_stops_after_the_retries(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda delay: None)
+    function = responses(429, 429, 429)
+    assert ApiThrottle(retries=2).call(function).status_code == 429
+    assert len(function.calls) == 3
+
+
+def test_call_async_retries_throttled_requests(monkeypatch):
+    async def sleep(delay):
+        pass
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    function = responses(429, 503, 503, 200)
+
+    async def coroutine(*args, **kwargs):
+        return function(*args, **kwargs)
+
+    response = asyncio.run(
+        ApiThrottle().call_async(coroutine, "session", slot=asyncio.Semaphore(1))
+    )
+    assert response.status_code == 200
+    assert len(function.calls) == 4
+
+
+def test_mistapi_does_not_retry_throttled_requests(fake_apisession):
+    # the retries are done by the ApiThrottle only
+    mist = Mist({"scope": "orgs", "scope_id": "org", "ssid": "ssid"})
+    assert mist.apisession._MAX_429_RETRIES == 0
@@ -0,0 +1,39 @@
+from mist_reconcile import MistReconcile, normalize
+from mist_records import LdapUser, Psk
+
+
+def names(items):
+    return sorted(item.name for item in items)
+
+
+def test_normalize():
+    assert normalize("John.Doe@Example.com") == "john.doe@example.com"
+    assert normalize(None) == ""
+    assert normalize("") == ""
+
+
+def test_diff():
+    ldap_users = [LdapUser("alice", "a@x"), LdapUser("Bob", "b@x"), LdapUser("carol", "c@x")]
+    psks = [Psk("1", "bob"), Psk("2", "dave"), Psk("3", "ALICE")]
+    reconcile = MistReconcile(ldap_users, psks)
+    assert names(reconcile.to_create) == ["carol"]
+    assert names(reconcile.to_delete) == ["dave"]
+    assert names(reconcile.unchanged) == ["Bob", "alice"]
+
+
+def test_duplicate_ldap_users_are_kept_once():
+    ldap_users = [LdapUser("alice", "a@x"), LdapUser("ALICE", "other@x")]
+    reconcile = MistReconcile(ldap_users, [])
+    assert [user.email for user in reconcile.to_create] == ["a@x"]
+    assert reconcile.ldap_users() == reconcile.to_create
+
+
+def test_all_psks_with_the_same_name_are_deleted():
+    psks = [Psk("1", "old"), Psk("2", "Old"), Psk("3", "kept")]
+    reconcile = MistReconcile([LdapUser("kept")], psks)
+    assert sorted(psk.id for psk in reconcile.to_delete) == ["1", "2"]
+
+
+def test_users_without_name_are_ignored():
+    reconcile = MistReconcile([LdapUser(""), LdapUser(None)], [])
+    assert reconcile.to_create == []
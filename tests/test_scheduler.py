@@ -0,0 +1,64 @@
+from datetime import datetime
+import pytest
+import mist_scheduler
+from mist_scheduler import CronSchedule, Scheduler
+
+
+def test_parse_fields():
+    cron = CronSchedule("*/15 8-10,18 * 1,6 1-5")
+    assert cron.minutes == {0, 15, 30, 45}
+    assert cron.hours == {8, 9, 10, 18}
+    assert cron.days == set(range(1, 32))
+    assert cron.months == {1, 6}
+    assert cron.weekdays == {1, 2, 3, 4, 5}
+
+
+def test_sunday_is_0_or_7():
+    assert CronSchedule("0 0 * * 7").weekdays == {0, 7}
+
+
+@pytest.mark.parametrize(
+    "expression",
+    ["* * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *", "5-1 * * * *", "*/0 * * * *", "x * * * *"],
+)
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_next_run():
+    # 2026-10-18 is a Sunday
+    after = datetime(2026, 10, 18, 10, 7, 30)
+    assert CronSchedule("*/15 * * * *").next_run(after) == datetime(2026, 10, 18, 10, 15)
+    assert CronSchedule("0 2 * * *").next_run(after) == datetime(2026, 10, 19, 2, 0)
+    assert CronSchedule("30 6 * * 1-5").next_run(after) == datetime(2026, 10, 19, 6, 30)
+    assert CronSchedule("0 0 1 1 *").next_run(after) == datetime(2027, 1, 1, 0, 0)
+    assert CronSchedule("0 0 29 2 *").next_run(after) == datetime(2028, 2, 29, 0, 0)
+
+
+def test_next_run_day_or_weekday():
+    # like cron, the day of month or the weekday must match when both are set
+    after = datetime(2026, 10, 18, 10, 0)
+    assert CronSchedule("0 0 25 * 3").next_run(after) == datetime(2026, 10, 21, 0, 0)
+
+
+def test_never_matching_expression():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 31 2 *").next_run(datetime(2026, 10, 18))
+
+
+def test_interval_skips_the_missed_runs(monkeypatch):
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls):
+            return datetime(2026, 10, 18, 10, 25)
+
+    monkeypatch.setattr(mist_scheduler, "datetime", FixedDatetime)
+    scheduler = Scheduler(interval=600)
+    assert scheduler.next_run(datetime(2026, 10, 18, 10, 0)) == datetime(2026, 10, 18, 10, 30)
+    assert scheduler.next_run(datetime(2026, 10, 18, 10, 20)) == datetime(2026, 10, 18, 10, 30)
+
+
+def test_interval_or_cron_required():
+    with pytest.raises(ValueError):
+        Scheduler()
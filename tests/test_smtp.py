@@ -0,0 +1,80 @@
+import smtplib
+import threading
+import pytest
+from mist_smtp import SmtpPool
+
+
+class FakeSmtp:
+    """
+    smtplib.SMTP recording the sessions opened and the messages sent
+    """
+    sessions = []
+
+    def __init__(self, host, port):
+        self.logins = []
+        self.sent = []
+        self.closed = False
+        self.disconnect = False
+        FakeSmtp.sessions.append(self)
+
+    def login(self, username, password):
+        self.logins.append(username)
+
+    def sendmail(self, from_email, receivers, msg):
+        if self.disconnect:
+            raise smtplib.SMTPServerDisconnected("idle timeout")
+        self.sent.append(msg)
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def pool():
+    FakeSmtp.sessions = []
+    return SmtpPool(FakeSmtp, "smtp.example.com", 587, "user", "password", size=3)
+
+
+def test_sessions_reused(pool):
+    for i in range(10):
+        pool.sendmail("mist@example.com", ["alice@example.com"], f"message {i}")
+    assert len(FakeSmtp.sessions) == 3
+    assert all(session.logins == ["user"] for session in FakeSmtp.sessions)
+    assert sum(len(session.sent) for session in FakeSmtp.sessions) == 10
+
+
+def test_sessions_limited_to_the_pool_size(pool):
+    started = threading.Barrier(5)
+
+    def send(i):
+        started.wait()
+        pool.sendmail("mist@example.com", ["alice@example.com"], f"message {i}")
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 1 <= len(FakeSmtp.sessions) <= 3
+    assert sum(len(session.sent) for session in FakeSmtp.sessions) == 5
+
+
+def test_reconnect_when_the_server_closed_the_session():
+    FakeSmtp.sessions = []
+    pool = SmtpPool(FakeSmtp, "smtp.example.com", 587, "user", "password")
+    pool.sendmail("mist@example.com", ["alice@example.com"], "first")
+    FakeSmtp.sessions[0].disconnect = True
+    pool.sendmail("mist@example.com", ["alice@example.com"], "second")
+    assert len(FakeSmtp.sessions) == 2
+    assert FakeSmtp.sessions[0].closed
+    assert FakeSmtp.sessions[1].sent == ["second"]
+
+
+def test_close(pool):
+    pool.sendmail("mist@example.com", ["alice@example.com"], "message")
+    pool.close()
+    assert FakeSmtp.sessions[0].closed
+    assert pool._created == 0
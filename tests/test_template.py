@@ -0,0 +1,26 @@
+import os
+import mist_template
+from mist_template import get_template
+
+
+def test_render_placeholders(tmp_path):
+    path = tmp_path / "template.html"
+    path.write_text("<p>{0} {user_name}: {psk!r} {count:03d} {{literal}}</p>")
+    html = get_template(str(path)).render("Hello", user_name="alice", psk="secret", count=7)
+    assert html == "<p>Hello alice: 'secret' 007 {literal}</p>"
+
+
+def test_template_parsed_once(tmp_path):
+    path = tmp_path / "template.html"
+    path.write_text("{user_name}")
+    assert get_template(str(path)) is get_template(str(path))
+
+
+def test_template_reloaded_when_modified(tmp_path):
+    path = tmp_path / "template.html"
+    path.write_text("Hello {user_name}")
+    template = get_template(str(path))
+    path.write_text("Bye {user_name}")
+    os.utime(path, (template.mtime + 10, template.mtime + 10))
+    assert get_template(str(path)).render(user_name="alice") == "Bye alice"
+    assert mist_template._TEMPLATES[str(path)] is not template